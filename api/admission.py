@@ -0,0 +1,74 @@
+"""
+api.admission.py
+~~~~~~~~~~~~~~~~
+Admission control of the webhook events, so latency stays bounded under overload.
+"""
+import os
+import threading
+from typing import Union
+
+from api import metrics
+from models import facebook
+
+CHEAP = "cheap"  # text replies, postbacks: no download
+ATTACHMENT = "attachment"  # attachment downloads, the expensive ingestions
+
+EVENTS = metrics.counter(
+    "webhook_events_total",
+    "Webhook messaging events by kind and admission outcome.",
+    ("kind", "outcome"),
+)
+IN_FLIGHT = metrics.gauge(
+    "webhook_in_flight", "Webhook messaging events being processed.", ("kind",)
+)
+
+
+def kind(messaging: Union[facebook.Messaging, facebook.WebhookMessaging]) -> str:
+    """Classify the messaging event by cost."""
+    return ATTACHMENT if messaging.message.attachments else CHEAP
+
+
+class AdmissionController:
+    """Caps the messaging events processed at once.
+
+    Cheap events may use the whole `capacity`, attachment downloads only `capacity - reserved`:
+    when downloads back up, text replies and postbacks are still admitted, and everything beyond
+    the capacity is rejected right away instead of queueing until it times out.
+    """
+
+    def __init__(self, capacity: int, reserved: int):
+        if not 0 <= reserved < capacity:
+            raise ValueError("The reserved capacity must be below the capacity.")
+        self.capacity = capacity
+        self.reserved = reserved
+        self._in_flight = {CHEAP: 0, ATTACHMENT: 0}
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return sum(self._in_flight.values())
+
+    def try_acquire(self, kind: str) -> bool:
+        """Admit an event of the kind if there is capacity left for it."""
+        limit = self.capacity - (self.reserved if kind == ATTACHMENT else 0)
+        with self._lock:
+            admitted = self.in_flight < limit
+            if admitted:
+                self._in_flight[kind] += 1
+        EVENTS.inc(kind=kind, outcome="accepted" if admitted else "rejected")
+        if admitted:
+            IN_FLIGHT.inc(kind=kind)
+        return admitted
+
+    def release(self, kind: str):
+        """Mark an admitted event of the kind as processed."""
+        with self._lock:
+            self._in_flight[kind] -= 1
+        IN_FLIGHT.dec(kind=kind)
+
+
+# Shared by the webhook handler
+ADMISSION = AdmissionController(
+    capacity=int(os.environ.get("WEBHOOK_MAX_IN_FLIGHT", 32)),
+    reserved=int(os.environ.get("WEBHOOK_RESERVED_CHEAP", 4)),
+)
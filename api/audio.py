@@ -0,0 +1,280 @@
+"""
+api.audio.py
+~~~~~~~~~~~~
+Audio decoding and vectorised signal analysis of the voice records.
+"""
+import functools
+import io
+import shutil
+import subprocess
+import tempfile
+import wave
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+SAMPLE_RATE = 16000  # every voice is analysed as mono PCM at this rate
+WAVEFORM_LEVELS = (64, 256, 1024, 4096)  # zoom levels in samples per peak, finest first
+PEAK_SCALE = 127  # peaks are quantized to int8 in [-PEAK_SCALE, PEAK_SCALE]
+
+# Landmark fingerprint config. Bin edges of the bands in which the loudest peak of a frame is picked.
+FINGERPRINT_BANDS = (2, 8, 16, 32, 64, 128, 256, 513)
+FINGERPRINT_FAN_OUT = 4  # number of following peaks each peak is paired with
+FINGERPRINT_MAX_DT = 63  # max frames between paired peaks, fits in 6 bits
+
+# Timbre embedding config: statistics of the MFCCs over the voiced frames
+N_MELS = 40
+N_MFCC = 20  # coefficients 1..N_MFCC, c0 (loudness) is left out
+EMBEDDING_SIZE = 2 * N_MFCC  # mean and standard deviation of each coefficient
+
+# Silence trimming & loudness normalisation config
+LEVEL_FRAME = 400  # 25ms frames...
+LEVEL_HOP = 160  # ...every 10ms
+SILENCE_FLOOR_DB = -50.0  # frames quieter than this (dBFS) are always silence
+SILENCE_RANGE_DB = 40.0  # ...as are frames this much quieter than the loudest frame
+TRIM_PADDING = 0.05  # seconds of silence kept around the voiced part
+TARGET_LOUDNESS_DB = -20.0  # RMS level (dBFS) of the voiced part after gain
+PEAK_CEILING_DB = -1.0  # the gain never pushes the peak above this level (dBFS)
+
+
+def decode(content: bytes, audio_extension: str, rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Decode the audio content to mono float32 PCM in [-1, 1] sampled at `rate`.
+    WAV is decoded natively, any other format by ffmpeg when it is installed.
+
+    Raises ValueError if the content cannot be decoded.
+    """
+    if audio_extension.lower() == "wav":
+        samples, source_rate = __decode_wav(content)
+        return resample(samples, source_rate, rate)
+    return __decode_ffmpeg(content, audio_extension, rate)
+
+
+def __decode_wav(content: bytes) -> tuple[np.ndarray, int]:
+    """Decode PCM WAV bytes. Return the mono samples and their sample rate."""
+    try:
+        with wave.open(io.BytesIO(content)) as wav:
+            channels = wav.getnchannels()
+            width = wav.getsampwidth()
+            rate = wav.getframerate()
+            raw = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError) as e:
+        raise ValueError(f"Cannot decode WAV content: {e}")
+
+    if width == 1:  # 8-bit WAV is unsigned
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width in (2, 4):
+        dtype = np.dtype(f"<i{width}")
+        samples = np.frombuffer(raw, dtype=dtype).astype(np.float32)
+        samples /= float(np.iinfo(dtype).max) + 1
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {width} bytes.")
+
+    samples = samples[: len(samples) - len(samples) % channels]
+    return samples.reshape(-1, channels).mean(axis=1, dtype=np.float32), rate
+
+
+def __decode_ffmpeg(content: bytes, audio_extension: str, rate: int) -> np.ndarray:
+    """Decode any ffmpeg supported format to mono float32 samples at `rate`.
+    The content is read from a temporary file rather than a pipe, which ffmpeg can't seek: e.g. an
+    MP4 with its index (moov atom) at the end, as recorded by phones, can't be read from a pipe.
+    """
+    if not shutil.which("ffmpeg"):
+        raise ValueError("Cannot decode compressed audio: ffmpeg is not installed.")
+    with tempfile.NamedTemporaryFile(suffix=f".{audio_extension}") as source:
+        source.write(content)
+        source.flush()
+        result = subprocess.run(
+            ["ffmpeg", "-v", "error", "-i", source.name, "-f", "f32le", "-ac", "1"]
+            + ["-ar", str(rate), "pipe:1"],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+        )
+    if result.returncode:
+        raise ValueError(f"ffmpeg cannot decode content: {result.stderr.decode()}")
+    return np.frombuffer(result.stdout, dtype="<f4").astype(np.float32)
+
+
+def resample(samples: np.ndarray, source_rate: int, rate: int) -> np.ndarray:
+    """Linearly resample the samples from `source_rate` to `rate`."""
+    if source_rate == rate or not len(samples):
+        return samples.astype(np.float32, copy=False)
+    duration = len(samples) / source_rate
+    positions = np.arange(int(duration * rate)) * (source_rate / rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def frames(samples: np.ndarray, size: int, hop: int) -> np.ndarray:
+    """Slice the samples into frames of `size` every `hop` samples, as a strided view without copies.
+    The tail is zero padded so every sample lands in a frame."""
+    count = max(1, -(-(len(samples) - size) // hop) + 1)
+    padded = np.zeros((count - 1) * hop + size, dtype=np.float32)
+    padded[: len(samples)] = samples[: len(padded)]
+    return np.lib.stride_tricks.sliding_window_view(padded, size)[::hop]
+
+
+def stft(samples: np.ndarray, n_fft: int = 1024, hop: int = 256) -> np.ndarray:
+    """Magnitude spectrogram of the samples, shape (frames, n_fft // 2 + 1)."""
+    windowed = frames(samples, n_fft, hop) * np.hanning(n_fft).astype(np.float32)
+    return np.abs(np.fft.rfft(windowed, axis=1)).astype(np.float32)
+
+
+def fingerprint(samples: np.ndarray) -> np.ndarray:
+    """Acoustic fingerprint of the samples: hashes of pairs of spectral peaks (landmarks).
+    Only the time-frequency layout of the loudest peaks is hashed, so a re-encoded or re-gained copy
+    of a recording shares most of its hashes with the original while byte hashes would differ.
+
+    Returns:
+    The sorted unique hashes as int64. Each hash packs (f1, f2, dt) on 26 bits.
+    """
+    spectrum = np.log1p(stft(samples, n_fft=1024, hop=512))
+    times, freqs = [], []
+    for low, high in zip(FINGERPRINT_BANDS[:-1], FINGERPRINT_BANDS[1:]):
+        band = spectrum[:, low:high]
+        strength = band.max(axis=1)
+        # only keep frames standing out of the band's typical level, so silence yields no peak
+        (keep,) = np.nonzero(strength > max(strength.mean() * 1.2, 1e-2))
+        times.append(keep)
+        freqs.append(band[keep].argmax(axis=1) + low)
+    times, freqs = np.concatenate(times), np.concatenate(freqs)
+    order = np.lexsort((freqs, times))
+    times, freqs = times[order].astype(np.int64), freqs[order].astype(np.int64)
+
+    hashes = []
+    for step in range(1, FINGERPRINT_FAN_OUT + 1):
+        dt = times[step:] - times[:-step]
+        paired = (dt > 0) & (dt <= FINGERPRINT_MAX_DT)
+        hashes.append(
+            (freqs[:-step][paired] << 16) | (freqs[step:][paired] << 6) | dt[paired]
+        )
+    return np.unique(np.concatenate(hashes))
+
+
+@functools.lru_cache
+def mel_filterbank(
+    n_fft: int = 512, n_mels: int = N_MELS, rate: int = SAMPLE_RATE
+) -> np.ndarray:
+    """Triangular mel filters mapping rfft bins to mel bands, shape (n_mels, n_fft // 2 + 1)."""
+    top = 2595 * np.log10(1 + rate / 2 / 700)
+    edges = 700 * (10 ** (np.linspace(0, top, n_mels + 2) / 2595) - 1)
+    bins = np.fft.rfftfreq(n_fft, 1 / rate)
+    lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (bins - lower) / (center - lower)
+    falling = (upper - bins) / (upper - center)
+    return np.maximum(0, np.minimum(rising, falling)).astype(np.float32)
+
+
+@functools.lru_cache
+def __dct_matrix(n_mels: int = N_MELS, n_mfcc: int = N_MFCC) -> np.ndarray:
+    """DCT-II basis of the cepstral coefficients 1..n_mfcc, shape (n_mfcc, n_mels)."""
+    coefficients = np.arange(1, n_mfcc + 1)[:, None]
+    return np.cos(np.pi / n_mels * (np.arange(n_mels) + 0.5) * coefficients).astype(
+        np.float32
+    )
+
+
+def embedding(samples: np.ndarray) -> np.ndarray:
+    """Fixed-size timbre embedding of the samples: mean and standard deviation of the MFCCs of the
+    voiced frames, scaled to unit length so the dot product of two embeddings is their cosine.
+
+    Returns:
+    A float32 vector of EMBEDDING_SIZE.
+    """
+    power = np.square(stft(samples, n_fft=512, hop=160))
+    log_mel = np.log(power @ mel_filterbank().T + 1e-6)
+    mfcc = log_mel @ __dct_matrix().T
+
+    # frames more than ~25dB below the loudest one are silence and would only blur the timbre
+    energy = log_mel.mean(axis=1)
+    voiced = energy > energy.max() - 6
+    stats = np.concatenate((mfcc[voiced].mean(axis=0), mfcc[voiced].std(axis=0)))
+    norm = np.linalg.norm(stats)
+    if norm < 1e-3:  # silence has no timbre
+        return np.zeros(EMBEDDING_SIZE, dtype=np.float32)
+    return (stats / norm).astype(np.float32)
+
+
+def levels(samples: np.ndarray) -> tuple[float, float, float]:
+    """Find the voiced part of the samples and the gain normalising its loudness.
+    Frame energies are computed in a single vectorised pass over strided frames.
+
+    Returns:
+    The (start, end) of the voiced part in seconds and the gain in dB to apply to it.
+    Silence yields an empty part and no gain.
+    """
+    framed = frames(samples, LEVEL_FRAME, LEVEL_HOP)
+    power = np.einsum("ij,ij->i", framed, framed) / LEVEL_FRAME
+    energy = 10 * np.log10(np.maximum(power, 1e-12))
+    threshold = max(SILENCE_FLOOR_DB, energy.max() - SILENCE_RANGE_DB)
+    (voiced,) = np.nonzero(energy > threshold)
+    if not len(voiced):
+        return 0.0, 0.0, 0.0
+
+    padding = int(TRIM_PADDING * SAMPLE_RATE)
+    start = max(0, voiced[0] * LEVEL_HOP - padding)
+    end = min(len(samples), voiced[-1] * LEVEL_HOP + LEVEL_FRAME + padding)
+    loudness = 10 * np.log10(power[voiced].mean())
+    peak = 20 * np.log10(np.abs(samples[start:end]).max())
+    gain = min(TARGET_LOUDNESS_DB - loudness, PEAK_CEILING_DB - peak)
+    return float(start / SAMPLE_RATE), float(end / SAMPLE_RATE), round(float(gain), 2)
+
+
+def apply_levels(
+    samples: np.ndarray, trim_start: float, trim_end: float, gain_db: float
+) -> np.ndarray:
+    """Trim the samples to their voiced part and apply the gain computed by `levels`."""
+    voiced = samples[int(trim_start * SAMPLE_RATE) : int(trim_end * SAMPLE_RATE)]
+    return (voiced * np.float32(10 ** (gain_db / 20))).astype(np.float32)
+
+
+def waveform_peaks(
+    samples: np.ndarray, levels: Sequence[int] = WAVEFORM_LEVELS
+) -> Mapping[int, np.ndarray]:
+    """Downsample the samples to min/max/rms peaks at every zoom level.
+    The finest level is computed from the samples in one pass, coarser levels are reduced from it.
+
+    Returns:
+    A mapping of samples per peak to an int8 array of shape (peaks, 3) holding min, max and rms.
+    """
+    levels = sorted(levels)
+    if any(level % levels[0] for level in levels):
+        raise ValueError("Every waveform level must be a multiple of the finest one.")
+
+    finest = levels[0]
+    if not len(samples):  # an empty record is drawn as silence
+        samples = np.zeros(1, dtype=np.float32)
+    padded = np.zeros(-(-len(samples) // finest) * finest, dtype=np.float32)
+    padded[: len(samples)] = samples
+    bins = padded.reshape(-1, finest)
+    lows, highs, powers = (
+        bins.min(axis=1),
+        bins.max(axis=1),
+        np.square(bins).mean(axis=1),
+    )
+
+    peaks = {}
+    for level in levels:
+        factor = level // finest
+        count = -(-len(lows) // factor)
+        pad = count * factor - len(lows)
+        # pad with the neutral element of each reduction so partial bins stay exact
+        low = np.pad(lows, (0, pad), constant_values=np.inf).reshape(count, factor)
+        high = np.pad(highs, (0, pad), constant_values=-np.inf).reshape(count, factor)
+        power = np.pad(powers, (0, pad)).reshape(count, factor)
+        weight = np.pad(np.ones_like(powers), (0, pad)).reshape(count, factor)
+        rms = np.sqrt(power.sum(axis=1) / weight.sum(axis=1))
+        stacked = np.stack((low.min(axis=1), high.max(axis=1), rms), axis=1)
+        peaks[level] = np.round(np.clip(stacked, -1, 1) * PEAK_SCALE).astype(np.int8)
+    return peaks
+
+
+def pack_peaks(peaks: Mapping[int, np.ndarray]) -> bytes:
+    """Serialize the waveform peaks to a compact binary blob."""
+    buffer = io.BytesIO()
+    np.savez(buffer, **{str(level): values for level, values in peaks.items()})
+    return buffer.getvalue()
+
+
+def unpack_peaks(content: bytes) -> Mapping[int, np.ndarray]:
+    """Deserialize the waveform peaks packed by `pack_peaks`."""
+    with np.load(io.BytesIO(content), allow_pickle=False) as packed:
+        return {int(level): packed[level] for level in packed.files}
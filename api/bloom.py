@@ -0,0 +1,82 @@
+"""
+api.bloom.py
+~~~~~~~~~~~~
+Counting Bloom filter: set membership answered in memory, with no false negatives and a bounded share of
+false positives, that supports removals.
+"""
+import hashlib
+import math
+import threading
+
+MAX_COUNT = 255  # a saturated counter is never decremented again
+
+
+class CountingBloomFilter:
+    """A Bloom filter of byte counters rather than bits, sized for `capacity` keys at `error_rate`.
+
+    `might_contain` False is definite: the key was never added, or was removed since. True may be a
+    false positive, at about `false_positive_rate()`. Only remove keys that were added, else the
+    counters of other keys may drop to zero and those keys be reported absent.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # optimal counters and hashes for the capacity & error rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._counters = bytearray(self.size)
+        self._lock = threading.Lock()
+
+    def _positions(self, key: str) -> list[int]:
+        # double hashing: the k positions derived from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                if self._counters[position] < MAX_COUNT:
+                    self._counters[position] += 1
+            self.count += 1
+
+    def remove(self, key: str):
+        positions = self._positions(key)
+        with self._lock:
+            if not all(self._counters[position] for position in positions):
+                return  # never added
+            for position in positions:
+                if self._counters[position] < MAX_COUNT:
+                    self._counters[position] -= 1
+            self.count -= 1
+
+    def might_contain(self, key: str) -> bool:
+        counters = self._counters
+        return all(counters[position] for position in self._positions(key))
+
+    __contains__ = might_contain
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self._counters)
+
+    def false_positive_rate(self) -> float:
+        """The current probability of a false positive: that all the positions of a key never added
+        are set."""
+        filled = (self.size - self._counters.count(0)) / self.size
+        return filled**self.hashes
+
+    def stats(self) -> dict:
+        return {
+            "keys": self.count,
+            "capacity": self.capacity,
+            "counters": self.size,
+            "hashes": self.hashes,
+            "memory_bytes": self.memory_bytes,
+            "false_positive_rate": self.false_positive_rate(),
+        }
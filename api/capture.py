@@ -0,0 +1,96 @@
+"""
+api.capture.py
+~~~~~~~~~~~~~~
+Capture journal of the webhook events, replayed by `python -m benchmarks.replay`.
+"""
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+from models import facebook
+
+LOGGER = logging.getLogger(__name__)
+
+# Capture is off unless a journal path is set
+CAPTURE_PATH = os.environ.get("WEBHOOK_CAPTURE_PATH")
+CAPTURE_MAX_BYTES = int(os.environ.get("WEBHOOK_CAPTURE_MAX_BYTES", 64 * 2**20))
+CAPTURE_BACKUPS = int(os.environ.get("WEBHOOK_CAPTURE_BACKUPS", 5))
+
+GLOBAL = {}
+
+
+class CaptureJournal:
+    """Events appended as compact JSON lines to `path`.
+
+    Once the file exceeds `max_bytes` it is rotated to `path.1`, `path.1` to `path.2`... keeping
+    `backups` files. Appends and rotations hold a file lock, so workers can share the journal.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, backups: int):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock_path = self.path.with_name(f".{self.path.name}.lock")
+
+    def append(self, event: Union[facebook.Event, bytes]):
+        """Append the event, a model or the JSON bytes it was received as, rotating the journal
+        first if it is full."""
+        if isinstance(event, bytes):
+            # re-serialized compactly, for the line to hold the whole event as received
+            line = json.dumps(json.loads(event), separators=(",", ":")).encode() + b"\n"
+        else:
+            line = event.model_dump_json(exclude_none=True).encode() + b"\n"
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self.path.exists() and self.path.stat().st_size >= self.max_bytes:
+                    self._rotate()
+                with open(self.path, "ab") as journal:
+                    journal.write(line)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def files(self) -> list[Path]:
+        """The journal files, oldest first."""
+        rotated = [
+            self.path.with_name(f"{self.path.name}.{i}")
+            for i in range(1, self.backups + 1)
+        ]
+        return [path for path in [*reversed(rotated), self.path] if path.exists()]
+
+    def _rotate(self):
+        for i in range(self.backups, 0, -1):
+            source = (
+                self.path.with_name(f"{self.path.name}.{i - 1}") if i > 1 else self.path
+            )
+            if source.exists():
+                os.replace(source, self.path.with_name(f"{self.path.name}.{i}"))
+        self.path.unlink(missing_ok=True)  # no backups kept
+        LOGGER.info("Rotated the capture journal %s.", self.path)
+
+
+def journal() -> Optional[CaptureJournal]:
+    """Get the capture journal at CAPTURE_PATH. Return None if capture is off."""
+    if not CAPTURE_PATH:
+        return None
+    capture = GLOBAL.get("journal")
+    if capture is None or capture.path != Path(CAPTURE_PATH):
+        capture = GLOBAL["journal"] = CaptureJournal(
+            CAPTURE_PATH, CAPTURE_MAX_BYTES, CAPTURE_BACKUPS
+        )
+    return capture
+
+
+def record(event: Union[facebook.Event, bytes]):
+    """Append the event to the capture journal, if capture is on. Capture failures are only logged."""
+    capture = journal()
+    if capture is None:
+        return
+    try:
+        capture.append(event)
+    except OSError as e:
+        LOGGER.warning("Failed to capture the event: %s", e)
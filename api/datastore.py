@@ -4,27 +4,46 @@ api.datastore.py
 Database storage related CRUD operations.
 TODO: set up actual database lol
 """
+import contextlib
 import csv
 import datetime
+import fcntl
 import logging
 import os
-from collections.abc import Mapping, Sequence
+import shutil
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Collection, Iterator, Mapping, Sequence
 from pathlib import Path
-from typing import Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 from zoneinfo import ZoneInfo
 
-import pymongo
-import transaction
 from pydantic import BaseModel as PydanticModel
 
+from api import bloom, logs, metrics, prompts, tracing, usercache
 from models import weaver
 
+if TYPE_CHECKING:  # imported on first use, for the API to boot without them
+    import numpy as np
+    import pymongo
+
+    from api import similarity, spectrogram
+
 LOGGER = logging.getLogger(__name__)
 
 # Voice records related config
 
 ROOT = Path(__file__).joinpath("..").joinpath("..").resolve()
 VOICES_DIR = ROOT / "voices"
+WAVEFORM_EXTENSION = "peaks"  # packed waveform peaks stored next to the voice file
+# files in voices dir that aren't voice records
+DERIVED_EXTENSIONS = {WAVEFORM_EXTENSION}
+EMBEDDINGS_DIR = "embeddings"  # subdirectory of voices dir holding the similarity index
+# subdirectory of voices dir caching spectrogram thumbnails
+SPECTROGRAMS_DIR = "spectrograms"
+SPECTROGRAMS_MAX_BYTES = int(os.environ.get("SPECTROGRAMS_MAX_BYTES", 256 * 2**20))
+STARTUP_LOCK = ".startup.lock"  # held by the worker initializing the datastore
 
 # MongoDB related config
 
@@ -33,27 +52,150 @@ USERS = "users"
 PROMPTS = "prompts"
 USERNAME_TO_ID = "username_to_id"
 PROMPT_MANAGER = "prompt_manager"
+# inverted index: landmark hash -> ids of the voices having it
+FINGERPRINTS = "fingerprints"
+ROLLUPS = "rollups"  # voices counted by prompt, user and day, see weaver.Rollup
+
+# Share of landmark hashes two recordings must have in common to be considered duplicates
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", 0.3))
+MIN_FINGERPRINT_SIZE = 8  # shorter fingerprints (silence, clicks) are never compared
+# Membership filters of the user ids and usernames: share of false positives, and the keys they are
+# sized for at least (twice the registered ones if more)
+USER_FILTER_ERROR_RATE = float(os.environ.get("USER_FILTER_ERROR_RATE", 0.01))
+USER_FILTER_CAPACITY = int(os.environ.get("USER_FILTER_CAPACITY", 100_000))
+# Timezone of the local days the voices are counted by, besides UTC days
+ROLLUP_TIMEZONE = os.environ.get("ROLLUP_TIMEZONE", "America/Los_Angeles")
+# Seconds between the reloads of a worker's prompt index in the background, to see the prompts other
+# workers changed
+PROMPT_REFRESH_INTERVAL = float(os.environ.get("PROMPT_REFRESH_INTERVAL", 60))
 
 GLOBAL = {}
+CONNECTING = threading.RLock()  # held while creating the client, for only one to be
 MONGO_CONN_STR = os.environ.get("MONGO_CONN_STR", "mongodb://127.0.0.1:27017")
+MONGO_DATABASE = os.environ.get("MONGO_DATABASE", "sounds")
+
+OPERATIONS = metrics.histogram(
+    "datastore_operation_seconds",
+    "Seconds taken by datastore calls.",
+    ("operation", "collection"),
+)
+ERRORS = metrics.counter(
+    "datastore_errors_total",
+    "Datastore calls that raised.",
+    ("operation", "collection"),
+)
+FILTER_LOOKUPS = metrics.counter(
+    "user_filter_lookups_total",
+    "User registry lookups through the membership filters, by filter and result: negative (answered"
+    " without a round trip), positive, or false_positive.",
+    ("filter", "result"),
+)
+FILTER_KEYS = metrics.gauge(
+    "user_filter_keys", "Keys in the user membership filters.", ("filter",)
+)
+FILTER_BYTES = metrics.gauge(
+    "user_filter_memory_bytes", "Memory of the user membership filters.", ("filter",)
+)
+FILTER_FALSE_POSITIVE_RATE = metrics.gauge(
+    "user_filter_false_positive_rate",
+    "Estimated false positive rate of the user membership filters.",
+    ("filter",),
+)
+
+
+class DuplicateVoiceError(ValueError):
+    """The voice record is a near-duplicate of an archived one."""
+
+
+def __database() -> "pymongo.database.Database":
+    """Get the MONGO_DATABASE (`sounds`) database"""
+    if "db_client" not in GLOBAL:
+        with CONNECTING:
+            if "db_client" not in GLOBAL:
+                LOGGER.info("No mongo client found. Creating a new one...")
+                startup()
+    return GLOBAL.get("db_client").get_database(MONGO_DATABASE)
 
 
-def __database() -> pymongo.database.Database:
-    """Get the `sounds` database"""
-    if "db_client" not in GLOBAL:
-        LOGGER.info("No mongo client found. Creating a new one...")
-        startup()
-    return GLOBAL.get("db_client").sounds
+def __embedding_index() -> "similarity.EmbeddingIndex":
+    """Get the similarity index of the voices directory"""
+    from api import audio, similarity
+
+    directory = VOICES_DIR / EMBEDDINGS_DIR
+    index = GLOBAL.get("embedding_index")
+    if index is None or index.directory != directory:
+        index = similarity.EmbeddingIndex(directory, dim=audio.EMBEDDING_SIZE)
+        GLOBAL.update(embedding_index=index)
+    return index
+
+
+def __spectrogram_cache() -> "spectrogram.SpectrogramCache":
+    """Get the spectrogram cache of the voices directory"""
+    from api import spectrogram
+
+    directory = VOICES_DIR / SPECTROGRAMS_DIR
+    cache = GLOBAL.get("spectrogram_cache")
+    if cache is None or cache.directory != directory:
+        cache = spectrogram.SpectrogramCache(directory, SPECTROGRAMS_MAX_BYTES)
+        GLOBAL.update(spectrogram_cache=cache)
+    return cache
 
 
 def startup():
-    """Startup the mongo client"""
+    """Startup the mongo client, blocking until the server answers.
+    A client already created, e.g. by a job run meanwhile, is reused."""
+    import pymongo
+
     LOGGER.info("Initializing the mongo client connection")
-    client = pymongo.MongoClient(
-        host=MONGO_CONN_STR, connectTimeoutMS=3000, serverSelectionTimeoutMS=3500
-    )
-    client.server_info()  # check server liveness
-    GLOBAL.update(db_client=client)
+    with CONNECTING:
+        client = GLOBAL.get("db_client")
+        if client is None:
+            client = pymongo.MongoClient(
+                host=MONGO_CONN_STR,
+                connectTimeoutMS=3000,
+                serverSelectionTimeoutMS=3500,
+            )
+        client.server_info()  # check server liveness
+        GLOBAL.update(db_client=client)
+
+
+def initialize() -> bool:
+    """One-time initialization: voices directory layout, collection indexes and the prompt manager.
+    Idempotent, and guarded by a cross-process lock so that among workers booting together only one
+    initializes while the others start serving right away.
+
+    Returns:
+    Whether this process did the initialization.
+    """
+    for directory in (VOICES_DIR / EMBEDDINGS_DIR, VOICES_DIR / SPECTROGRAMS_DIR):
+        directory.mkdir(parents=True, exist_ok=True)
+
+    with open(VOICES_DIR / STARTUP_LOCK, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            LOGGER.info("Another worker is initializing the datastore. Skipping.")
+            return False
+        try:
+            database = __database()
+            database.get_collection(METADATAS).create_index("username")
+            database.get_collection(METADATAS).create_index("prompt_id")
+            database.get_collection(USERNAME_TO_ID).create_index("id")
+            database.get_collection(FINGERPRINTS).create_index("voices")
+            __index_rollups(database.get_collection(ROLLUPS))
+            database.get_collection(PROMPT_MANAGER).update_one(
+                {"_id": "manager"},
+                {
+                    "$setOnInsert": weaver.PromptManager().model_dump(
+                        exclude={"id", "deleted_prompts"}
+                    )
+                },
+                upsert=True,
+            )
+            LOGGER.info("Initialized the datastore.")
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return True
 
 
 def shutdown():
@@ -64,55 +206,98 @@ def shutdown():
         client.close()
 
 
+@contextlib.contextmanager
+def __timed(operation: str, collection_name: str) -> Iterator[None]:
+    """Time the datastore call into OPERATIONS, counting it into ERRORS if it raises.
+    Within a trace the call is a span of its own."""
+    started = time.perf_counter()
+    try:
+        with tracing.span(f"mongo.{operation}", collection=collection_name):
+            yield
+    except Exception:
+        ERRORS.inc(operation=operation, collection=collection_name)
+        raise
+    finally:
+        OPERATIONS.observe(
+            time.perf_counter() - started,
+            operation=operation,
+            collection=collection_name,
+        )
+
+
 def __insert_collection(collection_name: str, document: PydanticModel) -> str:
     """Insert one document to the collection"""
 
     collection = __database().get_collection(collection_name)
-    inserted = collection.insert_one(
-        document.model_dump(by_alias=True, exclude_unset=True)
-    ).inserted_id
-    LOGGER.info(f"Inserted document with id {inserted} to {collection_name}")
+    with __timed("insert", collection_name):
+        inserted = collection.insert_one(
+            document.model_dump(by_alias=True, exclude_unset=True)
+        ).inserted_id
+    LOGGER.info("Inserted document with id %s to %s", inserted, collection_name)
 
     return inserted
 
 
 def __get_document(collection_name: str, query: Mapping = None) -> PydanticModel:
     """Get documents from given collection"""
-    LOGGER.info(f"Getting document in {collection_name} " f"with query={query}")
+    LOGGER.info(
+        "Getting document in %s with query=%s", collection_name, logs.payload(query)
+    )
     collection = __database().get_collection(collection_name)
-    return collection.find_one(query)
+    with __timed("get", collection_name):
+        return collection.find_one(query)
 
 
 def __get_documents(
-    collection_name: str, query: Union[str, Mapping] = None
+    collection_name: str,
+    query: Union[str, Mapping] = None,
+    projection: Optional[Mapping] = None,
 ) -> Sequence[PydanticModel]:
     """Get documents from given collection"""
     LOGGER.info(
-        f"Getting multiple documents in {collection_name} " f"with query={query}"
+        "Getting multiple documents in %s with query=%s",
+        collection_name,
+        logs.payload(query),
     )
     collection = __database().get_collection(collection_name)
-    return collection.find(query)
+    return collection.find(query, projection)
 
 
 def __update_collection(
-    collection_name: str, query: Union[str, Mapping], doc: PydanticModel
+    collection_name: str, query: Union[str, int, Mapping], doc: PydanticModel
 ) -> any:
     """Update the collection given the collection_name, doc, and filter_dict"""
-    LOGGER.info(f"Updating documents to {collection_name}")
+    LOGGER.info("Updating documents to %s", collection_name)
     collection = __database().get_collection(collection_name)
-    return collection.find_one_and_update(
-        ({"_id": query} if isinstance(query, str) else query),
-        {"$set": doc.model_dump(exclude_unset=True)},
+    with __timed("update", collection_name):
+        return collection.find_one_and_update(
+            (query if isinstance(query, Mapping) else {"_id": query}),
+            {"$set": doc.model_dump(exclude_unset=True)},
+        )
+
+
+def __delete_document(collection_name: str, query: Union[str, Mapping]) -> int:
+    """Delete one document from the collection. Return the number of deleted documents."""
+    LOGGER.info(
+        "Deleting document in %s with query=%s", collection_name, logs.payload(query)
     )
+    collection = __database().get_collection(collection_name)
+    with __timed("delete", collection_name):
+        return collection.delete_one(
+            {"_id": query} if isinstance(query, str) else query
+        ).deleted_count
 
 
+@tracing.traced("datastore.insert_voice")
 def insert_voice(
     id: str,
     audio_extension: str,
     audio_content: any,
     datetime: datetime.datetime,
     username: str,
-    prompt_id: int,
+    prompt_id: Optional[int],
+    fingerprint: Optional[Collection[int]] = None,
+    reject_duplicates: bool = False,
 ) -> str:
     """Save the audio file (voice records) to voices directory. Insert the metadata to the datastore.
     Args:
@@ -121,63 +306,434 @@ def insert_voice(
     audio_content -- the downloaded audio content
     datetime -- datetime of the audio content
     username -- owner of the voice record
-    prompt_id -- prompt associates with the voice record
+    prompt_id -- prompt associates with the voice record, None if no prompt was open
+    fingerprint -- landmark hashes of the audio (see audio.fingerprint) to detect near-duplicates
+    reject_duplicates -- raise DuplicateVoiceError on a near-duplicate instead of flagging its metadata
 
     Returns:
     A voice_id representing the filename stored in voices and index id the metadata in datastore.
     """
+    hashes = [int(hash) for hash in fingerprint] if fingerprint is not None else []
+    duplicates = find_duplicates(hashes)
+    if duplicates and reject_duplicates:
+        raise DuplicateVoiceError(
+            f"Voice {id} duplicates the archived voice {duplicates[0][0]}."
+        )
+
     try:
         # Save the static
         path = str(VOICES_DIR / f"{id}.{audio_extension}")
-        with open(path, "wb") as file:
-            file.write(audio_content)
-        metadata_id = __insert_collection(
-            METADATAS,
-            weaver.VoiceMetadata(
-                _id=id,
-                datetime=datetime,
-                audio_extension=audio_extension,
-                username=username,
-                prompt_id=prompt_id,
-            ),
+        with metrics.STAGES.time(stage="file_write"):
+            with tracing.span("disk.write"):
+                with open(path, "wb") as file:
+                    file.write(audio_content)
+        metadata = weaver.VoiceMetadata(
+            _id=id,
+            datetime=datetime,
+            audio_extension=audio_extension,
+            username=username,
+            prompt_id=prompt_id,
         )
+        if hashes:
+            metadata.fingerprint_size = len(hashes)
+        if duplicates:
+            LOGGER.warning("Voice %s flagged as duplicate of %s", id, duplicates[0][0])
+            metadata.duplicate_of = duplicates[0][0]
+        with metrics.STAGES.time(stage="metadata_insert"):
+            metadata_id = __insert_collection(METADATAS, metadata)
+        __insert_fingerprint(id, hashes)
+        __count_in_rollups(metadata, 1)
         return metadata_id
     except Exception as e:
-        LOGGER.warning(f"Aborting transaction: {e}")
+        import transaction
+
+        LOGGER.warning("Aborting transaction: %s", e)
         transaction.abort()
         raise e
 
 
-def delete_voice(id: str):
-    """Delete the voice file and its metadata"""
+def delete_voice(id: str) -> bool:
+    """Delete the voice file, its derived files, metadata and fingerprint.
+    Return False if the voice isn't archived."""
+    metadata = get_metadata(id)
+    if metadata is None:
+        return False
+    for extension in (metadata.audio_extension, *DERIVED_EXTENSIONS):
+        (VOICES_DIR / f"{id}.{extension}").unlink(missing_ok=True)
+    __spectrogram_cache().discard(id)
+    __delete_metadata(id)
+    __count_in_rollups(metadata, -1)
+    __delete_fingerprint(id)
+    __embedding_index().remove(id)
+    return True
 
 
-def get_voice(id: str) -> Optional[any]:
+def get_voice(id: str) -> Optional[Path]:
     """Get the voice file by id index. Return None if not found."""
+    metadata = get_metadata(id)
+    if metadata is None:
+        return None
+    path = VOICES_DIR / f"{id}.{metadata.audio_extension}"
+    return path if path.is_file() else None
+
+
+def get_voices_by_prompt(id: int) -> Sequence[weaver.VoiceMetadata]:
+    """Get the metadata of the voice records answering the prompt, oldest first."""
+    return [
+        weaver.VoiceMetadata.model_validate(doc)
+        for doc in __get_documents(METADATAS, query={"prompt_id": id}).sort("datetime")
+    ]
+
+
+def get_voices_by_user(id: str) -> Sequence[weaver.VoiceMetadata]:
+    """Get the metadata of the voice records of the user (by username), oldest first."""
+    return [
+        weaver.VoiceMetadata.model_validate(doc)
+        for doc in __get_documents(METADATAS, query={"username": id}).sort("datetime")
+    ]
+
+
+def update_metadata(id: str, metadata: weaver.VoiceMetadataUpdate) -> bool:
+    """Update metadata. Indexed by id. Return False if the metadata isn't found."""
+    previous = __update_collection(METADATAS, query=id, doc=metadata)
+    if previous is None:
+        return False
+    # moved from the rollups of its previous prompt, user or day
+    before = weaver.VoiceMetadata.model_validate(previous)
+    after = before.model_copy(update=metadata.model_dump(exclude_unset=True))
+    if __rollup_keys(before) != __rollup_keys(after):
+        __count_in_rollups(before, -1)
+        __count_in_rollups(after, 1)
+    return True
 
 
-def get_voices_by_prompt(id: str) -> Sequence[any]:
-    """Get voice records by the id"""
+def get_metadata(id: str) -> Optional[weaver.VoiceMetadata]:
+    """Get the metadata by id index. Return None if not found."""
+    doc = __get_document(METADATAS, query=id)
+    if doc:
+        doc = weaver.VoiceMetadata.model_validate(doc)
+    return doc
 
 
-def get_voices_by_user(id: str) -> Sequence[any]:
-    """Get voice records by the id"""
+def voice_files() -> Iterator[tuple[str, Path]]:
+    """Iterate over the id and path of every voice record file in the voices directory.
+    Hidden files, e.g. the STARTUP_LOCK, aren't voice records."""
+    for path in sorted(VOICES_DIR.iterdir()):
+        id, _, extension = path.name.rpartition(".")
+        if (
+            path.is_file()
+            and id
+            and not id.startswith(".")
+            and extension not in DERIVED_EXTENSIONS
+        ):
+            yield id, path
 
 
-def update_metadata(metadata: weaver.VoiceMetadata):
-    """Update metadata. Indexed by id."""
+def insert_waveform(id: str, content: bytes) -> str:
+    """Save the packed waveform peaks of the voice record next to its voice file."""
+    with open(VOICES_DIR / f"{id}.{WAVEFORM_EXTENSION}", "wb") as file:
+        file.write(content)
+    return id
 
 
-def get_metadata(id: str) -> Optional[weaver.VoiceMetadata]:
-    """Get the metadata by id index. Return None if not found."""
-    doc = __get_document(MEADATA, query=id)
-    if doc:
-        doc = weaver.VoiceMetadata.model_validate(doc)
-    return doc
+def get_waveform(id: str) -> Optional[bytes]:
+    """Get the packed waveform peaks of the voice record by id. Return None if not found."""
+    path = VOICES_DIR / f"{id}.{WAVEFORM_EXTENSION}"
+    return path.read_bytes() if path.is_file() else None
+
+
+def insert_embedding(id: str, embedding: "np.ndarray") -> str:
+    """Index the timbre embedding of the voice record (see audio.embedding) for similarity search."""
+    __embedding_index().add(id, embedding)
+    return id
+
+
+def get_similar_voices(
+    ids: Sequence[str], k: int = 10
+) -> Sequence[Optional[Sequence[tuple[str, float]]]]:
+    """Get the k voice records sounding the most like each of the voices, in one batched query.
+
+    Returns:
+    Per voice, the (voice id, cosine similarity) of its neighbours. None if the voice has no embedding.
+    """
+    import numpy as np
+
+    index = __embedding_index()
+    embeddings = {id: index.get(id) for id in ids}
+    found = [id for id in ids if embeddings[id] is not None]
+    similar = {}
+    if found:
+        neighbours = index.search(
+            np.stack([embeddings[id] for id in found]), k=k, exclude=found
+        )
+        similar = dict(zip(found, neighbours))
+    return [similar.get(id) for id in ids]
+
+
+def get_spectrogram(
+    id: str, height: int, width: int, render: Callable[[], bytes]
+) -> bytes:
+    """Get the spectrogram PNG of the voice record from the cache, rendering it on the first request."""
+    from api import spectrogram
+
+    return __spectrogram_cache().get(spectrogram.cache_key(id, height, width), render)
 
 
-def __delete_metadata():
+def __delete_metadata(id: str):
     """Delete metadata. Must be done through voice deletion."""
+    __delete_document(METADATAS, id)
+
+
+@tracing.traced("datastore.find_duplicates")
+def find_duplicates(fingerprint: Collection[int]) -> Sequence[tuple[str, float]]:
+    """Find the archived voices sharing at least DUPLICATE_THRESHOLD of their landmark hashes with the
+    fingerprint. Only the postings of the fingerprint's hashes are read, never the whole archive.
+
+    Returns:
+    The (voice id, share of common hashes) of the duplicates, most similar first.
+    """
+    if len(fingerprint) < MIN_FINGERPRINT_SIZE:
+        return []
+    common = Counter()
+    for posting in __get_documents(FINGERPRINTS, {"_id": {"$in": list(fingerprint)}}):
+        common.update(posting["voices"])
+    if not common:
+        return []
+
+    sizes = {
+        doc["_id"]: doc.get("fingerprint_size")
+        for doc in __get_documents(
+            METADATAS, {"_id": {"$in": list(common)}}, {"fingerprint_size": 1}
+        )
+    }
+    duplicates = [
+        (id, count / min(len(fingerprint), sizes[id]))
+        for id, count in common.items()
+        if sizes.get(id)
+    ]
+    return sorted(
+        (duplicate for duplicate in duplicates if duplicate[1] >= DUPLICATE_THRESHOLD),
+        key=lambda duplicate: duplicate[1],
+        reverse=True,
+    )
+
+
+@tracing.traced("datastore.insert_fingerprint")
+def __insert_fingerprint(id: str, hashes: Sequence[int]):
+    """Add the voice to the postings of each of its hashes in the inverted index."""
+    import pymongo
+
+    if not hashes:
+        return
+    __database().get_collection(FINGERPRINTS).bulk_write(
+        [
+            pymongo.UpdateOne({"_id": hash}, {"$addToSet": {"voices": id}}, upsert=True)
+            for hash in hashes
+        ],
+        ordered=False,
+    )
+
+
+def __delete_fingerprint(id: str):
+    """Remove the voice from the inverted index, dropping the postings left empty."""
+    collection = __database().get_collection(FINGERPRINTS)
+    collection.update_many({"voices": id}, {"$pull": {"voices": id}})
+    collection.delete_many({"voices": {"$size": 0}})
+
+
+def __rollup_keys(
+    metadata: weaver.VoiceMetadata,
+) -> list[tuple[weaver.RollupKind, str]]:
+    """The rollups counting the voice, but the one of its user for its prompt."""
+    from api import utils  # imports api.datastore
+
+    archived = metadata.datetime
+    if archived.tzinfo is None:  # stored in UTC
+        archived = archived.replace(tzinfo=ZoneInfo("UTC"))
+    keys = [
+        (weaver.RollupKind.USER, metadata.username),
+        (
+            weaver.RollupKind.DAY,
+            archived.astimezone(ZoneInfo("UTC")).date().isoformat(),
+        ),
+        (
+            weaver.RollupKind.LOCAL_DAY,
+            utils.utc_to_(archived, ROLLUP_TIMEZONE).date().isoformat(),
+        ),
+    ]
+    if metadata.prompt_id is not None:
+        keys.append((weaver.RollupKind.PROMPT, str(metadata.prompt_id)))
+    return keys
+
+
+def __rollup_id(kind: weaver.RollupKind, key: str) -> str:
+    """The id of the rollup document counting the key of the kind."""
+    return f"{kind.value}/{key}"
+
+
+def __count_in_rollups(metadata: weaver.VoiceMetadata, delta: int):
+    """Add `delta` (1 archived, -1 deleted) to the voices of the rollups counting the voice, each by
+    an atomic $inc. A rollup is only decremented down to zero: the voice may never have been counted,
+    e.g. archived before the rollups existed. A failure is logged rather than raised, the voice being
+    stored: rebuild_rollups recounts them."""
+    import pymongo
+
+    collection = __database().get_collection(ROLLUPS)
+    counting = delta > 0
+    # decrements only match the rollups counting enough voices, and create none
+    counted = {} if counting else {"voices": {"$gte": -delta}}
+    try:
+        with __timed("rollup", ROLLUPS):
+            participants = 0
+            if metadata.prompt_id is not None:
+                # a prompt gains a participant with the first voice of a user, loses one with the last
+                key = f"{metadata.prompt_id}/{metadata.username}"
+                answered = collection.find_one_and_update(
+                    {"_id": __rollup_id(weaver.RollupKind.PROMPT_USER, key), **counted},
+                    {
+                        "$inc": {"voices": delta},
+                        "$setOnInsert": {
+                            "kind": weaver.RollupKind.PROMPT_USER.value,
+                            "key": key,
+                            "prompt": metadata.prompt_id,
+                            "user": metadata.username,
+                        },
+                    },
+                    upsert=counting,
+                    return_document=pymongo.ReturnDocument.AFTER,
+                )
+                if answered is None:  # the user's voices for the prompt weren't counted
+                    pass
+                elif counting and answered["voices"] == delta:
+                    participants = 1
+                elif not counting and answered["voices"] <= 0:
+                    participants = -1
+                    collection.delete_one(
+                        {"_id": answered["_id"], "voices": {"$lte": 0}}
+                    )
+            collection.bulk_write(
+                [
+                    pymongo.UpdateOne(
+                        {"_id": __rollup_id(kind, key), **counted},
+                        {
+                            "$inc": {
+                                "voices": delta,
+                                **(
+                                    {"participants": participants}
+                                    if kind == weaver.RollupKind.PROMPT
+                                    else {}
+                                ),
+                            },
+                            "$setOnInsert": {"kind": kind.value, "key": key},
+                        },
+                        upsert=counting,
+                    )
+                    for kind, key in __rollup_keys(metadata)
+                ],
+                ordered=False,
+            )
+    except Exception as e:
+        LOGGER.error("Failed to count the voice %s in the rollups: %s", metadata.id, e)
+
+
+def __index_rollups(collection: "pymongo.collection.Collection"):
+    # the top contributors of a prompt, read in order
+    collection.create_index([("kind", 1), ("prompt", 1), ("voices", -1)])
+
+
+def get_rollup(kind: weaver.RollupKind, key: str) -> weaver.Rollup:
+    """The rollup, of no voices if none were counted. One lookup by _id."""
+    doc = __get_document(ROLLUPS, query=__rollup_id(kind, key))
+    if doc:
+        return weaver.Rollup.model_validate(doc)
+    return weaver.Rollup(
+        _id=__rollup_id(kind, key),
+        kind=kind,
+        key=key,
+        participants=0 if kind == weaver.RollupKind.PROMPT else None,
+    )
+
+
+def get_top_contributors(prompt_id: int, limit: int) -> Sequence[weaver.Rollup]:
+    """The prompt_user rollups of the users who sent the most voices answering the prompt."""
+    collection = __database().get_collection(ROLLUPS)
+    with __timed("get", ROLLUPS):
+        docs = list(
+            collection.find(
+                {"kind": weaver.RollupKind.PROMPT_USER.value, "prompt": prompt_id}
+            )
+            .sort([("voices", -1), ("_id", 1)])
+            .limit(limit)
+        )
+    return [weaver.Rollup.model_validate(doc) for doc in docs]
+
+
+def rebuild_rollups() -> int:
+    """Recount every rollup from the voice metadata, e.g. to backfill the voices archived before the
+    rollups existed. The recounted rollups replace the current ones at once, but the voices archived
+    or deleted during the scan may be missed: run it while the archive is quiet.
+
+    Returns:
+    The number of rollups.
+    """
+    counts = Counter()  # (kind, key) -> voices
+    answers = Counter()  # (prompt, user) -> voices
+    with __timed("scan", METADATAS):
+        for doc in __get_documents(
+            METADATAS, {}, {"username": 1, "prompt_id": 1, "datetime": 1}
+        ):
+            metadata = weaver.VoiceMetadata(
+                _id=doc["_id"],
+                datetime=doc["datetime"],
+                audio_extension="",
+                username=doc["username"],
+                prompt_id=doc.get("prompt_id"),
+            )
+            counts.update(__rollup_keys(metadata))
+            if metadata.prompt_id is not None:
+                answers[(metadata.prompt_id, metadata.username)] += 1
+    participants = Counter(str(prompt) for prompt, _ in answers)
+    docs = [
+        weaver.Rollup(
+            _id=__rollup_id(kind, key),
+            kind=kind,
+            key=key,
+            voices=voices,
+            participants=(
+                participants[key] if kind == weaver.RollupKind.PROMPT else None
+            ),
+        )
+        for (kind, key), voices in counts.items()
+    ] + [
+        weaver.Rollup(
+            _id=__rollup_id(weaver.RollupKind.PROMPT_USER, f"{prompt}/{user}"),
+            kind=weaver.RollupKind.PROMPT_USER,
+            key=f"{prompt}/{user}",
+            voices=voices,
+            prompt=prompt,
+            user=user,
+        )
+        for (prompt, user), voices in answers.items()
+    ]
+
+    database = __database()
+    staging = database.get_collection(f"{ROLLUPS}_rebuild")
+    staging.drop()
+    __index_rollups(staging)
+    if docs:
+        staging.insert_many(
+            [
+                rollup.model_dump(by_alias=True, mode="json", exclude_none=True)
+                for rollup in docs
+            ]
+        )
+        staging.rename(ROLLUPS, dropTarget=True)
+    else:
+        staging.drop()
+        database.drop_collection(ROLLUPS)
+        __index_rollups(database.get_collection(ROLLUPS))
+    LOGGER.info("Rebuilt %d rollups.", len(docs))
+    return len(docs)
 
 
 def insert_user(
@@ -186,54 +742,232 @@ def insert_user(
     last_name: Optional[str] = None,
     username: Optional[str] = None,
 ) -> str:
-    """Insert new user to the table"""
+    """Insert new user to the table.
+    Raise DuplicateKeyError if the user or username is registered, e.g. by another worker: the
+    key is added to the membership filter, which hadn't seen it."""
+    import pymongo
+
     # todo: use mongodb transaction
-    # Add user to the Users collection
-    inserted = __insert_collection(
-        USERS,
-        weaver.User(
-            _id=id,
-            username=username or id,
-            first_name=first_name,
-            last_name=last_name,
-        ),
-    )
-    # Add username to id mapping
-    __insert_collection(
-        USERNAME_TO_ID, weaver.UsernameToId(_id=(username or id), id=id)
-    )
+    try:
+        # Add user to the Users collection
+        try:
+            inserted = __insert_collection(
+                USERS,
+                weaver.User(
+                    _id=id,
+                    username=username or id,
+                    first_name=first_name,
+                    last_name=last_name,
+                ),
+            )
+        except pymongo.errors.DuplicateKeyError:
+            __filter_add(USERS, id)
+            raise
+        __filter_add(USERS, id)
+        # Add username to id mapping
+        try:
+            __insert_collection(
+                USERNAME_TO_ID, weaver.UsernameToId(_id=(username or id), id=id)
+            )
+        except pymongo.errors.DuplicateKeyError:
+            __filter_add(USERNAME_TO_ID, username or id)
+            raise
+        __filter_add(USERNAME_TO_ID, username or id)
+    finally:
+        __invalidate_user(id)  # cached as not registered
     return inserted
 
 
 def get_user_by_id(id: str) -> Optional[weaver.User]:
-    """Get the user by unique id (internal)."""
+    """Get the user by unique id (internal).
+    Read through the user cache shared by the workers of the host, if on."""
+    users = usercache.cache()
+    if users is not None:
+        cached = users.get(id)
+        if cached is not usercache.MISS:
+            return None if cached is None else weaver.User.model_validate_json(cached)
+        generation = users.generation
     doc = __get_document(USERS, query=id)
     if doc:
         doc = weaver.User.model_validate(doc)
+    if users is not None:
+        users.put(
+            id,
+            (
+                doc.model_dump_json(by_alias=True, exclude_unset=True).encode()
+                if doc
+                else None
+            ),
+            generation,
+        )
     return doc
 
 
+def __invalidate_user(id: str):
+    """Drop the user from the user cache, if on."""
+    users = usercache.cache()
+    if users is not None:
+        users.invalidate(id)
+
+
+def user_registered(id: str) -> bool:
+    """Whether the user is registered. A user id the membership filter never saw is answered
+    without a round trip: one registered by another worker since this one's filter was built may be
+    reported absent, for `insert_user` to reject."""
+    return __filtered(USERS, id, lambda: get_user_by_id(id)) is not None
+
+
+def username_available(username: str, id: Optional[str] = None) -> bool:
+    """Whether the username is free, or already the one of the user `id`. A username the membership
+    filter never saw is answered without a round trip, possibly stale the same way as
+    `user_registered`: only claiming it, as `update_user` does, is authoritative."""
+    mapping = __filtered(
+        USERNAME_TO_ID,
+        username,
+        lambda: __get_document(USERNAME_TO_ID, query=username),
+    )
+    return mapping is None or mapping["id"] == id
+
+
 def get_user_by_username(username: str) -> Optional[weaver.User]:
     """Get the user by unqiue username (user-friendly)."""
     # Store a mapping username -> id
-    user_id = __get_document(USERNAME_TO_ID, query=username)
-    return get_user_by_id(user_id)
+    mapping = __filtered(
+        USERNAME_TO_ID,
+        username,
+        lambda: __get_document(USERNAME_TO_ID, query=username),
+    )
+    if not mapping:
+        return None
+    return get_user_by_id(weaver.UsernameToId.model_validate(mapping).id)
+
+
+def update_user(user: weaver.User) -> bool:
+    """Update user. Indexed by id. Return False if the user isn't registered.
+    Raise ValueError if the username is taken by another user."""
+    try:
+        previous = __get_document(USERS, query=user.id)
+        if previous is None:
+            return False
+        renamed = previous["username"] != user.username
+        # claimed before the user is updated, for a taken one to change nothing
+        if renamed:
+            __claim_username(user.id, user.username)
+        __update_collection(
+            USERS,
+            query=user.id,
+            doc=weaver.UserUpdate(
+                **user.model_dump(exclude={"id"}, exclude_unset=True)
+            ),
+        )
+        if renamed:
+            __release_username(user.id, previous["username"])
+    finally:
+        __invalidate_user(user.id)
+    return True
 
 
-def update_user(user: weaver.User):
-    """Update user. Indexed by id."""
+def __claim_username(id: str, username: str):
+    """Map the username to the user. Raise ValueError if it's another user's."""
+    import pymongo
+
+    # a username seen taken is refused without claiming it, a free one is claimed to be sure
+    if not username_available(username, id):
+        raise ValueError(f"The username {username} is taken.")
+    try:
+        __insert_collection(USERNAME_TO_ID, weaver.UsernameToId(_id=username, id=id))
+    except pymongo.errors.DuplicateKeyError:
+        __filter_add(USERNAME_TO_ID, username)  # unseen if claimed by another worker
+        mapping = __get_document(USERNAME_TO_ID, query=username)
+        if mapping is None or mapping["id"] != id:
+            raise ValueError(f"The username {username} is taken.")
+        return  # left over by an interrupted update
+    __filter_add(USERNAME_TO_ID, username)
 
 
-def __update_username(id: str, username: str):
-    """Update username. And the mapping username->id."""
+def __release_username(id: str, username: str):
+    """Unmap the previous username of the user, once renamed."""
+    __delete_document(USERNAME_TO_ID, {"_id": username, "id": id})
 
 
-def delete_user(id: str):
-    """Delete user by id."""
+def delete_user(id: str) -> bool:
+    """Delete user by id. Return False if the user isn't registered."""
+    try:
+        user = get_user_by_id(id)
+        if user is None:
+            return False
+        __delete_document(USERS, id)
+        __delete_username(user.username)
+    finally:
+        __invalidate_user(id)
+    return True
 
 
 def __delete_username(user_name: str):
     """Delete the username in the mapping since user is deleted."""
+    __delete_document(USERNAME_TO_ID, user_name)
+
+
+def build_user_filters():
+    """Build the membership filters of the user ids and usernames from a scan of their `_id`s, e.g.
+    at startup. Until built, every lookup goes to the database.
+
+    The filters of a process only see the registrations it made since: a user registered by another
+    one may be reported absent, which the unique `_id`s reject when registering it again. Keys are
+    never removed, as this process may not have counted them: the users and usernames deleted since
+    are looked up, as false positives, until the filters are built again.
+    """
+    database = __database()
+    building = {}
+    for name in (USERS, USERNAME_TO_ID):
+        registered = database.get_collection(name).estimated_document_count()
+        building[name] = bloom.CountingBloomFilter(
+            max(USER_FILTER_CAPACITY, 2 * registered), USER_FILTER_ERROR_RATE
+        )
+    # written to while scanning, for the keys added meanwhile not to be missed
+    GLOBAL["user_filters_building"] = building
+    try:
+        for name, keys in building.items():
+            with __timed("scan", name):
+                for doc in database.get_collection(name).find({}, {"_id": 1}):
+                    keys.add(doc["_id"])
+        GLOBAL["user_filters"] = building
+    finally:
+        GLOBAL.pop("user_filters_building", None)
+    LOGGER.info("Built the user filters: %s", user_filter_stats())
+
+
+def user_filter_stats() -> Mapping[str, Mapping]:
+    """The size, memory and estimated false positive rate of the user filters, by collection.
+    Refreshes their gauges."""
+    stats = {}
+    for name, keys in GLOBAL.get("user_filters", {}).items():
+        stats[name] = keys.stats()
+        FILTER_KEYS.set(keys.count, filter=name)
+        FILTER_BYTES.set(keys.memory_bytes, filter=name)
+        FILTER_FALSE_POSITIVE_RATE.set(stats[name]["false_positive_rate"], filter=name)
+    return stats
+
+
+def __filtered(name: str, key: str, get: Callable[[], any]) -> any:
+    """None if the filter of the collection rules the key out, else the result of `get`."""
+    filters = GLOBAL.get("user_filters")
+    if filters is None:
+        return get()
+    if not filters[name].might_contain(key):
+        FILTER_LOOKUPS.inc(filter=name, result="negative")
+        return None
+    found = get()
+    FILTER_LOOKUPS.inc(
+        filter=name, result="false_positive" if found is None else "positive"
+    )
+    return found
+
+
+def __filter_add(name: str, key: str):
+    for filters in (GLOBAL.get("user_filters"), GLOBAL.get("user_filters_building")):
+        if filters is not None:
+            filters[name].add(key)
 
 
 def insert_prompt(text: str, begins: datetime.datetime, ends: datetime.datetime):
@@ -252,11 +986,74 @@ def insert_prompt(text: str, begins: datetime.datetime, ends: datetime.datetime)
         query="manager",
         doc=weaver.PromptManagerUpdate(next_index=manager.next_index + 1),
     )
+    __index_prompt(inserted, begins, ends)
     return inserted
 
 
-def update_prompt(prompt: weaver.Prompt):
-    """Update prompt."""
+def update_prompt(prompt: weaver.Prompt) -> bool:
+    """Update prompt. Indexed by id. Return False if the prompt doesn't exist."""
+    previous = __update_collection(
+        PROMPTS,
+        query=prompt.id,
+        doc=weaver.PromptUpdate(
+            **prompt.model_dump(exclude={"id"}, exclude_unset=True)
+        ),
+    )
+    if previous is None:
+        return False
+    __index_prompt(prompt.id, prompt.begins, prompt.ends)
+    return True
+
+
+def load_prompts() -> prompts.PromptIndex:
+    """Load the windows of the prompts not deleted into the prompt index of the process, e.g. at
+    startup, and record the prompt open now as the manager's active prompt."""
+    manager = __get_or_create_prompt_manager()
+    with __timed("scan", PROMPTS):
+        index = prompts.PromptIndex(
+            {
+                doc["_id"]: (doc["begins"], doc["ends"])
+                for doc in __get_documents(PROMPTS, {}, {"begins": 1, "ends": 1})
+                if doc["_id"] not in manager.deleted_prompts
+            }
+        )
+    GLOBAL["prompt_index"] = index
+    __set_active_prompt(index, manager)
+    LOGGER.info("Loaded the windows of %d prompts.", len(index))
+    return index
+
+
+def active_prompt(at: datetime.datetime) -> Optional[int]:
+    """The id of the prompt open at the instant, None if none is. Answered by the prompt index of the
+    process, loaded on the first call if not yet, then reloaded in the background (api.main).
+    """
+    index = GLOBAL.get("prompt_index")
+    if index is None:
+        index = load_prompts()
+    return index.active(at)
+
+
+def __index_prompt(id: int, begins: datetime.datetime, ends: datetime.datetime):
+    """Update the window of the prompt in the prompt index, if loaded."""
+    index = GLOBAL.get("prompt_index")
+    if index is None:
+        return
+    index = index.with_window(id, begins, ends)
+    GLOBAL["prompt_index"] = index
+    __set_active_prompt(index)
+
+
+def __set_active_prompt(
+    index: prompts.PromptIndex, manager: Optional[weaver.PromptManager] = None
+):
+    """Record the prompt open now as the manager's active prompt, unless it already is."""
+    active = index.active(datetime.datetime.now(datetime.timezone.utc))
+    if manager is None or manager.active_prompt != active:
+        __update_collection(
+            PROMPT_MANAGER,
+            query="manager",
+            doc=weaver.PromptManagerUpdate(active_prompt=active),
+        )
 
 
 def __get_or_create_prompt_manager() -> weaver.PromptManager:
@@ -272,14 +1069,34 @@ def __get_or_create_prompt_manager() -> weaver.PromptManager:
 
 def clearall():
     """Drop all collections."""
-    for name in (METADATAS, USERS, USERNAME_TO_ID, PROMPTS, PROMPT_MANAGER):
+    for name in (
+        METADATAS,
+        USERS,
+        USERNAME_TO_ID,
+        PROMPTS,
+        PROMPT_MANAGER,
+        FINGERPRINTS,
+        ROLLUPS,
+    ):
         __database().drop_collection(name)
+    users = usercache.cache()
+    if users is not None:
+        users.clear()
+    if "user_filters" in GLOBAL:
+        build_user_filters()
+    GLOBAL.pop("prompt_index", None)
     LOGGER.warning("Cleared all collections in database.")
 
 
 def clearvoices():
     """Delete all voice files."""
+    GLOBAL.pop("embedding_index", None)
+    GLOBAL.pop("spectrogram_cache", None)
+    if not VOICES_DIR.is_dir():
+        return
     for voice in VOICES_DIR.iterdir():
         if voice.is_file():
             voice.unlink(missing_ok=True)
+        elif voice.name in (EMBEDDINGS_DIR, SPECTROGRAMS_DIR):
+            shutil.rmtree(voice)
     LOGGER.warning("Cleared all voice record files.")
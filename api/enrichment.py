@@ -0,0 +1,87 @@
+"""
+api.enrichment.py
+~~~~~~~~~~~~~~~~~
+Derived data computed once per voice record, either at ingest or in batch over the voices directory.
+Run `python -m api.enrichment` to backfill voices archived before a stage existed.
+`python -m api.enrichment levels` only runs the named stages.
+"""
+import logging
+import sys
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+
+from api import audio, datastore
+from models import weaver
+
+LOGGER = logging.getLogger(__name__)
+
+
+def decode_voice(content: bytes, audio_extension: str) -> Optional[np.ndarray]:
+    """Decode the voice content for the enrichment stages. Return None if it cannot be decoded."""
+    try:
+        return audio.decode(content, audio_extension)
+    except ValueError as e:
+        LOGGER.warning("Skipping enrichment of undecodable audio: %s", e)
+        return None
+
+
+def enrich_voice(id: str, samples: np.ndarray, stages: Optional[Sequence[str]] = None):
+    """Run the enrichment stages (all by default) over the decoded samples of the voice `id`.
+    A failing stage is logged and skipped so it never fails the ingest."""
+    for name in stages or STAGES:
+        try:
+            STAGES[name](id, samples)
+        except Exception as e:
+            LOGGER.warning("Enrichment stage %s failed for %s: %s", name, id, e)
+
+
+def __store_waveform(id: str, samples: np.ndarray):
+    """Precompute the waveform peaks at every zoom level."""
+    datastore.insert_waveform(id, audio.pack_peaks(audio.waveform_peaks(samples)))
+
+
+def __store_embedding(id: str, samples: np.ndarray):
+    """Index the timbre embedding for similar-sound search."""
+    datastore.insert_embedding(id, audio.embedding(samples))
+
+
+def __store_levels(id: str, samples: np.ndarray):
+    """Store the voiced part and loudness gain on the metadata, so renders skip the analysis."""
+    trim_start, trim_end, gain_db = audio.levels(samples)
+    update = weaver.VoiceMetadataUpdate(
+        trim_start=trim_start, trim_end=trim_end, gain_db=gain_db
+    )
+    if not datastore.update_metadata(id, update):
+        raise LookupError(f"No metadata for voice {id}.")
+
+
+# Enrichment stages by name, run in this order
+STAGES = {
+    "waveform": __store_waveform,
+    "embedding": __store_embedding,
+    "levels": __store_levels,
+}
+
+
+def enrich_all(stages: Optional[Sequence[str]] = None) -> int:
+    """Enrich every voice record in the voices directory. Return the number of voices enriched."""
+    unknown = set(stages or ()) - STAGES.keys()
+    if unknown:
+        raise ValueError(
+            f"Unknown enrichment stages {unknown}, expected {list(STAGES)}."
+        )
+    enriched = 0
+    for id, path in datastore.voice_files():
+        samples = decode_voice(path.read_bytes(), path.suffix.lstrip("."))
+        if samples is not None:
+            enrich_voice(id, samples, stages)
+            enriched += 1
+    LOGGER.info("Enriched %d voice records.", enriched)
+    return enriched
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    enrich_all(sys.argv[1:] or None)
@@ -0,0 +1,248 @@
+"""
+api.jobqueue.py
+~~~~~~~~~~~~~~~
+Durable queue of the accepted webhook events, so pending downloads survive restarts.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Optional
+
+from api import datastore, metrics
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUE_PATH = Path(os.environ.get("JOB_QUEUE_PATH", datastore.ROOT / "jobs.sqlite"))
+# Seconds before a job claimed by a worker is considered orphaned and claimed again
+LEASE = float(os.environ.get("JOB_LEASE", 600))
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+RETRY_BACKOFF = 10.0  # seconds before the first retry, doubled on every attempt
+POLL_INTERVAL = 5.0  # seconds between two looks for due jobs
+
+PENDING = "pending"
+RUNNING = "running"
+FAILED = "failed"
+
+JOBS = metrics.gauge("job_queue_jobs", "Jobs in the durable queue.", ("status",))
+
+GLOBAL = {}
+
+
+def worker(pid: Optional[int] = None) -> Optional[str]:
+    """Identity of the process `pid` of this host, this one by default: host name, pid and start time,
+    so that a pid reused by another process isn't mistaken for it. None if the process isn't running.
+    """
+    pid = pid or os.getpid()
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # the start time in clock ticks since boot, after the command in parentheses
+            started = stat.read().rsplit(")", 1)[1].split()[19]
+    except FileNotFoundError:
+        if os.path.isdir("/proc/self"):
+            return None
+        try:  # no procfs: the pid alone
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+        started = ""
+    return f"{socket.gethostname()}:{pid}:{started}"
+
+
+class JobQueue:
+    """Jobs stored in the SQLite database at `path`, shared by the workers of the host.
+
+    A job is enqueued already claimed by the enqueuing worker, so it is processed right away and
+    only picked up again by `claim_due` if it failed (after a backoff) or its worker died before
+    completing it. A job records the worker claiming it: a dead worker of the host has its jobs
+    claimed again right away, others once their `lease` expired, e.g. a hung worker or one of another
+    host sharing the queue. Completed jobs are deleted, jobs failing `max_attempts` times are kept
+    as failed.
+
+    The database runs in WAL mode with synchronous=NORMAL: a commit survives the process being killed,
+    and each enqueue costs an append to the WAL rather than a sync of the whole database.
+    """
+
+    def __init__(
+        self, path: Path, lease: float = LEASE, max_attempts: int = MAX_ATTEMPTS
+    ):
+        self.path = Path(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker = worker()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender_id TEXT NOT NULL,
+                    mid TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 1,
+                    created_at REAL NOT NULL,
+                    available_at REAL NOT NULL,
+                    claimed_at REAL,
+                    error TEXT,
+                    worker TEXT
+                )"""
+            )
+            columns = self._connection.execute("PRAGMA table_info(jobs)").fetchall()
+            # queue of a version before
+            if "worker" not in {column[1] for column in columns}:
+                self._connection.execute("ALTER TABLE jobs ADD COLUMN worker TEXT")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, available_at)"
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def enqueue(self, jobs: Sequence[tuple[str, str, str]]) -> Sequence[int]:
+        """Persist the jobs, claimed by the caller, in one transaction.
+        Args:
+        jobs -- the (sender id, message id, payload) of every job
+
+        Returns:
+        The ids of the jobs, in order.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [
+                    self._connection.execute(
+                        "INSERT INTO jobs (sender_id, mid, payload, status, created_at, available_at, claimed_at,"
+                        " worker) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (sender_id, mid, payload, RUNNING, now, now, now, self.worker),
+                    ).lastrowid
+                    for sender_id, mid, payload in jobs
+                ]
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return ids
+
+    def claim_due(self, limit: int = 100) -> Sequence[tuple[int, str]]:
+        """Claim the failed jobs due for a retry and the jobs orphaned by a dead worker.
+
+        Returns:
+        The (id, payload) of the claimed jobs, oldest first.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._reclaim(now)
+                due = self._connection.execute(
+                    "SELECT id, payload FROM jobs"
+                    " WHERE (status = ? AND available_at <= ?) OR (status = ? AND claimed_at <= ?)"
+                    " ORDER BY id LIMIT ?",
+                    (PENDING, now, RUNNING, now - self.lease, limit),
+                ).fetchall()
+                self._connection.executemany(
+                    "UPDATE jobs SET status = ?, claimed_at = ?, worker = ?, attempts = attempts + 1"
+                    " WHERE id = ?",
+                    [(RUNNING, now, self.worker, id) for id, _ in due],
+                )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        if due:
+            LOGGER.info("Claimed %d due jobs.", len(due))
+        return due
+
+    @staticmethod
+    def _dead(owner: str) -> bool:
+        """Whether the worker, of this host, is known to be dead. The ones of other hosts never are."""
+        host, pid, _ = owner.rsplit(":", 2)
+        return host == socket.gethostname() and worker(int(pid)) != owner
+
+    def _reclaim(self, now: float):
+        """Make the running jobs of the dead workers of the host due, within a transaction."""
+        owners = self._connection.execute(
+            "SELECT DISTINCT worker FROM jobs WHERE status = ? AND worker != ?",
+            (RUNNING, self.worker),
+        ).fetchall()
+        dead = [owner for (owner,) in owners if self._dead(owner)]
+        for owner in dead:
+            reclaimed = self._connection.execute(
+                "UPDATE jobs SET status = ?, available_at = ?, claimed_at = NULL"
+                " WHERE status = ? AND worker = ?",
+                (PENDING, now, RUNNING, owner),
+            ).rowcount
+            LOGGER.warning("Reclaimed %d jobs of the dead worker %s.", reclaimed, owner)
+
+    def complete(self, id: int):
+        """Delete the processed job."""
+        with self._lock:
+            self._connection.execute("DELETE FROM jobs WHERE id = ?", (id,))
+
+    def fail(self, id: int, error: str, retry: bool = True) -> bool:
+        """Record the failure of the job, scheduling a retry with exponential backoff unless
+        it ran out of attempts or `retry` is False. Return whether the job will be retried.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT attempts FROM jobs WHERE id = ?", (id,)
+            ).fetchone()
+            if row is None:
+                return False
+            (attempts,) = row
+            retry = retry and attempts < self.max_attempts
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, available_at = ?, claimed_at = NULL, error = ? WHERE id = ?",
+                (
+                    PENDING if retry else FAILED,
+                    time.time() + RETRY_BACKOFF * 2 ** (attempts - 1),
+                    error,
+                    id,
+                ),
+            )
+        return retry
+
+    def defer(self, id: int):
+        """Give the claimed job back to the queue as due right away, its attempt not counted, e.g.
+        while the datastore isn't connected yet."""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, available_at = ?, claimed_at = NULL,"
+                " attempts = MAX(attempts - 1, 0) WHERE id = ?",
+                (PENDING, time.time(), id),
+            )
+
+    def counts(self) -> Mapping[str, int]:
+        """Number of jobs per status."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return {PENDING: 0, RUNNING: 0, FAILED: 0, **dict(rows)}
+
+
+def queue() -> JobQueue:
+    """Get the job queue at QUEUE_PATH"""
+    jobs = GLOBAL.get("job_queue")
+    if jobs is None or jobs.path != QUEUE_PATH:
+        jobs = GLOBAL["job_queue"] = JobQueue(QUEUE_PATH)
+    return jobs
+
+
+def update_metrics():
+    """Refresh the queue gauges."""
+    for status, count in queue().counts().items():
+        JOBS.set(count, status=status)
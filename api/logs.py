@@ -0,0 +1,105 @@
+"""
+api.logs.py
+~~~~~~~~~~~
+Cheap logging of the ingest path: payloads rendered only when a record is emitted, truncated or sampled,
+and a structured (JSON lines) format.
+"""
+import json
+import logging
+import os
+import random
+import sys
+from typing import Any, Optional
+
+from pydantic import BaseModel
+
+from api import tracing
+
+# "text" leaves the logging configuration alone, "json" emits a JSON object per record to stderr
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Level of the root logger if set, e.g. WARNING to skip the INFO records of every request
+LOG_LEVEL = os.environ.get("LOG_LEVEL")
+# Longer payloads are cut
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", 2000))
+# Share of the payloads rendered in the emitted records, the others are elided
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", 1.0))
+
+
+class Payload:
+    """A log argument rendered as compact JSON when the record is formatted, so never if the record
+    isn't emitted: `LOGGER.info("Data event: %s", Payload(event))`.
+    """
+
+    __slots__ = ("value", "_text")
+
+    def __init__(self, value: Any):
+        self.value = value
+        self._text = None
+
+    def __str__(self) -> str:
+        if self._text is None:  # once for all the handlers
+            self._text = self._render()
+        return self._text
+
+    def _render(self) -> str:
+        if random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+            return "<payload not sampled>"
+        if isinstance(self.value, BaseModel):
+            text = self.value.model_dump_json(exclude_none=True)
+        elif isinstance(self.value, bytes):
+            text = self.value.decode(errors="replace")
+        elif isinstance(self.value, str):
+            text = self.value
+        else:
+            text = json.dumps(self.value, default=str)
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            text = f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({len(text)} chars)"
+        return text
+
+
+def payload(value: Any) -> Payload:
+    """Defer rendering the value until the record is emitted."""
+    return Payload(value)
+
+
+class StructuredFormatter(logging.Formatter):
+    """A JSON object per record: time, level, logger, message, the trace id within a trace, and
+    the exception if any."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        span = tracing.current()
+        if span is not None:
+            entry["trace_id"] = span.trace_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure(
+    format: Optional[str] = None,
+    level: Optional[str] = None,
+    stream=None,
+) -> Optional[logging.Handler]:
+    """Apply LOG_FORMAT & LOG_LEVEL (or the arguments) to the root logger. Idempotent.
+    Returns:
+    The structured handler of the root logger, None in the text format.
+    """
+    root = logging.getLogger()
+    level = level or LOG_LEVEL
+    if level:
+        root.setLevel(level)
+    if (format or LOG_FORMAT) != "json":
+        return None
+    for handler in root.handlers:
+        if isinstance(handler.formatter, StructuredFormatter):
+            return handler
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(StructuredFormatter())
+    root.addHandler(handler)
+    return handler
@@ -1,39 +1,174 @@
 """
 api.main.py
 """
+import asyncio
+import collections
+import datetime
+import hashlib
+import hmac
+import importlib
 import logging
 import os
-import pickle
 from contextlib import asynccontextmanager
 from pathlib import Path
-from pprint import pformat as pf
+from typing import Optional
 
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
+from pydantic import BaseModel, ValidationError
 
-from api import datastore, utils
-from models import facebook
+from api import (
+    admission,
+    capture,
+    datastore,
+    jobqueue,
+    logs,
+    metrics,
+    profiling,
+    sharding,
+    static,
+    tracing,
+)
+from models import facebook, weaver
 
 LOGGER = logging.getLogger(__name__)
 
 # A user secret to verify webhook get request
 FB_VERIFY_TOKEN = os.environ.get("FB_VERIFY_TOKEN", "default")
+# "development" wipes the database & voices on every boot, "production" keeps them
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "development")
 PRIVACY_POLICY_PATH = Path(__file__).joinpath("..").resolve() / "pp.html"
+# Seconds Facebook is asked to wait before redelivering an event rejected under overload
+OVERLOAD_RETRY_AFTER = 5
+# Voice records never change once archived, so their derived data can be cached for good
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Seconds between the attempts to connect the datastore in the background
+STARTUP_RETRY_INTERVAL = 5
+# Imported in the background once serving, rather than at boot: the processing of jobs
+# (requests, numpy) and the datastore client
+DEFERRED_IMPORTS = ("api.utils", "api.spectrogram", "api.enrichment", "pymongo")
+
+# Replies to the sender of a message that failed, never the error itself
+ERROR_REPLY = "ERROR! Your message couldn't be archived, please try again later."
+NOT_AUDIO_REPLY = "ERROR! Only voice messages are archived."
+DUPLICATE_REPLY = "This voice is already archived."
+
+# State of the background startup, reported by GET /ready
+READINESS = {"datastore": False, "warm": False, "error": None}
+
+static.ASSETS.add("privacy-policy", PRIVACY_POLICY_PATH, "text/html")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Startup and shutdown logic for the API."""
-    # startup Database client
-    datastore.startup()
-    datastore.clearall()
-    datastore.clearvoices()
+    """Startup and shutdown logic for the API.
+    Requests are served right away, while the datastore connects in the background. Only the
+    development mode waits for it, to wipe the data before any job runs.
+    """
+    logs.configure()
+    READINESS.update(datastore=False, warm=False, error=None)
+    if STARTUP_MODE == "development":
+        await asyncio.to_thread(__start_datastore)
+    starting = asyncio.create_task(__start())
     yield
+    starting.cancel()
     # shutdown Database client
     datastore.shutdown()
 
 
+def __start_datastore():
+    """Connect the Database client and initialize the datastore."""
+    if not READINESS["datastore"]:
+        datastore.startup()
+        if STARTUP_MODE == "development":
+            datastore.clearall()
+            datastore.clearvoices()
+        # Only one of the workers booting together initializes, the others serve right away
+        datastore.initialize()
+        datastore.build_user_filters()
+        datastore.load_prompts()
+        READINESS.update(datastore=True, error=None)
+
+
+def __warm_up():
+    """Import the DEFERRED_IMPORTS, build the models and load the static assets, before the first
+    requests need them."""
+    try:
+        static.ASSETS.load()
+        for name in DEFERRED_IMPORTS:
+            importlib.import_module(name)
+        for module in (facebook, weaver):
+            for model in vars(module).values():
+                if (
+                    isinstance(model, type)
+                    and issubclass(model, BaseModel)
+                    and model is not BaseModel
+                ):
+                    model.model_rebuild()
+    except Exception as e:
+        LOGGER.error("Failed to warm up: %s", e)
+        return
+    READINESS.update(warm=True)
+
+
+async def __start():
+    """Warm up, while connecting the datastore then retrying the due jobs."""
+    await asyncio.gather(asyncio.to_thread(__warm_up), __connect())
+
+
+async def __connect():
+    """Connect the datastore, retrying every STARTUP_RETRY_INTERVAL until Mongo answers, then
+    retry the due jobs and refresh the prompts."""
+    while True:
+        try:
+            await asyncio.to_thread(__start_datastore)
+            break
+        except Exception as e:
+            READINESS.update(error=f"{e}")
+            LOGGER.error("Failed to start the datastore, retrying: %s", e)
+            await asyncio.sleep(STARTUP_RETRY_INTERVAL)
+    # Unfinished jobs of the previous run are replayed right away, failed ones once backed off
+    await asyncio.gather(__retry_jobs(), __refresh_prompts())
+
+
+async def __refresh_prompts():
+    """Reload the prompt index every PROMPT_REFRESH_INTERVAL, off the ingest of the messages."""
+    while True:
+        await asyncio.sleep(datastore.PROMPT_REFRESH_INTERVAL)
+        try:
+            await asyncio.to_thread(datastore.load_prompts)
+        except Exception as e:
+            LOGGER.error("Failed to reload the prompts: %s", e)
+
+
+async def __retry_jobs():
+    """Resubmit the due jobs of the durable queue, every POLL_INTERVAL."""
+    while True:
+        try:
+            for job_id, payload in await asyncio.to_thread(jobqueue.queue().claim_due):
+                messaging = facebook.WebhookMessaging.model_validate_json(payload)
+                trace = tracing.trace(
+                    "webhook.retry",
+                    job_id=job_id,
+                    mid=messaging.message.mid,
+                    sender=messaging.sender.id,
+                )
+                sharding.SHARDS.submit(
+                    messaging.sender.id,
+                    tracing.context(trace).run,
+                    __process_job,
+                    job_id,
+                    messaging,
+                )
+                trace.end()
+            await asyncio.to_thread(jobqueue.update_metrics)
+            await asyncio.to_thread(datastore.user_filter_stats)
+        except Exception as e:
+            LOGGER.error("Failed to retry jobs: %s", e)
+        await asyncio.sleep(jobqueue.POLL_INTERVAL)
+
+
 APP = FastAPI(
     title="Weaving Sounds Digital Archive Bot",
     description="A Chatbot that archive daily sounds",
@@ -61,49 +196,429 @@ async def messenger_webhook(request: Request):
             resp = int(request.query_params.get("hub.challenge", "errored"))
         except ValueError:
             resp = request.query_params.get("hub.challenge", "errored")
-        LOGGER.warning(f"Return challenge: {resp}")
+        LOGGER.warning("Return challenge: %s", resp)
         return JSONResponse(content=resp, headers={"Content-Type": "text/html"})
     LOGGER.error(
-        f"""Invalid Request or Verification Token: given {verify_token}, expected {FB_VERIFY_TOKEN}.
-        Have you set up the token based on README/Set up Messenger chatbot?"""
+        """Invalid Request or Verification Token: given %s, expected %s.
+        Have you set up the token based on README/Set up Messenger chatbot?""",
+        verify_token,
+        FB_VERIFY_TOKEN,
     )
     return "Invalid Request or Verification Token"
 
 
 @APP.post("/webhook")
-async def messenger_post(data: facebook.Event) -> str:
-    """
-    Handler for webhook Facebook Event (currently for postback and messages)
-    """
-    LOGGER.info(f"Data event:\n {pf(data.model_dump())}")
-    for entry in data.entry:
-        messages = entry.messaging
-        answer = ""
-        id = None
-        if messages[0]:
-            message = messages[0]
-            LOGGER.info(f"userID: {message.sender.id}")
-            LOGGER.info(f"Message object: \n{pf(message.message.model_dump())}")
-            try:
-                # Retrieve the public Facebook profile of the sender to store in system
-                id = utils.handle_fb_user(message.sender.id)
-                answer = utils.handle_user_message(id, message.message)
-            except Exception as e:  # todo: handling exceptions better
-                answer = f"ERROR! {e}"
-                LOGGER.error(f"ERROR:\n {e}")
-
-        # Send a reply to the sender
-        utils.reply_to(message.sender.id, answer)
-        return "Success!"
+@profiling.profiled_request
+async def messenger_post(request: Request) -> str:
+    """
+    Handler for webhook Facebook Event (currently for postback and messages).
+    Events are acknowledged once persisted to the job queue, then processed in the background.
+    Events beyond the admission capacity are rejected with 503 for Facebook to redeliver later.
+    """
+    body = await request.body()
+    # Validated here rather than by FastAPI, in one pass from the bytes into the ingest models
+    with metrics.STAGES.time(stage="validate"):
+        try:
+            data = facebook.WebhookEvent.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError(
+                [{**error, "loc": ("body", *error["loc"])} for error in e.errors()]
+            )
+    LOGGER.info("Data event: %s", logs.payload(body))
+    if capture.CAPTURE_PATH:  # the journal is written off the event loop
+        await asyncio.to_thread(capture.record, body)
+    messagings = [
+        messaging for entry in data.entry or [] for messaging in entry.messaging
+    ]
+    # One trace per messaging, followed until the reply to it
+    traces = [
+        tracing.trace(
+            "webhook.messaging", mid=messaging.message.mid, sender=messaging.sender.id
+        )
+        for messaging in messagings
+    ]
+
+    admitted = []
+    queued = collections.Counter()  # shard -> items of this event queued on it
+    for messaging in messagings:
+        kind = admission.kind(messaging)
+        shard = sharding.SHARDS.shard(messaging.sender.id)
+        shard_full = (
+            sharding.SHARDS.depth(shard) + queued[shard] >= sharding.SHARDS.max_depth
+        )
+        if shard_full or not admission.ADMISSION.try_acquire(kind):
+            for admitted_kind in admitted:
+                admission.ADMISSION.release(admitted_kind)
+            LOGGER.warning(
+                "Overloaded%s, rejecting %d events.",
+                f" shard {shard}" if shard_full else "",
+                len(messagings),
+            )
+            for trace in traces:
+                trace.end(error="Overloaded")
+            return JSONResponse(
+                content={"status_code": 10503, "message": "Overloaded", "data": None},
+                status_code=503,
+                headers={"Retry-After": str(OVERLOAD_RETRY_AFTER)},
+            )
+        admitted.append(kind)
+        queued[shard] += 1
+
+    # Persisted before acknowledging, so a restart never loses an accepted event
+    try:
+        with metrics.STAGES.time(stage="enqueue"):
+            job_ids = await asyncio.to_thread(
+                jobqueue.queue().enqueue,
+                [
+                    (
+                        messaging.sender.id,
+                        messaging.message.mid,
+                        messaging.model_dump_json(exclude_none=True),
+                    )
+                    for messaging in messagings
+                ],
+            )
+    except Exception as e:
+        # not accepted: the slots are given back and Facebook redelivers later
+        for admitted_kind in admitted:
+            admission.ADMISSION.release(admitted_kind)
+        LOGGER.error("Failed to queue %d events: %s", len(messagings), e)
+        for trace in traces:
+            trace.end(error=f"{e}")
+        return JSONResponse(
+            content={"status_code": 10503, "message": "Unavailable", "data": None},
+            status_code=503,
+            headers={"Retry-After": str(OVERLOAD_RETRY_AFTER)},
+        )
+    # Processed in order per sender, in parallel across senders, after acknowledging
+    for job_id, messaging, kind, trace in zip(job_ids, messagings, admitted, traces):
+        trace.set(job_id=job_id)
+        future = sharding.SHARDS.submit(
+            messaging.sender.id,
+            tracing.context(trace).run,
+            __process_job,
+            job_id,
+            messaging,
+        )
+        future.add_done_callback(lambda _, kind=kind: admission.ADMISSION.release(kind))
+        trace.end()
+    return "Success!"
+
+
+@tracing.traced("job.process")
+@profiling.profiled_job
+def __process_job(job_id: int, message: facebook.WebhookMessaging):
+    """Register the sender, archive the message's audio and reply with the outcome.
+    Network failures (Graph API, attachment download) are retried by the job queue.
+    """
+    import pymongo
+    import requests
+
+    from api import utils
+
+    jobs = jobqueue.queue()
+    if not READINESS["datastore"]:
+        # queued until the datastore is connected, then picked up by __retry_jobs
+        LOGGER.info("Job %s deferred until the datastore is connected.", job_id)
+        jobs.defer(job_id)
+        return
+    LOGGER.info(
+        "Job %s of user %s: %s",
+        job_id,
+        message.sender.id,
+        logs.payload(message.message),
+    )
+    try:
+        # Retrieve the public Facebook profile of the sender to store in system
+        id = utils.handle_fb_user(message.sender.id)
+        answer = utils.handle_user_message(id, message.message, message.timestamp)
+        jobs.complete(job_id)
+    except (
+        requests.exceptions.RequestException,
+        pymongo.errors.ConnectionFailure,
+    ) as e:
+        if jobs.fail(job_id, f"{e}"):
+            LOGGER.warning("Job %s failed, to be retried: %s", job_id, e)
+            return
+        answer = ERROR_REPLY
+        LOGGER.error("Job %s failed: %s", job_id, e)
+    except datastore.DuplicateVoiceError as e:  # rejected under DUPLICATE_POLICY
+        jobs.complete(job_id)
+        answer = DUPLICATE_REPLY
+        LOGGER.info("Job %s rejected as a duplicate: %s", job_id, e)
+    except AttributeError as e:  # not a voice message
+        jobs.fail(job_id, f"{e}", retry=False)
+        answer = NOT_AUDIO_REPLY
+        LOGGER.error("Job %s failed: %s", job_id, e)
+    except Exception as e:
+        jobs.fail(job_id, f"{e}", retry=False)
+        answer = ERROR_REPLY
+        LOGGER.exception("Job %s failed: %s", job_id, e)
+
+    # Send a reply to the sender
+    utils.reply_to(message.sender.id, answer)
+
+
+@APP.get("/ready")
+def get_readiness():
+    """
+    Readiness of the API: 200 once the datastore is connected, 503 while it connects in the background.
+    """
+    return JSONResponse(
+        content={"ready": READINESS["datastore"], **READINESS},
+        status_code=200 if READINESS["datastore"] else 503,
+    )
+
+
+@APP.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Metrics of the API in Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def __admin(authorization: Optional[str] = Header(default=None)):
+    """Only let the bearer of ADMIN_TOKEN in. The admin endpoints don't exist if it is unset."""
+    if not profiling.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    expected = f"Bearer {profiling.ADMIN_TOKEN}"
+    if not hmac.compare_digest((authorization or "").encode(), expected.encode()):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid admin token.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+@APP.post("/admin/profile/cpu", dependencies=[Depends(__admin)])
+def start_cpu_profile(
+    count: int = Query(default=100, ge=1, alias="requests"),
+    sample_rate: float = Query(default=1.0, gt=0, le=1),
+):
+    """
+    CPU profile a sample of the next webhook requests and of their processing.
+    """
+    profiling.CPU.start(count, sample_rate)
+    return {"remaining": profiling.CPU.remaining, "sample_rate": sample_rate}
+
+
+@APP.get("/admin/profile/cpu", dependencies=[Depends(__admin)])
+def get_cpu_profile(
+    format: str = Query(default="prof", pattern="^(prof|text)$"), limit: int = 50
+):
+    """
+    The CPU profile collected so far, as a .prof file (snakeviz, pstats) or as text.
+    """
+    if format == "text":
+        content = profiling.CPU.report(limit)
+    else:
+        content = profiling.CPU.dump()
+    if content is None:
+        raise HTTPException(status_code=404, detail="No request profiled yet.")
+    if format == "text":
+        return PlainTextResponse(content)
+    return Response(
+        content,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="cpu.prof"'},
+    )
+
+
+@APP.delete("/admin/profile/cpu", dependencies=[Depends(__admin)])
+def stop_cpu_profile():
+    """
+    Stop picking requests to profile. The profile collected stays available.
+    """
+    profiling.CPU.stop()
+    return {"remaining": 0}
+
+
+@APP.post("/admin/profile/memory", dependencies=[Depends(__admin)])
+def start_memory_profile(frames: int = Query(default=10, ge=1, le=100)):
+    """
+    Trace the memory allocations from now on, the baseline of the memory reports.
+    """
+    profiling.MEMORY.start(frames)
+    return {"tracing": True, "frames": frames}
+
+
+@APP.get("/admin/profile/memory", dependencies=[Depends(__admin)])
+def get_memory_profile(
+    format: str = Query(default="text", pattern="^(text|snapshot)$"),
+    limit: int = 30,
+):
+    """
+    The allocations grown the most since the baseline as text, or a tracemalloc snapshot file.
+    """
+    try:
+        if format == "text":
+            return PlainTextResponse(profiling.MEMORY.report(limit))
+        content = profiling.MEMORY.snapshot()
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=f"{e}")
+    return Response(
+        content,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="memory.snapshot"'},
+    )
+
+
+@APP.delete("/admin/profile/memory", dependencies=[Depends(__admin)])
+def stop_memory_profile():
+    """
+    Stop tracing the memory allocations.
+    """
+    profiling.MEMORY.stop()
+    return {"tracing": False}
+
+
+@APP.post("/admin/rollups/rebuild", dependencies=[Depends(__admin)])
+def rebuild_rollups():
+    """
+    Recount the voices per prompt, user and day from the voice metadata, e.g. to backfill them.
+    """
+    return {"rollups": datastore.rebuild_rollups()}
+
+
+@APP.get("/stats/prompts/{id}")
+def get_prompt_stats(id: int):
+    """
+    The voices answering a prompt and the users who sent them.
+    """
+    rollup = datastore.get_rollup(weaver.RollupKind.PROMPT, str(id))
+    return {"prompt": id, "voices": rollup.voices, "participants": rollup.participants}
+
+
+@APP.get("/stats/prompts/{id}/contributors")
+def get_prompt_contributors(id: int, limit: int = Query(default=10, ge=1, le=100)):
+    """
+    The users who sent the most voices answering a prompt.
+    """
+    return {
+        "prompt": id,
+        "contributors": [
+            {"user": rollup.user, "voices": rollup.voices}
+            for rollup in datastore.get_top_contributors(id, limit)
+        ],
+    }
+
+
+@APP.get("/stats/users/{id:path}")
+def get_user_stats(id: str):
+    """
+    The voices archived of a user.
+    """
+    return {
+        "user": id,
+        "voices": datastore.get_rollup(weaver.RollupKind.USER, id).voices,
+    }
+
+
+@APP.get("/stats/days/{day}")
+def get_day_stats(day: datetime.date, local: bool = False):
+    """
+    The voices archived on a day, in UTC or in the archive's local timezone.
+    """
+    kind = weaver.RollupKind.LOCAL_DAY if local else weaver.RollupKind.DAY
+    return {
+        "day": day.isoformat(),
+        "timezone": datastore.ROLLUP_TIMEZONE if local else "UTC",
+        "voices": datastore.get_rollup(kind, day.isoformat()).voices,
+    }
 
 
 @APP.get("/privacy-policy", response_class=HTMLResponse)
-def get_privacy_policy():
+def get_privacy_policy(request: Request):
     """
     Privacy policy page. Needed according to Meta's app policy at https://www.termsfeed.com/blog/privacy-policy-url/
     """
-    with open(PRIVACY_POLICY_PATH) as rfile:
-        return rfile.read()
+    return static.ASSETS.response("privacy-policy", request)
+
+
+@APP.get("/voices/{id}/waveform")
+def get_voice_waveform(id: str, request: Request, samples_per_peak: int = None):
+    """
+    Precomputed waveform peaks (min, max, rms scaled to +-scale) of a voice record at one zoom level,
+    the coarsest by default.
+    """
+    from api import audio
+
+    if samples_per_peak is None:
+        samples_per_peak = audio.WAVEFORM_LEVELS[-1]
+    content = datastore.get_waveform(id)
+    if content is None:
+        raise HTTPException(status_code=404, detail=f"No waveform for voice {id}.")
+
+    etag = f'"{hashlib.md5(content).hexdigest()}-{samples_per_peak}"'
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    peaks = audio.unpack_peaks(content)
+    if samples_per_peak not in peaks:
+        raise HTTPException(
+            status_code=400,
+            detail=f"samples_per_peak must be one of {sorted(peaks)}.",
+        )
+    values = peaks[samples_per_peak]
+    return JSONResponse(
+        content={
+            "id": id,
+            "sample_rate": audio.SAMPLE_RATE,
+            "samples_per_peak": samples_per_peak,
+            "scale": audio.PEAK_SCALE,
+            "min": values[:, 0].tolist(),
+            "max": values[:, 1].tolist(),
+            "rms": values[:, 2].tolist(),
+        },
+        headers=headers,
+    )
+
+
+@APP.get("/voices/{id}/similar")
+def get_similar_voices(id: str, k: int = Query(default=10, ge=1, le=100)):
+    """
+    The k voice records sounding the most like a voice, by cosine similarity of their timbre.
+    """
+    (similar,) = datastore.get_similar_voices([id], k=k)
+    if similar is None:
+        raise HTTPException(status_code=404, detail=f"No embedding for voice {id}.")
+    return {
+        "id": id,
+        "similar": [{"id": voice, "similarity": score} for voice, score in similar],
+    }
+
+
+@APP.get("/voices/{id}/spectrogram")
+def get_voice_spectrogram(
+    id: str,
+    height: int = Query(default=128, ge=16, le=256),
+    width: int = Query(default=512, ge=16, le=2048),
+):
+    """
+    Spectrogram thumbnail (grayscale PNG) of a voice record, rendered on the first request.
+    """
+    from api import enrichment, spectrogram
+
+    # before the cache, which may still hold the spectrograms of a voice being deleted
+    path = datastore.get_voice(id)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Voice {id} not found.")
+
+    def render() -> bytes:
+        samples = enrichment.decode_voice(path.read_bytes(), path.suffix.lstrip("."))
+        if samples is None:
+            raise HTTPException(status_code=415, detail=f"Voice {id} can't be decoded.")
+        return spectrogram.render(samples, height=height, width=width)
+
+    return Response(
+        content=datastore.get_spectrogram(id, height, width, render),
+        media_type="image/png",
+        headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL},
+    )
 
 
 @APP.exception_handler(RequestValidationError)
@@ -111,7 +626,9 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     """Handles pydantic model validation error"""
     exc_str = f"{exc}".replace("\n", " ").replace("   ", " ")
     LOGGER.error(
-        f"Validation Exception with input: {pf(exc.errors()[0]['input'])}\n\n{pf(exc.errors()[0])}\n"
+        "Validation Exception with input: %s\n\n%s",
+        logs.payload(exc.errors()[0]["input"]),
+        logs.payload(exc.errors()[0]),
     )
     content = {"status_code": 10422, "message": exc_str, "data": None}
     return JSONResponse(content=content, status_code=422)
@@ -120,7 +637,8 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 @APP.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
     """Handles general error"""
-    LOGGER.error(f"{request.json()} :: {exc}")
+    # the body was consumed by the endpoint, so only the request line is logged
+    LOGGER.error("%s %s :: %s", request.method, request.url.path, exc, exc_info=exc)
 
     exc_str = f"{exc}".replace("\n", " ").replace("   ", " ")
     return JSONResponse(
@@ -0,0 +1,215 @@
+"""
+api.metrics.py
+~~~~~~~~~~~~~~
+In-process metrics of the API, exposed in Prometheus text format on GET /metrics.
+"""
+import bisect
+import contextlib
+import threading
+import time
+from collections.abc import Iterator, Sequence
+
+REGISTRY = {}  # metric name -> metric, in registration order
+# Upper bounds in seconds, from sub-millisecond datastore calls to slow downloads
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+class Metric:
+    """A family of samples sharing a name, one sample per combination of label values."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def value(self, **labels) -> float:
+        """Current value of the sample with the labels."""
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Sequence[tuple[str, tuple, float]]:
+        """The (name suffix, label pairs, value) of every sample."""
+        with self._lock:
+            return [
+                ("", tuple(zip(self.labelnames, key)), value)
+                for key, value in self._values.items()
+            ]
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Observations counted into buckets by upper bound, with their count and sum.
+    Observing costs a bisection and an increment, so it can time every call of a hot path.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per bucket (the last is +Inf), then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the seconds the block takes, even if it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def value(self, **labels) -> int:
+        """Number of observations with the labels."""
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def sum(self, **labels) -> float:
+        """Sum of the observations with the labels."""
+        counts = self._values.get(self._key(labels))
+        return counts[-1] if counts else 0.0
+
+    def samples(self) -> Sequence[tuple[str, tuple, float]]:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        samples = []
+        for key, counts in values:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                samples.append(("_bucket", (*labels, ("le", le)), cumulative))
+            samples.append(("_sum", labels, counts[-1]))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+def __register(
+    cls: type, name: str, help: str, labelnames: Sequence[str], **kwargs
+) -> Metric:
+    """Get the registered metric by name, registering it on first use."""
+    metric = REGISTRY.get(name)
+    if metric is None:
+        metric = REGISTRY.setdefault(name, cls(name, help, labelnames, **kwargs))
+    return metric
+
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    """Get or register a counter."""
+    return __register(Counter, name, help, labelnames)
+
+
+def gauge(name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+    """Get or register a gauge."""
+    return __register(Gauge, name, help, labelnames)
+
+
+def histogram(
+    name: str,
+    help: str,
+    labelnames: Sequence[str] = (),
+    buckets: Sequence[float] = DEFAULT_BUCKETS,
+) -> Histogram:
+    """Get or register a histogram."""
+    return __register(Histogram, name, help, labelnames, buckets=buckets)
+
+
+# Seconds taken by each stage of the webhook ingest path (see api.main & api.utils)
+STAGES = histogram(
+    "ingest_stage_seconds",
+    "Seconds taken by each stage of the webhook ingest path.",
+    ("stage",),
+)
+
+
+def render() -> str:
+    """Render every registered metric in Prometheus text exposition format."""
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for suffix, labels, value in metric.samples():
+            label_text = ",".join(
+                f'{name}="{__escape(label)}"' for name, label in labels
+            )
+            label_text = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{metric.name}{suffix}{label_text} {__format(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def __escape(label: str) -> str:
+    """Escape a label value for the text format."""
+    return label.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def __format(value: float) -> str:
+    """Format a sample value without losing precision."""
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
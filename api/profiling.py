@@ -0,0 +1,233 @@
+"""
+api.profiling.py
+~~~~~~~~~~~~~~~~
+On-demand CPU (cProfile) and memory (tracemalloc) profiling of the running API, driven by the admin endpoints.
+"""
+import contextlib
+import contextvars
+import cProfile
+import functools
+import io
+import logging
+import marshal
+import os
+import pickle
+import pstats
+import random
+import threading
+import tracemalloc
+from collections.abc import Callable, Iterator
+from typing import Optional
+
+LOGGER = logging.getLogger(__name__)
+
+# Token of the admin endpoints, which are disabled if unset
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# Functions summed up on top of the CPU report: logging payloads and pydantic (de)serialization
+HIGHLIGHTS = (
+    "pformat",
+    "model_dump",
+    "model_dump_json",
+    "model_validate",
+    "model_validate_json",
+)
+
+# Whether the work of the current request is profiled, propagated to its jobs with the context
+PROFILED = contextvars.ContextVar("profiled", default=False)
+
+
+class CpuProfiler:
+    """Profiles a sample of the next requests and the jobs they spawn, accumulating their stats.
+
+    A request profile runs on the event loop thread, so it also counts the coroutines interleaved
+    with it. Only one request is profiled at a time to keep them apart.
+    """
+
+    def __init__(self):
+        self.remaining = 0  # requests left to profile
+        self.sample_rate = 1.0
+        self.profiled = 0  # requests profiled since started
+        self._stats = None
+        self._request_active = False
+        self._lock = threading.Lock()
+
+    def start(self, requests: int, sample_rate: float = 1.0):
+        """Profile `requests` of the next requests, each picked with probability `sample_rate`.
+        The stats collected so far are discarded."""
+        with self._lock:
+            self.remaining = requests
+            self.sample_rate = sample_rate
+            self.profiled = 0
+            self._stats = None
+        LOGGER.warning("CPU profiling the next %d requests.", requests)
+
+    def stop(self):
+        with self._lock:
+            self.remaining = 0
+
+    def _take(self) -> bool:
+        """Whether to profile the request starting."""
+        with self._lock:
+            if self.remaining <= 0 or self._request_active:
+                return False
+            if random.random() >= self.sample_rate:
+                return False
+            self.remaining -= 1
+            self.profiled += 1
+            self._request_active = True
+            return True
+
+    @contextlib.contextmanager
+    def request(self) -> Iterator[bool]:
+        """Profile the request if it is picked, yielding whether it is. Its jobs are profiled too."""
+        if not self._take():
+            yield False
+            return
+        token = PROFILED.set(True)
+        try:
+            with self._profile():
+                yield True
+        finally:
+            PROFILED.reset(token)
+            with self._lock:
+                self._request_active = False
+
+    @contextlib.contextmanager
+    def job(self) -> Iterator[None]:
+        """Profile the job if the request it comes from was."""
+        if not PROFILED.get():
+            yield
+            return
+        with self._profile():
+            yield
+
+    @contextlib.contextmanager
+    def _profile(self) -> Iterator[None]:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # since Python 3.12 a single profiler may be active at once: run unprofiled
+            LOGGER.info("Not profiled: %s", e)
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+
+    def dump(self) -> Optional[bytes]:
+        """The accumulated stats as a .prof file (pstats, snakeviz...). None if nothing was profiled."""
+        with self._lock:
+            return None if self._stats is None else marshal.dumps(self._stats.stats)
+
+    def report(self, limit: int = 50) -> Optional[str]:
+        """The accumulated stats as text: the HIGHLIGHTS, then the top functions by cumulative time.
+        None if nothing was profiled."""
+        with self._lock:
+            if self._stats is None:
+                return None
+            buffer = io.StringIO()
+            total = self._stats.total_tt
+            buffer.write(
+                f"{self.profiled} requests profiled, {total:.3f}s of CPU time.\n"
+            )
+            for name in HIGHLIGHTS:
+                seconds = sum(
+                    cumulative
+                    for (_, _, function), (_, _, _, cumulative, _) in (
+                        self._stats.stats.items()
+                    )
+                    if function == name
+                )
+                share = seconds / total if total else 0
+                buffer.write(f"{name:<20} {seconds:.3f}s ({share:.1%})\n")
+            buffer.write("\n")
+            self._stats.stream = buffer
+            self._stats.sort_stats("cumulative").print_stats(limit)
+            return buffer.getvalue()
+
+
+class MemoryProfiler:
+    """tracemalloc snapshots of the process, diffed against the baseline taken when started."""
+
+    def __init__(self):
+        self._baseline = None
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 10):
+        """Trace the allocations with `frames` of traceback, from a new baseline."""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._baseline = tracemalloc.take_snapshot()
+        LOGGER.warning("Tracing memory allocations.")
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._baseline = None
+
+    def snapshot(self) -> bytes:
+        """The current snapshot as a file, for tracemalloc.Snapshot.load.
+        Raises ValueError if not tracing."""
+        if not tracemalloc.is_tracing():
+            raise ValueError("Memory profiling isn't started.")
+        # what Snapshot.dump writes to a path
+        return pickle.dumps(tracemalloc.take_snapshot(), pickle.HIGHEST_PROTOCOL)
+
+    def report(self, limit: int = 30, group_by: str = "lineno") -> str:
+        """The allocations grown the most since the baseline, as text.
+        Raises ValueError if not tracing."""
+        with self._lock:
+            if not tracemalloc.is_tracing() or self._baseline is None:
+                raise ValueError("Memory profiling isn't started.")
+            ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            snapshot = tracemalloc.take_snapshot().filter_traces(ignored)
+            baseline = self._baseline.filter_traces(ignored)
+            current, peak = tracemalloc.get_traced_memory()
+            lines = [
+                f"Traced {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB.",
+                f"Top {limit} differences since the baseline:",
+            ]
+            lines.extend(
+                str(statistic)
+                for statistic in snapshot.compare_to(baseline, group_by)[:limit]
+            )
+            return "\n".join(lines) + "\n"
+
+
+# Shared by the admin endpoints & the request middleware
+CPU = CpuProfiler()
+MEMORY = MemoryProfiler()
+
+
+def profiled_request(fn: Callable) -> Callable:
+    """Decorate an async endpoint for its requests to be profiled when picked by CPU."""
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with CPU.request():
+            return await fn(*args, **kwargs)
+
+    return wrapper
+
+
+def profiled_job(fn: Callable) -> Callable:
+    """Decorate a job to be profiled if the request it comes from is."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with CPU.job():
+            return fn(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,71 @@
+"""
+api.prompts.py
+~~~~~~~~~~~~~~
+Interval index of the prompts: which prompt is open at an instant, by a bisection.
+"""
+import bisect
+import datetime
+import heapq
+from collections.abc import Mapping
+from typing import Optional
+
+UTC = datetime.timezone.utc
+
+
+def seconds(dt: datetime.datetime) -> float:
+    """Seconds since the epoch of the datetime, naive ones being UTC as stored by Mongo."""
+    return (dt if dt.tzinfo else dt.replace(tzinfo=UTC)).timestamp()
+
+
+class PromptIndex:
+    """Prompts by their window, open from `begins` until `ends` excluded.
+
+    The windows are cut into the segments between their bounds, each with the prompt open during it,
+    so `active` is a bisection of the segments. Where windows overlap, the prompt begun last is open,
+    the highest id on ties. Outside of every window no prompt is open. The index is immutable: an
+    update builds another, swapped in while lookups read the previous one.
+    """
+
+    def __init__(
+        self,
+        windows: Optional[
+            Mapping[int, tuple[datetime.datetime, datetime.datetime]]
+        ] = None,
+    ):
+        self.windows = dict(windows or {})
+        prompts = sorted(
+            (seconds(begins), id, seconds(ends))
+            for id, (begins, ends) in self.windows.items()
+        )
+        prompts = [prompt for prompt in prompts if prompt[0] < prompt[2]]  # not empty
+        bounds = sorted(
+            {bound for begins, _, ends in prompts for bound in (begins, ends)}
+        )
+        self._starts, self._active = [], []
+        open_, next_ = [], 0  # heap of the prompts begun, latest first
+        for bound in bounds:
+            while next_ < len(prompts) and prompts[next_][0] == bound:
+                begins, id, ends = prompts[next_]
+                heapq.heappush(open_, (-begins, -id, ends))
+                next_ += 1
+            # ended, below the top they're popped later
+            while open_ and open_[0][2] <= bound:
+                heapq.heappop(open_)
+            active = -open_[0][1] if open_ else None
+            if not self._active or self._active[-1] != active:
+                self._starts.append(bound)
+                self._active.append(active)
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    def active(self, at: datetime.datetime) -> Optional[int]:
+        """The id of the prompt open at the instant, None if none is."""
+        segment = bisect.bisect_right(self._starts, seconds(at)) - 1
+        return self._active[segment] if segment >= 0 else None
+
+    def with_window(
+        self, id: int, begins: datetime.datetime, ends: datetime.datetime
+    ) -> "PromptIndex":
+        """A copy of the index with the window of the prompt added or replaced."""
+        return PromptIndex({**self.windows, id: (begins, ends)})
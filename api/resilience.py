@@ -0,0 +1,175 @@
+"""
+api.resilience.py
+~~~~~~~~~~~~~~~~~
+Timeouts, retries and circuit breakers of the calls to the upstream services (Graph API, attachments CDN).
+"""
+import logging
+import random
+import threading
+import time
+from collections.abc import Callable
+
+import requests
+import urllib3
+
+from api import metrics, tracing
+
+LOGGER = logging.getLogger(__name__)
+
+GRAPH = "graph"  # Facebook Graph API: user profiles, replies
+CDN = "cdn"  # Facebook CDN serving the attachments
+
+# upstream -> (connect timeout, read timeout) in seconds
+TIMEOUTS = {GRAPH: (3.05, 10), CDN: (3.05, 30)}
+ATTEMPTS = 3  # calls per request, retries included
+BACKOFF_BASE = 0.25  # seconds, doubled on every retry
+BACKOFF_MAX = 2.0
+FAILURE_THRESHOLD = 5  # consecutive failures opening the circuit
+RESET_TIMEOUT = 30.0  # seconds the circuit stays open before a trial call
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+CIRCUIT_STATE = metrics.gauge(
+    "upstream_circuit_state",
+    "Circuit breaker state per upstream: 0 closed, 1 half-open, 2 open.",
+    ("upstream",),
+)
+CALLS = metrics.counter(
+    "upstream_calls_total",
+    "Calls to the upstreams by outcome (success, failure, rejected by the open circuit).",
+    ("upstream", "outcome"),
+)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """The upstream is unhealthy, the call failed fast without reaching it."""
+
+
+class CircuitBreaker:
+    """Fails the calls to an upstream fast after `failure_threshold` consecutive failures.
+
+    Once open, calls are rejected for `reset_timeout` seconds, then a single trial call is let
+    through (half-open): its success closes the circuit, its failure opens it again. Should the trial
+    call never report back, another one is let through after `reset_timeout`.
+    """
+
+    def __init__(
+        self,
+        upstream: str,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        reset_timeout: float = RESET_TIMEOUT,
+    ):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set(CLOSED, upstream=upstream)
+
+    def allow(self) -> bool:
+        """Whether a call may go through now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            # one trial call per reset_timeout while not closed
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._opened_at = time.monotonic()
+            self._set(HALF_OPEN)
+            return True
+
+    def record(self, success: bool):
+        """Account for the outcome of an allowed call."""
+        with self._lock:
+            if success:
+                self._failures = 0
+                self._set(CLOSED)
+                return
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    LOGGER.warning("Circuit of %s opened.", self.upstream)
+                self._opened_at = time.monotonic()
+                self._set(OPEN)
+
+    def _set(self, state: int):
+        self.state = state
+        CIRCUIT_STATE.set(state, upstream=self.upstream)
+
+
+BREAKERS = {upstream: CircuitBreaker(upstream) for upstream in TIMEOUTS}
+
+
+def call(
+    upstream: str, method: Callable, *args, idempotent: bool = True, **kwargs
+) -> requests.Response:
+    """Call `method(*args, **kwargs)`, a `requests` method, with the timeouts of the upstream.
+    Connection errors, timeouts, 429 and 5xx responses are retried with jittered exponential backoff
+    and count as failures for the circuit breaker of the upstream.
+    Args:
+    upstream -- GRAPH or CDN
+    method -- e.g. requests.get
+    idempotent -- if False, only retry the calls that never reached the upstream
+
+    Returns:
+    The last response, the caller checks its status.
+
+    Raises:
+    CircuitOpenError if the circuit of the upstream is open, the request exceptions of the last attempt.
+    """
+    breaker = BREAKERS[upstream]
+    for attempt in range(ATTEMPTS):
+        if attempt:
+            time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)))
+        if not breaker.allow():
+            CALLS.inc(upstream=upstream, outcome="rejected")
+            raise CircuitOpenError(f"{upstream} is unavailable, try again later.")
+
+        try:
+            with tracing.span(f"{upstream}.request", attempt=attempt + 1) as span:
+                response = method(*args, timeout=TIMEOUTS[upstream], **kwargs)
+                if span is not None:
+                    span.set(status=getattr(response, "status_code", None))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            __record(breaker, success=False)
+            # unless idempotent, a request that may have reached the upstream isn't sent again
+            if attempt == ATTEMPTS - 1 or not (idempotent or __never_sent(e)):
+                raise
+            LOGGER.warning("Call to %s failed, retrying: %s", upstream, e)
+            continue
+
+        status = getattr(response, "status_code", None)
+        failed = isinstance(status, int) and (status >= 500 or status == 429)
+        __record(breaker, success=not failed)
+        if not failed or not idempotent or attempt == ATTEMPTS - 1:
+            return response
+        LOGGER.warning("Call to %s answered %s, retrying.", upstream, status)
+
+
+def __never_sent(error: requests.exceptions.RequestException) -> bool:
+    """Whether the request failed before being sent: the connection timed out, was refused or the
+    host wasn't resolved. A connection aborted or reset may have been after it was sent.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, "reason", reason)  # the cause wrapped by MaxRetryError
+    return isinstance(
+        reason,
+        (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError),
+    )
+
+
+def __record(breaker: CircuitBreaker, success: bool):
+    breaker.record(success)
+    CALLS.inc(upstream=breaker.upstream, outcome="success" if success else "failure")
+
+
+def reset():
+    """Close every circuit."""
+    for breaker in BREAKERS.values():
+        with breaker._lock:
+            breaker._failures = 0
+            breaker._set(CLOSED)
@@ -0,0 +1,79 @@
+"""
+api.sharding.py
+~~~~~~~~~~~~~~~
+Sharded processing of the webhook events: in order per sender, in parallel across senders.
+"""
+import logging
+import os
+import threading
+import zlib
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from api import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUE_DEPTH = metrics.gauge(
+    "webhook_shard_queue_depth",
+    "Messaging events queued or processing per shard.",
+    ("shard",),
+)
+
+
+class ShardedExecutor:
+    """Runs work items on `shards` single-threaded executors, routed by key.
+
+    All the items of a key (the sender id) go to the same shard and run one after another in
+    submission order, so the messages of a user are never processed out of order. Items of keys on
+    other shards proceed in parallel. A shard holds at most `max_depth` items: a hot key backs up
+    its own shard only, and the webhook rejects its events instead of taking the whole capacity.
+    """
+
+    def __init__(self, shards: int, max_depth: int):
+        if shards < 1 or max_depth < 1:
+            raise ValueError("Shard count and depth must be positive.")
+        self.max_depth = max_depth
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-{shard}")
+            for shard in range(shards)
+        ]
+        self._depths = [0] * shards
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._executors)
+
+    def shard(self, key: str) -> int:
+        """The shard of the key, stable across processes and restarts."""
+        return zlib.crc32(str(key).encode()) % len(self._executors)
+
+    def depth(self, shard: int) -> int:
+        """Number of items queued or running on the shard."""
+        return self._depths[shard]
+
+    def submit(self, key: str, fn: Callable, *args) -> Future:
+        """Queue `fn(*args)` on the shard of the key."""
+        shard = self.shard(key)
+        with self._lock:
+            self._depths[shard] += 1
+        QUEUE_DEPTH.inc(shard=shard)
+        future = self._executors[shard].submit(fn, *args)
+        future.add_done_callback(lambda done: self._done(shard, done))
+        return future
+
+    def _done(self, shard: int, future: Future):
+        with self._lock:
+            self._depths[shard] -= 1
+        QUEUE_DEPTH.dec(shard=shard)
+        # reported here, the submitters don't wait for the result
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            LOGGER.error("Work on shard %s failed: %s", shard, error, exc_info=error)
+
+
+# Shared by the webhook handler
+SHARDS = ShardedExecutor(
+    shards=int(os.environ.get("WEBHOOK_SHARDS", 8)),
+    max_depth=int(os.environ.get("WEBHOOK_SHARD_MAX_DEPTH", 8)),
+)
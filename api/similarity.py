@@ -0,0 +1,293 @@
+"""
+api.similarity.py
+~~~~~~~~~~~~~~~~~
+Nearest-neighbour index over the voice embeddings, stored as a memory-mapped float32 matrix.
+"""
+import contextlib
+import fcntl
+import logging
+import threading
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from typing import IO, Optional
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+INITIAL_CAPACITY = 1024  # rows of the matrix file, doubled whenever it is full
+PARTITION_THRESHOLD = 4096  # below this many voices queries scan every embedding
+PARTITION_PROBES = 4  # partitions scanned per query once partitioned
+KMEANS_ITERATIONS = 8
+
+
+class EmbeddingIndex:
+    """Unit length embeddings of the voice records keyed by VoiceMetadata.id.
+
+    The vectors live in `<directory>/embeddings.f32`, a float32 matrix memory-mapped so every worker
+    shares the page cache. `<directory>/ids.log` journals which voice owns each row. It is appended on
+    every insert/delete under a file lock and replayed incrementally, so the other processes pick
+    the changes up on their next query without reloading the matrix.
+
+    Queries are batched matrix products over every embedding until PARTITION_THRESHOLD voices, then
+    only the PARTITION_PROBES k-means partitions closest to each query are scanned. New voices join
+    their nearest partition, and the partitions are rebuilt whenever the index doubled in size.
+    """
+
+    def __init__(self, directory: Path, dim: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self._matrix_path = self.directory / "embeddings.f32"
+        self._journal_path = self.directory / "ids.log"
+        self._matrix_path.touch()
+        self._journal_path.touch()
+        self._lock = threading.RLock()
+
+        self._matrix: Optional[np.memmap] = None
+        self._ids: list[Optional[str]] = []  # row -> voice id, None if the row is free
+        self._rows: dict[str, int] = {}  # voice id -> row
+        self._free: set[int] = set()
+        self._live = np.zeros(0, dtype=bool)
+        self._offset = 0  # bytes of the journal already replayed
+
+        self._centroids: Optional[np.ndarray] = None
+        self._assignment = np.zeros(0, dtype=np.int32)  # row -> partition, -1 if free
+        self._partitions: Optional[tuple[np.ndarray, np.ndarray]] = None
+        self._partitioned_size = 0  # number of voices when the partitions were built
+
+        with self._lock:
+            self._refresh()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, id: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return id in self._rows
+
+    def get(self, id: str) -> Optional[np.ndarray]:
+        """Get a copy of the embedding of the voice. Return None if not indexed."""
+        with self._lock:
+            self._refresh()
+            row = self._rows.get(id)
+            return None if row is None else np.array(self._matrix[row])
+
+    def add(self, id: str, vector: np.ndarray):
+        """Insert or replace the embedding of the voice."""
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        with self._lock, self._journal() as journal:
+            self._refresh()
+            row = self._rows.get(id)
+            if row is None:
+                row = self._free.pop() if self._free else len(self._ids)
+                self._reserve(row + 1)
+            self._matrix[row] = vector
+            self._matrix.flush()
+            if id not in self._rows:
+                self._append(journal, row, id)
+            elif self._centroids is not None:
+                self._assign_partition(row)
+
+    def remove(self, id: str) -> bool:
+        """Remove the embedding of the voice. Return False if it wasn't indexed."""
+        with self._lock, self._journal() as journal:
+            self._refresh()
+            row = self._rows.get(id)
+            if row is None:
+                return False
+            self._matrix[row] = 0
+            self._matrix.flush()
+            self._append(journal, row, None)
+            return True
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 10,
+        exclude: Optional[Sequence[Optional[str]]] = None,
+    ) -> Sequence[Sequence[tuple[str, float]]]:
+        """Find the k nearest voices of each query vector by cosine similarity.
+        Args:
+        queries -- unit length query vectors, shape (dim,) or (queries, dim)
+        k -- number of neighbours per query
+        exclude -- per query, a voice id left out of its results (usually the query voice itself)
+
+        Returns:
+        Per query, the (voice id, similarity) of its neighbours, most similar first.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        exclude = exclude or [None] * len(queries)
+        with self._lock:
+            self._refresh()
+            if not self._rows:
+                return [[] for _ in queries]
+            if len(self) >= PARTITION_THRESHOLD:
+                self._partition()
+
+            if self._centroids is None:
+                rows = np.flatnonzero(self._live)
+                scores = queries @ self._matrix[rows].T
+                return [
+                    self._top(rows, row_scores, k, excluded)
+                    for row_scores, excluded in zip(scores, exclude)
+                ]
+
+            order, bounds = self._partition_rows()
+            probes = np.argsort(-(queries @ self._centroids.T), axis=1)
+            results = []
+            for query, probe, excluded in zip(queries, probes, exclude):
+                rows = np.concatenate(
+                    [order[bounds[p] : bounds[p + 1]] for p in probe[:PARTITION_PROBES]]
+                )
+                results.append(self._top(rows, self._matrix[rows] @ query, k, excluded))
+            return results
+
+    def similar(self, id: str, k: int = 10) -> Optional[Sequence[tuple[str, float]]]:
+        """Find the k voices sounding the most like the voice. Return None if it isn't indexed."""
+        vector = self.get(id)
+        if vector is None:
+            return None
+        return self.search(vector, k, exclude=[id])[0]
+
+    def _top(
+        self, rows: np.ndarray, scores: np.ndarray, k: int, excluded: Optional[str]
+    ) -> Sequence[tuple[str, float]]:
+        """The k best scoring rows as (voice id, score)."""
+        if excluded in self._rows:
+            keep = rows != self._rows[excluded]
+            rows, scores = rows[keep], scores[keep]
+        if len(rows) > k:
+            best = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[best], scores[best]
+        ranked = np.argsort(-scores, kind="stable")
+        return [(self._ids[rows[i]], float(scores[i])) for i in ranked]
+
+    @contextlib.contextmanager
+    def _journal(self) -> Iterator[IO]:
+        """Open the journal for appending, holding the cross-process write lock."""
+        with open(self._journal_path, "a") as journal:
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            try:
+                yield journal
+            finally:
+                fcntl.flock(journal, fcntl.LOCK_UN)
+
+    def _append(self, journal: IO, row: int, id: Optional[str]):
+        """Journal and apply the new owner of the row."""
+        line = f"{row}\t{id or ''}\n"
+        journal.write(line)
+        journal.flush()
+        self._offset += len(line.encode())
+        self._apply(row, id)
+
+    def _refresh(self):
+        """Replay the journal entries written since the last refresh, by any process."""
+        with open(self._journal_path, "rb") as journal:
+            journal.seek(self._offset)
+            written = journal.read()
+        written = written[: written.rfind(b"\n") + 1]  # skip a line still being written
+        if not written and self._matrix is not None:
+            return
+        self._map()
+        for line in written.decode().splitlines():
+            row, _, id = line.partition("\t")
+            self._apply(int(row), id or None)
+        self._offset += len(written)
+
+    def _apply(self, row: int, id: Optional[str]):
+        """Set the voice owning the row."""
+        self._reserve(row + 1)
+        while len(self._ids) <= row:
+            self._free.add(len(self._ids))
+            self._ids.append(None)
+        previous = self._ids[row]
+        if previous is not None:
+            self._rows.pop(previous, None)
+        self._ids[row] = id
+        self._live[row] = id is not None
+        if id is None:
+            self._free.add(row)
+            self._assignment[row] = -1
+            self._partitions = None
+        else:
+            self._free.discard(row)
+            self._rows[id] = row
+            if self._centroids is not None:
+                self._assign_partition(row)
+
+    def _reserve(self, rows: int):
+        """Grow the matrix file (doubling) so it holds at least `rows`."""
+        capacity = 0 if self._matrix is None else len(self._matrix)
+        if rows > capacity:
+            capacity = max(INITIAL_CAPACITY, capacity)
+            while capacity < rows:
+                capacity *= 2
+            with open(self._matrix_path, "r+b") as file:
+                if file.seek(0, 2) < capacity * self.dim * 4:
+                    file.truncate(capacity * self.dim * 4)
+        self._map()
+
+    def _map(self):
+        """(Re)map the matrix file if another process or _reserve grew it."""
+        capacity = self._matrix_path.stat().st_size // (self.dim * 4)
+        if self._matrix is not None and len(self._matrix) == capacity:
+            return
+        self._matrix = (
+            np.memmap(
+                self._matrix_path,
+                dtype=np.float32,
+                mode="r+",
+                shape=(capacity, self.dim),
+            )
+            if capacity
+            else np.zeros((0, self.dim), dtype=np.float32)
+        )
+        grown = capacity - len(self._live)
+        self._live = np.pad(self._live, (0, max(grown, 0)))
+        self._assignment = np.pad(
+            self._assignment, (0, max(grown, 0)), constant_values=-1
+        )
+
+    def _partition(self):
+        """Cluster the embeddings with k-means, unless the partitions are still fresh."""
+        if self._centroids is not None and len(self) < 2 * self._partitioned_size:
+            return
+        rows = np.flatnonzero(self._live)
+        vectors = np.array(self._matrix[rows])
+        count = int(np.sqrt(len(rows)))
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(len(vectors), count, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            nearest = (vectors @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, vectors)
+            sizes = np.bincount(nearest, minlength=count)
+            filled = sizes > 0
+            centroids[filled] = sums[filled] / sizes[filled, None]
+            centroids /= np.maximum(
+                np.linalg.norm(centroids, axis=1, keepdims=True), 1e-6
+            )
+
+        self._centroids = centroids
+        self._assignment[:] = -1
+        self._assignment[rows] = (vectors @ centroids.T).argmax(axis=1)
+        self._partitions = None
+        self._partitioned_size = len(rows)
+        LOGGER.info("Partitioned %d embeddings into %d partitions.", len(rows), count)
+
+    def _assign_partition(self, row: int):
+        """Add the row to its nearest partition."""
+        self._assignment[row] = (self._centroids @ self._matrix[row]).argmax()
+        self._partitions = None
+
+    def _partition_rows(self) -> tuple[np.ndarray, np.ndarray]:
+        """Rows sorted by partition and the bounds of each partition in that order."""
+        if self._partitions is None:
+            order = np.argsort(self._assignment, kind="stable")
+            bounds = np.searchsorted(
+                self._assignment[order], np.arange(len(self._centroids) + 1)
+            )
+            self._partitions = order, bounds
+        return self._partitions
@@ -0,0 +1,167 @@
+"""
+api.spectrogram.py
+~~~~~~~~~~~~~~~~~~
+Spectrogram thumbnails of the voice records, rendered lazily to PNG and kept in an on-disk LRU cache.
+"""
+import contextlib
+import glob
+import logging
+import os
+import struct
+import threading
+import zlib
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from api import audio
+
+LOGGER = logging.getLogger(__name__)
+
+N_FFT = 1024
+HOP = 256
+DYNAMIC_RANGE_DB = 80.0  # quieter bins than the loudest one minus this range are black
+EVICTION_TARGET = 0.9  # eviction frees the cache down to this share of its bound
+
+
+def cache_key(id: str, height: int, width: int) -> str:
+    """Cache file name of the spectrogram of the voice `id`, covering every render parameter."""
+    return f"{id}.{N_FFT}-{HOP}-{height}x{width}.png"
+
+
+def render(samples: np.ndarray, height: int = 128, width: int = 512) -> bytes:
+    """Render the log-power spectrogram of the samples as a grayscale PNG.
+    The frequency axis is pooled to `height` rows (low frequencies at the bottom) and the time
+    axis to at most `width` columns.
+    """
+    power = np.square(audio.stft(samples, n_fft=N_FFT, hop=HOP))
+    power = __pool(__pool(power, width, axis=0), height, axis=1)
+    db = 10 * np.log10(np.maximum(power, 1e-10))
+    db = np.clip(db - db.max() + DYNAMIC_RANGE_DB, 0, DYNAMIC_RANGE_DB)
+    return encode_png(np.round(db.T[::-1] * (255 / DYNAMIC_RANGE_DB)).astype(np.uint8))
+
+
+def __pool(values: np.ndarray, size: int, axis: int) -> np.ndarray:
+    """Average the values down to at most `size` buckets along the axis."""
+    length = values.shape[axis]
+    if length <= size:
+        return values
+    edges = np.linspace(0, length, size + 1).astype(int)
+    sums = np.add.reduceat(values, edges[:-1], axis=axis)
+    return sums / np.expand_dims(np.diff(edges), 1 - axis)
+
+
+def encode_png(pixels: np.ndarray) -> bytes:
+    """Encode a 2D uint8 array as a grayscale PNG."""
+    height, width = pixels.shape
+    # every scanline is prefixed by its filter type, 0 (none)
+    scanlines = np.hstack((np.zeros((height, 1), dtype=np.uint8), pixels)).tobytes()
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        crc = struct.pack(">I", zlib.crc32(kind + data))
+        return struct.pack(">I", len(data)) + kind + data + crc
+
+    return b"".join(
+        (
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)),
+            chunk(b"IDAT", zlib.compress(scanlines, 9)),
+            chunk(b"IEND", b""),
+        )
+    )
+
+
+class SpectrogramCache:
+    """Rendered files under `directory`, bounded to `max_bytes` in total.
+
+    A hit refreshes the file's mtime, so the least recently used files are evicted first once the
+    bound is exceeded. Misses render behind a per-key lock: concurrent requests for the same key
+    wait for the first render instead of repeating it. Files are written atomically, so workers
+    sharing the directory never read a partial file.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks: dict[str, tuple[threading.Lock, int]] = {}
+        self._size = sum(path.stat().st_size for path in self.directory.glob("*.png"))
+
+    def get(self, key: str, render: Callable[[], bytes]) -> bytes:
+        """Get the cached file `key`, rendering and caching it on a miss."""
+        path = self.directory / key
+        content = self._read(path)
+        if content is not None:
+            return content
+
+        with self._key_lock(key):
+            content = self._read(path)  # rendered while waiting for the lock
+            if content is None:
+                content = render()
+                temporary = path.with_name(f"{key}.{os.getpid()}.tmp")
+                temporary.write_bytes(content)
+                os.replace(temporary, path)
+                self._added(len(content))
+        return content
+
+    def discard(self, id: str):
+        """Remove the cached spectrograms of the voice `id`, e.g. once it is deleted."""
+        for path in self.directory.glob(f"{glob.escape(id)}.*.png"):
+            # not the ones of another voice whose id starts with `id.`
+            if "." in path.name[len(id) + 1 : -len(".png")]:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                size = path.stat().st_size
+                path.unlink()
+                with self._lock:
+                    self._size -= size
+
+    @staticmethod
+    def _read(path: Path) -> Optional[bytes]:
+        """Read a cached file and mark it as recently used. Return None on a miss."""
+        try:
+            content = path.read_bytes()
+            os.utime(path)
+            return content
+        except FileNotFoundError:
+            return None
+
+    @contextlib.contextmanager
+    def _key_lock(self, key: str) -> Iterator[None]:
+        """Hold the lock of the key, dropping it once no request waits on it anymore."""
+        with self._lock:
+            lock, holders = self._key_locks.get(key, (threading.Lock(), 0))
+            self._key_locks[key] = (lock, holders + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, holders = self._key_locks[key]
+                if holders == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (lock, holders - 1)
+
+    def _added(self, size: int):
+        """Account for a new file, evicting the least recently used ones when over the bound."""
+        with self._lock:
+            self._size += size
+            if self._size <= self.max_bytes:
+                return
+            # other workers write to the directory too, so evict from an actual listing
+            files = []
+            for path in self.directory.glob("*.png"):
+                with contextlib.suppress(FileNotFoundError):
+                    stat = path.stat()
+                    files.append((stat.st_mtime, stat.st_size, path))
+            self._size = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if self._size <= self.max_bytes * EVICTION_TARGET:
+                    break
+                path.unlink(missing_ok=True)
+                self._size -= size
+            LOGGER.info("Evicted spectrograms down to %d bytes.", self._size)
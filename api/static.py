@@ -0,0 +1,180 @@
+"""
+api.static.py
+~~~~~~~~~~~~~
+Static assets served from memory: read and compressed (gzip, and brotli if installed) once, reloaded when
+their file changes, answered with strong ETags and 304 to conditional requests.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from api import metrics
+
+try:  # optional: `pip install brotli` to also serve br
+    import brotli
+except ImportError:
+    brotli = None
+
+LOGGER = logging.getLogger(__name__)
+
+STATIC_CACHE_CONTROL = os.environ.get("STATIC_CACHE_CONTROL", "public, max-age=3600")
+# Seconds between the checks of an asset's file for changes, 0 to check on every request
+STATIC_RELOAD_INTERVAL = float(os.environ.get("STATIC_RELOAD_INTERVAL", 5))
+MIN_COMPRESS_SIZE = 256  # smaller assets aren't worth compressing
+# q-value of identity when the Accept-Encoding header doesn't rate it: acceptable, below any coding accepted
+IMPLICIT_IDENTITY_QUALITY = 0.001
+
+RESPONSES = metrics.counter(
+    "static_responses_total",
+    "Static asset responses by asset, content encoding and status.",
+    ("asset", "encoding", "status"),
+)
+
+
+class Asset:
+    """The content of a static file and its compressed variants, by content encoding."""
+
+    __slots__ = ("path", "media_type", "mtime_ns", "size", "etag", "variants")
+
+    def __init__(self, path: Path, media_type: str):
+        self.path = Path(path)
+        self.media_type = media_type
+        stat = self.path.stat()
+        content = self.path.read_bytes()
+        self.mtime_ns, self.size = stat.st_mtime_ns, stat.st_size
+        self.etag = hashlib.sha256(content).hexdigest()[:32]
+        self.variants = {"identity": content}
+        if len(content) >= MIN_COMPRESS_SIZE:
+            compressed = {"gzip": gzip.compress(content, 9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(content, quality=11)
+            self.variants.update(
+                (encoding, variant)
+                for encoding, variant in compressed.items()
+                if len(variant) < len(content)
+            )
+
+    def changed(self) -> bool:
+        """Whether the file was modified since it was read."""
+        stat = self.path.stat()
+        return (stat.st_mtime_ns, stat.st_size) != (self.mtime_ns, self.size)
+
+    def tag(self, encoding: str) -> str:
+        """Strong ETag of the variant: each encoding is a representation of its own."""
+        return (
+            f'"{self.etag}"' if encoding == "identity" else f'"{self.etag}-{encoding}"'
+        )
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """Whether the If-None-Match header names a variant of this version of the asset."""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = {self.tag(encoding) for encoding in self.variants}
+        # weak comparison, as for GET: W/"x" matches "x"
+        return any(
+            tag.strip().removeprefix("W/") in tags for tag in if_none_match.split(",")
+        )
+
+
+class StaticAssets:
+    """Assets by name, loaded on first use (or by `load`) and reloaded once their file changes,
+    checked at most every `reload_interval` seconds."""
+
+    def __init__(self, reload_interval: float = STATIC_RELOAD_INTERVAL):
+        self.reload_interval = reload_interval
+        self._files = {}  # name -> (path, media type)
+        self._assets = {}  # name -> (Asset, monotonic time its file was last checked)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, path: Path, media_type: str):
+        """Register the file as the asset `name`, read on first use."""
+        with self._lock:
+            self._files[name] = (Path(path), media_type)
+            self._assets.pop(name, None)
+
+    def load(self):
+        """Read and compress every asset not loaded yet, e.g. at startup."""
+        for name in list(self._files):
+            self.get(name)
+
+    def get(self, name: str) -> Asset:
+        """The asset, reloaded if its file changed. Raises KeyError for an unknown asset."""
+        path, media_type = self._files[name]
+        asset, checked = self._assets.get(name, (None, 0.0))
+        now = time.monotonic()
+        if asset is not None and now - checked < self.reload_interval:
+            return asset
+        with self._lock:
+            asset, _ = self._assets.get(name, (None, 0.0))
+            if asset is None or asset.changed():
+                asset = Asset(path, media_type)
+                LOGGER.info(
+                    "Loaded the static asset %s: %s", name, sorted(asset.variants)
+                )
+            self._assets[name] = (asset, now)
+        return asset
+
+    def response(self, name: str, request: Request) -> Response:
+        """The asset in the best encoding the client accepts, or 304 if its copy is current."""
+        asset = self.get(name)
+        encoding = negotiate(request.headers.get("accept-encoding", ""), asset.variants)
+        if encoding is None:
+            RESPONSES.inc(asset=name, encoding="none", status="406")
+            return Response(status_code=406, headers={"Vary": "Accept-Encoding"})
+        headers = {
+            "ETag": asset.tag(encoding),
+            "Cache-Control": STATIC_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+        if asset.matches(request.headers.get("if-none-match")):
+            RESPONSES.inc(asset=name, encoding=encoding, status="304")
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        RESPONSES.inc(asset=name, encoding=encoding, status="200")
+        return Response(
+            content=asset.variants[encoding],
+            media_type=asset.media_type,
+            headers=headers,
+        )
+
+
+def negotiate(accept_encoding: str, variants: Mapping[str, bytes]) -> Optional[str]:
+    """The encoding of the variants to send for the Accept-Encoding header: the one of highest
+    q-value, the smallest variant on ties. Identity is acceptable unless rated 0, by itself or by
+    "*". None if no variant is acceptable."""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        encoding, _, parameters = item.strip().partition(";")
+        quality = 1.0
+        if parameters.strip().startswith("q="):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                continue
+        if encoding.strip():
+            accepted[encoding.strip()] = quality
+    default = accepted.get("*", 0.0)
+    if "identity" not in accepted:  # acceptable unless "*" rates it 0
+        accepted["identity"] = accepted.get("*", IMPLICIT_IDENTITY_QUALITY)
+    candidates = [
+        (accepted.get(encoding, default), -len(variant), encoding)
+        for encoding, variant in variants.items()
+    ]
+    quality, _, encoding = max(candidates, default=(0.0, 0, None))
+    return encoding if quality > 0 else None
+
+
+# The assets served by the API, registered by api.main
+ASSETS = StaticAssets()
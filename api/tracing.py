@@ -0,0 +1,166 @@
+"""
+api.tracing.py
+~~~~~~~~~~~~~~
+Trace spans of the webhook processing, from the request to the reply, exported as JSON lines.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Optional
+
+LOGGER = logging.getLogger(__name__)
+
+# Tracing is off unless exported: "stdout" or a file path of JSON lines
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT")
+# Share of the messagings traced, the others cost a context variable lookup per span
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+
+CURRENT = contextvars.ContextVar("span", default=None)
+GLOBAL = {}
+
+
+class Span:
+    """A timed operation of a trace. Spans of a sampled trace are exported once they end."""
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        sampled: bool,
+        attributes: dict,
+    ):
+        self.name = name
+        self.trace_id = trace_id  # correlation id of everything done for a messaging
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.error = None
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, **attributes):
+        """Add attributes to the span."""
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[str] = None):
+        """End the span, exporting it if its trace is sampled."""
+        duration = time.perf_counter() - self._started
+        if error is not None:
+            self.error = error
+        if not self.sampled:
+            return
+        span_exporter = exporter()
+        if span_exporter is None:
+            return
+        span_exporter.export(
+            {
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "name": self.name,
+                "start": self.start,
+                "duration_ms": round(duration * 1000, 3),
+                "attributes": self.attributes,
+                "error": self.error,
+            }
+        )
+
+
+class SpanExporter:
+    """Writes the spans as JSON lines to a file, or to stdout."""
+
+    def __init__(self, destination: str):
+        self.destination = destination
+        if destination == "stdout":
+            self._file = sys.stdout
+        else:
+            Path(destination).parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(destination, "a", buffering=1)  # line buffered
+        self._lock = threading.Lock()
+
+    def export(self, span: dict):
+        line = json.dumps(span, default=str) + "\n"
+        try:
+            with self._lock:
+                self._file.write(line)
+        except OSError as e:
+            LOGGER.warning("Failed to export the span %s: %s", span["name"], e)
+
+
+def exporter() -> Optional[SpanExporter]:
+    """Get the exporter of TRACE_EXPORT. Return None if tracing is off."""
+    if not TRACE_EXPORT:
+        return None
+    span_exporter = GLOBAL.get("exporter")
+    if span_exporter is None or span_exporter.destination != TRACE_EXPORT:
+        span_exporter = GLOBAL["exporter"] = SpanExporter(TRACE_EXPORT)
+    return span_exporter
+
+
+def trace(name: str, **attributes) -> Span:
+    """Start the root span of a new trace, sampled at TRACE_SAMPLE_RATE if tracing is on.
+    The caller ends it, and runs the traced work in `context(span)`.
+    """
+    sampled = bool(TRACE_EXPORT) and random.random() < TRACE_SAMPLE_RATE
+    return Span(name, uuid.uuid4().hex, None, sampled, attributes)
+
+
+def context(span: Span) -> contextvars.Context:
+    """A copy of the current context where the span is the current one, to run work under it
+    on another thread: `executor.submit(context(span).run, fn, *args)`."""
+    copied = contextvars.copy_context()
+    copied.run(CURRENT.set, span)
+    return copied
+
+
+def current() -> Optional[Span]:
+    """The current span, None outside a trace."""
+    return CURRENT.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Run the block in a child span of the current one. Outside a sampled trace it does nothing
+    and yields None. Exceptions are recorded on the span and raised.
+    """
+    parent = CURRENT.get()
+    if parent is None or not parent.sampled:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, True, attributes)
+    token = CURRENT.set(child)
+    error = None
+    try:
+        yield child
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        CURRENT.reset(token)
+        child.end(error)
+
+
+def traced(name: str) -> Callable:
+    """Decorate a function to run each call in a span."""
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
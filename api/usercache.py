@@ -0,0 +1,207 @@
+"""
+api.usercache.py
+~~~~~~~~~~~~~~~~
+Host-wide cache of the user registry, shared by the worker processes through a memory-mapped hash table.
+"""
+import contextlib
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Optional, Union
+
+from api import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+# The cache is off unless a file is set, e.g. /dev/shm/weaving-sounds-users to stay in memory
+USER_CACHE_PATH = os.environ.get("USER_CACHE_PATH")
+# Entries of the table, each of SLOT_SIZE bytes
+USER_CACHE_SLOTS = int(os.environ.get("USER_CACHE_SLOTS", 16384))
+
+MAGIC = b"WSUC"
+FORMAT = 1  # layout version, a file of another layout is reset
+# magic, layout version, slots, generation: bumped by every invalidation
+HEADER = struct.Struct("<4sIIQ")
+HEADER_SIZE = 64
+GENERATION_OFFSET = 12
+# sequence: odd while the slot is written, state, key length, value length
+SLOT = struct.Struct("<IBBH")
+SLOT_SIZE = 512
+MAX_KEY = 120
+MAX_VALUE = SLOT_SIZE - SLOT.size - MAX_KEY
+PROBES = 8  # slots probed from the key's own, before evicting it
+
+# Slot states, a user not registered is cached as ABSENT
+EMPTY = 0
+ABSENT = 1
+PRESENT = 2
+MISS = object()  # get() of a key not cached
+
+GLOBAL = {}
+
+LOOKUPS = metrics.counter(
+    "user_cache_lookups_total", "User cache lookups by result.", ("result",)
+)
+
+
+class SharedCache:
+    """A fixed-size hash table of bytes values in a memory-mapped file, shared by the processes mapping
+    it. Keys may also be cached as absent (None).
+
+    Reads take no lock: each slot has a sequence number, odd while it is written, and a read racing
+    a write is a miss. Writes hold a file lock. A fill carries the generation read before its value
+    was fetched, and is dropped if an invalidation happened since, so a value fetched before an
+    update is never cached after it.
+    """
+
+    def __init__(self, path: Path, slots: int):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.slots = slots
+        size = HEADER_SIZE + slots * SLOT_SIZE
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            header = os.pread(self._fd, HEADER.size, 0)
+            if (
+                os.fstat(self._fd).st_size != size
+                or header[:12] != HEADER.pack(MAGIC, FORMAT, slots, 0)[:12]
+            ):
+                LOGGER.info("Creating the user cache %s.", self.path)
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, FORMAT, slots, 0), 0)
+        self._map = mmap.mmap(self._fd, size)
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @property
+    def generation(self) -> int:
+        """The invalidations so far. Read it before fetching a value to put."""
+        return struct.unpack_from("<Q", self._map, GENERATION_OFFSET)[0]
+
+    def _offsets(self, key: bytes) -> Iterator[int]:
+        start = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+        for probe in range(PROBES):
+            yield HEADER_SIZE + (start + probe) % self.slots * SLOT_SIZE
+
+    def _read(self, offset: int) -> Optional[tuple[int, bytes, bytes]]:
+        """The (state, key, value) of the slot, None if it is being written."""
+        sequence, state, key_length, value_length = SLOT.unpack_from(self._map, offset)
+        if sequence % 2:
+            return None
+        body = offset + SLOT.size
+        key = self._map[body : body + key_length]
+        value = self._map[body + MAX_KEY : body + MAX_KEY + value_length]
+        if SLOT.unpack_from(self._map, offset)[0] != sequence:
+            return None
+        return state, key, value
+
+    def _read_locked(self, offset: int) -> tuple[int, bytes, bytes]:
+        """The (state, key, value) of the slot, with the file lock held. A slot still odd was left by
+        a writer killed mid-write: it is emptied, its sequence even again."""
+        slot = self._read(offset)
+        if slot is not None:
+            return slot
+        LOGGER.warning("Emptying the slot at %d left written by a dead writer.", offset)
+        sequence = SLOT.unpack_from(self._map, offset)[0]
+        struct.pack_into("<BBH", self._map, offset + 4, EMPTY, 0, 0)
+        struct.pack_into("<I", self._map, offset, (sequence + 1) & 0xFFFFFFFF)
+        return EMPTY, b"", b""
+
+    def _write(self, offset: int, state: int, key: bytes = b"", value: bytes = b""):
+        """Write the slot, with the file lock held."""
+        sequence = SLOT.unpack_from(self._map, offset)[0]
+        struct.pack_into("<I", self._map, offset, (sequence + 1) & 0xFFFFFFFF)
+        body = offset + SLOT.size
+        self._map[body : body + len(key)] = key
+        self._map[body + MAX_KEY : body + MAX_KEY + len(value)] = value
+        struct.pack_into("<BBH", self._map, offset + 4, state, len(key), len(value))
+        struct.pack_into("<I", self._map, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    def get(self, key: str) -> Union[bytes, None, object]:
+        """The cached value of the key: bytes, None if cached as absent, MISS if not cached."""
+        encoded = key.encode()
+        # every probe is read, so emptying a slot never hides the entries probed after it
+        for offset in self._offsets(encoded):
+            slot = self._read(offset)
+            if slot is None:
+                continue
+            state, slot_key, value = slot
+            if state != EMPTY and slot_key == encoded:
+                LOOKUPS.inc(result="hit")
+                return value if state == PRESENT else None
+        LOOKUPS.inc(result="miss")
+        return MISS
+
+    def put(self, key: str, value: Optional[bytes], generation: int) -> bool:
+        """Cache the value (None for absent) of the key, fetched at `generation`.
+        Returns whether it was cached: not if invalidated since, or too large."""
+        encoded = key.encode()
+        if len(encoded) > MAX_KEY or (value is not None and len(value) > MAX_VALUE):
+            return False
+        with self._locked():
+            if self.generation != generation:
+                return False
+            # the key's slot, else the first free one, else the key's own is evicted
+            offsets = list(self._offsets(encoded))
+            target, free = None, None
+            for offset in offsets:
+                state, slot_key, _ = self._read_locked(offset)
+                if state != EMPTY and slot_key == encoded:
+                    target = offset
+                    break
+                if state == EMPTY and free is None:
+                    free = offset
+            if target is None:
+                target = offsets[0] if free is None else free
+            self._write(
+                target,
+                ABSENT if value is None else PRESENT,
+                encoded,
+                value or b"",
+            )
+        return True
+
+    def invalidate(self, key: str):
+        """Drop the key, and any fill of a value fetched before."""
+        encoded = key.encode()
+        with self._locked():
+            struct.pack_into("<Q", self._map, GENERATION_OFFSET, self.generation + 1)
+            for offset in self._offsets(encoded):
+                state, slot_key, _ = self._read_locked(offset)
+                if state != EMPTY and slot_key == encoded:
+                    self._write(offset, EMPTY)
+
+    def clear(self):
+        """Drop every key."""
+        with self._locked():
+            struct.pack_into("<Q", self._map, GENERATION_OFFSET, self.generation + 1)
+            for slot in range(self.slots):
+                offset = HEADER_SIZE + slot * SLOT_SIZE
+                if self._read_locked(offset)[0] != EMPTY:
+                    self._write(offset, EMPTY)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def cache() -> Optional[SharedCache]:
+    """Get the user cache at USER_CACHE_PATH. Return None if the cache is off."""
+    if not USER_CACHE_PATH:
+        return None
+    users = GLOBAL.get("cache")
+    if users is None or users.path != Path(USER_CACHE_PATH):
+        users = GLOBAL["cache"] = SharedCache(USER_CACHE_PATH, USER_CACHE_SLOTS)
+    return users
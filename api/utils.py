@@ -6,42 +6,60 @@ Utilities used by api.
 # pylint: disable=logging-format-interpolation
 # TODO: better name
 
+import contextvars
 import logging
 import mimetypes
 import os
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, Union
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
+import pymongo
 import requests
 
-from api import datastore
+from api import audio, datastore, enrichment, metrics, resilience, tracing
 from models import facebook
 
 LOGGER = logging.getLogger(__name__)
 FB_PAGE_TOKEN = os.environ.get("FB_PAGE_TOKEN", "default")
-FB_GRAPH_API = "https://graph.facebook.com/v19.0"
+FB_GRAPH_API = os.environ.get("FB_GRAPH_API", "https://graph.facebook.com/v19.0")
+# Near-duplicates of archived voices are either "flag"ged on their metadata or "reject"ed
+DUPLICATE_POLICY = os.environ.get("DUPLICATE_POLICY", "flag")
+# Attachments of a message downloaded at once
+ATTACHMENT_CONCURRENCY = int(os.environ.get("ATTACHMENT_CONCURRENCY", 4))
 
 
+@tracing.traced("utils.handle_fb_user")
 def handle_fb_user(sender_id: Union[str, int]) -> str:
     """Get the user's Facebook identity"""
     user_id = f"fb/{sender_id}"
     # if user not registered, get user basic info and register to the system
-    if datastore.get_user_by_id(user_id) is None:
+    with metrics.STAGES.time(stage="user_lookup"):
+        registered = datastore.user_registered(user_id)
+    if not registered:
         LOGGER.info("User not found in the system! Registering new user...")
         try:
             # According to Meta's doc: https://developers.facebook.com/docs/messenger-platform/identity/user-profile/#available-profile-fields
-            response = requests.get(
-                f"{FB_GRAPH_API}/{sender_id}?access_token={FB_PAGE_TOKEN}"
-            )
-            response.raise_for_status()
-            response = response.json()
-            datastore.insert_user(
-                user_id,
-                first_name=response.get("first_name", "undefined"),
-                last_name=response.get("last_name", None),
-            )
+            with metrics.STAGES.time(stage="profile_fetch"):
+                response = resilience.call(
+                    resilience.GRAPH,
+                    requests.get,
+                    f"{FB_GRAPH_API}/{sender_id}?access_token={FB_PAGE_TOKEN}",
+                )
+                response.raise_for_status()
+                response = response.json()
+            try:
+                datastore.insert_user(
+                    user_id,
+                    first_name=response.get("first_name", "undefined"),
+                    last_name=response.get("last_name", None),
+                )
+            except pymongo.errors.DuplicateKeyError:
+                # registered by another worker, now known to this one's user filter
+                LOGGER.info("User %s was registered meanwhile.", user_id)
+                return user_id
             reply_to(
                 sender_id,
                 f"New user detected. Registered user with ID {user_id} on webiste. To change your displayable username, go to tanwinn.io/weaving-sounds :)",
@@ -51,23 +69,105 @@ def handle_fb_user(sender_id: Union[str, int]) -> str:
     return user_id
 
 
-def handle_user_message(user_id: str, message: facebook.Message):
-    """If the user message's attachments are audios, archive them."""
+def handle_user_message(
+    user_id: str,
+    message: Union[facebook.Message, facebook.WebhookMessage],
+    timestamp: Optional[int] = None,
+):
+    """If the user message's attachments are audios, archive them.
+    Several attachments are downloaded concurrently, each archived as the voice `<mid>-<index>`.
+    Network failures are raised for the message to be retried, the voices archived by then are skipped.
+    The voices answer the prompt open when the message was sent, at `timestamp` (milliseconds since
+    the epoch) or now.
+    """
     if not dict(message).get("attachments"):
         raise AttributeError("User message doesn't have attachments.")
 
-    if len(message.attachments) > 1:
-        raise AttributeError(
-            "Too many attachements at once. Please upload one at a time."
+    sent = (
+        datetime.now(tz=ZoneInfo("UTC"))
+        if timestamp is None
+        else datetime.fromtimestamp(timestamp / 1000, tz=ZoneInfo("UTC"))
+    )
+    prompt_id = datastore.active_prompt(sent)
+
+    if len(message.attachments) == 1:
+        __archive_attachment(
+            user_id=user_id,
+            attachment=message.attachments[0],
+            voice_id=f"{message.mid}",
+            prompt_id=prompt_id,
+        )
+        LOGGER.info("Saved audio & metadata: %s", message.mid)
+        return f"Saved audio file with ID {message.mid}"
+
+    voice_ids = [f"{message.mid}-{i}" for i in range(len(message.attachments))]
+    workers = min(ATTACHMENT_CONCURRENCY, len(voice_ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # each in a copy of the context, for its spans to join the message's trace
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                __archive_attachment,
+                user_id,
+                attachment,
+                voice_id,
+                prompt_id,
+            )
+            for attachment, voice_id in zip(message.attachments, voice_ids)
+        ]
+    saved, errors = [], []
+    for voice_id, future in zip(voice_ids, futures):
+        error = future.exception()
+        # retried by the job queue, like network failures
+        if isinstance(
+            error,
+            (requests.exceptions.RequestException, pymongo.errors.ConnectionFailure),
+        ):
+            raise error
+        if error is None:
+            saved.append(voice_id)
+        else:
+            errors.append((voice_id, error))
+    if not saved:
+        raise errors[0][1]
+
+    LOGGER.info("Saved audio & metadata: %s", saved)
+    answer = f"Saved {len(saved)} of {len(voice_ids)} audio files with IDs {', '.join(saved)}."
+    if errors:
+        LOGGER.warning("Not saved: %s", errors)
+        answer += (
+            " Not saved: "
+            + "; ".join(f"{id} ({__not_saved_reason(e)})" for id, e in errors)
+            + "."
         )
+    return answer
+
+
+def __not_saved_reason(error: Exception) -> str:
+    """The reason an attachment wasn't saved, told to its sender rather than the error itself."""
+    if isinstance(error, datastore.DuplicateVoiceError):
+        return "duplicate"
+    if isinstance(error, AttributeError):
+        return "not an audio"
+    return "error"
 
+
+def __archive_attachment(
+    user_id: str,
+    attachment: facebook.Attachment,
+    voice_id: str,
+    prompt_id: Optional[int],
+):
+    """Archive the attachment as the voice, unless an earlier attempt already did."""
+    if datastore.get_metadata(voice_id) is not None:
+        LOGGER.info("Voice %s already archived.", voice_id)
+        return
     __extract_and_store_audio_from_url(
-        user_id=user_id, attachment=message.attachments[0], voice_id=f"{message.mid}"
+        user_id=user_id, attachment=attachment, voice_id=voice_id, prompt_id=prompt_id
     )
-    LOGGER.info(f"Saved audio & metadata: {message.mid}")
-    return f"Saved audio file with ID {message.mid}"
 
 
+@tracing.traced("utils.reply_to")
 def reply_to(user_id: str, text: str) -> Mapping:
     """
     Compose a message/reply to `user_id` with content of `text`
@@ -77,11 +177,16 @@ def reply_to(user_id: str, text: str) -> Mapping:
         recipient=facebook.User(id=user_id),
         message=facebook.ResponseMessage(text=text),
     ).model_dump()
-    LOGGER.info(f"Prepping call to Facebook Graph API.")
-    response = requests.post(
-        f"{FB_GRAPH_API}/me/messages?access_token={FB_PAGE_TOKEN}", json=data
-    )
-    response.raise_for_status()
+    LOGGER.info("Prepping call to Facebook Graph API.")
+    with metrics.STAGES.time(stage="reply"):
+        response = resilience.call(
+            resilience.GRAPH,
+            requests.post,
+            f"{FB_GRAPH_API}/me/messages?access_token={FB_PAGE_TOKEN}",
+            json=data,
+            idempotent=False,  # never send the reply twice
+        )
+        response.raise_for_status()
     return data
 
 
@@ -129,8 +234,12 @@ def __extract_attachment_filename(header: Mapping) -> Optional[str]:
     return name if name else None
 
 
+@tracing.traced("utils.extract_and_store_audio_from_url")
 def __extract_and_store_audio_from_url(
-    user_id: str, attachment: facebook.Attachment, voice_id: str
+    user_id: str,
+    attachment: facebook.Attachment,
+    voice_id: str,
+    prompt_id: Optional[int] = None,
 ) -> str:
     """Download the audio from url to ./records and store its metadata to datastore's 'METADATAS table."""
     # Ensure that the attachment is an audio type and has a downloadable url
@@ -140,10 +249,14 @@ def __extract_and_store_audio_from_url(
     ):
         raise AttributeError("Attachment not an audio.")
 
-    # Download the audio file
+    # Download the audio file, its body is streamed when read
     try:
-        response = requests.get(attachment.payload.url, stream=True)
-        response.raise_for_status()
+        with metrics.STAGES.time(stage="download"):
+            response = resilience.call(
+                resilience.CDN, requests.get, attachment.payload.url, stream=True
+            )
+            response.raise_for_status()
+            audio_content = response.content
     except requests.exceptions.RequestException as e:
         raise requests.exceptions.HTTPError(e)
 
@@ -155,12 +268,20 @@ def __extract_and_store_audio_from_url(
     if not filetype:  # if we cannot guess the file type (extension), raise error
         raise AttributeError("Cannot detech the attachment's audio file extension.")
 
+    # Decode once, the fingerprint and derived data (waveform peaks...) all need the samples
+    audio_extension = filetype.strip(".")
+    samples = enrichment.decode_voice(audio_content, audio_extension)
+
     # Save the static file to voices
     datastore.insert_voice(
         id=voice_id,
-        audio_content=response.content,
+        audio_content=audio_content,
         datetime=dt,
-        audio_extension=filetype.strip("."),
-        prompt_id=1,  # todo:
+        audio_extension=audio_extension,
+        prompt_id=prompt_id,
         username=user_id,
+        fingerprint=None if samples is None else audio.fingerprint(samples),
+        reject_duplicates=DUPLICATE_POLICY == "reject",
     )
+    if samples is not None:
+        enrichment.enrich_voice(voice_id, samples)
@@ -0,0 +1,5 @@
+"""
+benchmarks
+~~~~~~~~~~
+Load tools & benchmarks of the API, run against local stand-ins of the Facebook upstreams.
+"""
@@ -0,0 +1,429 @@
+"""
+benchmarks.datastore.py
+~~~~~~~~~~~~~~~~~~~~~~~
+Cost of every api.datastore operation and how it scales with the size of the collections, against
+mongomock and a local mongod. The collections are seeded with `size` documents each, then every
+operation is timed on its own, along with the pydantic validation & serialization of its models.
+Results are appended to benchmarks/results/datastore.jsonl with the git revision.
+
+    python -m benchmarks.datastore --sizes 1000 10000 100000 1000000 --backends mongomock mongod
+"""
+import argparse
+import contextlib
+import datetime
+import random
+import tempfile
+import time
+from collections.abc import Callable, Iterator, Mapping, Sequence
+from pathlib import Path
+from typing import Optional
+from unittest import mock
+
+import mongomock
+import numpy as np
+import pymongo
+
+from api import datastore
+from benchmarks import results
+from models import weaver
+
+NAME = "datastore"  # results stored to benchmarks/results/datastore.jsonl
+DATABASE = "sounds_benchmark"  # dropped before every size, never the API's database
+BATCH = 10_000  # documents inserted at once while seeding
+VOICES_PER_USER = 10
+VOICES_PER_PROMPT = 100  # the listings return as many documents whatever the size
+FINGERPRINT_SIZE = 200  # landmark hashes of a voice
+EPOCH = datetime.datetime(2024, 1, 1)
+
+
+def __client(backend: str) -> Optional[pymongo.MongoClient]:
+    """A client of the backend, or None if mongod isn't reachable at MONGO_CONN_STR."""
+    if backend == "mongomock":
+        return mongomock.MongoClient()
+    client = pymongo.MongoClient(
+        host=datastore.MONGO_CONN_STR, serverSelectionTimeoutMS=2000
+    )
+    try:
+        client.server_info()
+    except pymongo.errors.PyMongoError as e:
+        print(
+            f"Skipping mongod, not reachable at {datastore.MONGO_CONN_STR}: {type(e).__name__}"
+        )
+        client.close()
+        return None
+    return client
+
+
+@contextlib.contextmanager
+def configured(client: pymongo.MongoClient, directory: Path) -> Iterator[None]:
+    """Point api.datastore to the DATABASE of the client, and to voices under `directory`."""
+    with mock.patch.object(datastore, "MONGO_DATABASE", DATABASE):
+        with mock.patch.object(datastore, "VOICES_DIR", Path(directory)):
+            datastore.GLOBAL.update(db_client=client)
+            try:
+                yield
+            finally:
+                datastore.GLOBAL.pop("db_client", None)
+
+
+def __voice(n: int) -> weaver.VoiceMetadata:
+    return weaver.VoiceMetadata(
+        _id=f"voice-{n}",
+        datetime=EPOCH + datetime.timedelta(minutes=n),
+        audio_extension="wav",
+        username=f"user-{n // VOICES_PER_USER}",
+        prompt_id=n // VOICES_PER_PROMPT,
+        fingerprint_size=FINGERPRINT_SIZE,
+    )
+
+
+def __user(n: int) -> weaver.User:
+    return weaver.User(
+        _id=f"fb/{n}", username=f"user-{n}", first_name="Bench", last_name=str(n)
+    )
+
+
+def __prompt(n: int) -> weaver.Prompt:
+    begins = EPOCH + datetime.timedelta(weeks=n)
+    return weaver.Prompt(
+        _id=n, begins=begins, ends=begins + datetime.timedelta(weeks=1), text="Bench?"
+    )
+
+
+def __fingerprint(rng: random.Random) -> Sequence[int]:
+    return rng.sample(range(2**32), FINGERPRINT_SIZE)
+
+
+def seed(database: pymongo.database.Database, size: int, rng: random.Random):
+    """Fill every collection with `size` documents, as the datastore would store them."""
+    for name, model in (
+        (datastore.METADATAS, __voice),
+        (datastore.USERS, __user),
+        (datastore.PROMPTS, __prompt),
+    ):
+        for start in range(0, size, BATCH):
+            database.get_collection(name).insert_many(
+                [
+                    model(n).model_dump(by_alias=True, exclude_unset=True)
+                    for n in range(start, min(size, start + BATCH))
+                ]
+            )
+    for start in range(0, size, BATCH):
+        database.get_collection(datastore.USERNAME_TO_ID).insert_many(
+            [
+                {"_id": f"user-{n}", "id": f"fb/{n}"}
+                for n in range(start, min(size, start + BATCH))
+            ]
+        )
+        database.get_collection(datastore.FINGERPRINTS).insert_many(
+            [
+                {"_id": hash, "voices": [f"voice-{n}"]}
+                for n, hash in zip(
+                    range(start, min(size, start + BATCH)),
+                    rng.sample(range(2**32), min(size, start + BATCH) - start),
+                )
+            ]
+        )
+    database.get_collection(datastore.PROMPT_MANAGER).update_one(
+        {"_id": "manager"}, {"$set": {"next_index": size}}
+    )
+
+
+def __time(
+    operation: Callable, arguments: Sequence[tuple], budget: float = float("inf")
+) -> Sequence[float]:
+    """Seconds every call of the operation took, one call per arguments. The calls stop once they
+    took `budget` seconds overall: under mongomock the slowest operations take seconds each.
+    """
+    durations = []
+    for args in arguments:
+        started = time.perf_counter()
+        operation(*args)
+        durations.append(time.perf_counter() - started)
+        if sum(durations) >= budget:
+            break
+    return durations
+
+
+def __summary(seconds: Sequence[float]) -> Mapping[str, float]:
+    """p50, p95, p99 in microseconds and the operations per second."""
+    p50, p95, p99 = np.percentile(np.asarray(seconds) * 1e6, (50, 95, 99))
+    return {
+        "calls": len(seconds),
+        "p50_us": round(float(p50), 1),
+        "p95_us": round(float(p95), 1),
+        "p99_us": round(float(p99), 1),
+        "ops_per_second": round(len(seconds) / sum(seconds), 1),
+    }
+
+
+def operations(
+    size: int, ops: int, rng: random.Random
+) -> Mapping[str, tuple[Callable, Sequence[tuple]]]:
+    """Every benchmarked operation with the arguments of its `ops` calls on a seeded datastore."""
+    users = max(1, size // VOICES_PER_USER)
+    prompts = max(1, size // VOICES_PER_PROMPT)
+    content = b"\0" * 1024
+
+    def insert_voice(n: int, fingerprint: Optional[Sequence[int]]):
+        datastore.insert_voice(
+            id=f"new-voice-{n}",
+            audio_extension="wav",
+            audio_content=content,
+            datetime=EPOCH,
+            username="user-0",
+            prompt_id=0,
+            fingerprint=fingerprint,
+        )
+
+    return {
+        "insert_voice": (insert_voice, [(n, None) for n in range(ops)]),
+        "insert_voice_fingerprinted": (
+            insert_voice,
+            [(ops + n, __fingerprint(rng)) for n in range(ops)],
+        ),
+        "insert_user": (
+            lambda n: datastore.insert_user(id=f"fb/new-{n}", first_name="Bench"),
+            [(n,) for n in range(ops)],
+        ),
+        "insert_prompt": (
+            lambda: datastore.insert_prompt("Bench?", EPOCH, EPOCH),
+            [()] * ops,
+        ),
+        "get_metadata": (
+            datastore.get_metadata,
+            [(f"voice-{rng.randrange(size)}",) for _ in range(ops)],
+        ),
+        "get_user_by_id": (
+            datastore.get_user_by_id,
+            [(f"fb/{rng.randrange(size)}",) for _ in range(ops)],
+        ),
+        "get_user_by_username": (
+            datastore.get_user_by_username,
+            [(f"user-{rng.randrange(size)}",) for _ in range(ops)],
+        ),
+        "get_voices_by_user": (
+            datastore.get_voices_by_user,
+            [(f"user-{rng.randrange(users)}",) for _ in range(ops)],
+        ),
+        "get_voices_by_prompt": (
+            datastore.get_voices_by_prompt,
+            [(rng.randrange(prompts),) for _ in range(ops)],
+        ),
+        "get_prompt_rollup": (
+            lambda id: datastore.get_rollup(weaver.RollupKind.PROMPT, str(id)),
+            [(rng.randrange(prompts),) for _ in range(ops)],
+        ),
+        "get_top_contributors": (
+            datastore.get_top_contributors,
+            [(rng.randrange(prompts), 10) for _ in range(ops)],
+        ),
+        "active_prompt": (
+            datastore.active_prompt,
+            [
+                (EPOCH + datetime.timedelta(weeks=rng.uniform(0, size)),)
+                for _ in range(ops)
+            ],
+        ),
+    }
+
+
+def negative_lookups(ops: int) -> Mapping[str, tuple[Callable, Sequence[tuple]]]:
+    """The lookups of users & usernames not registered, which the user filters answer."""
+    return {
+        "user_registered_new": (
+            datastore.user_registered,
+            [(f"fb/new-sender-{n}",) for n in range(ops)],
+        ),
+        "username_available_new": (
+            datastore.username_available,
+            [(f"new-user-{n}",) for n in range(ops)],
+        ),
+    }
+
+
+def validation(ops: int) -> Mapping[str, Mapping[str, float]]:
+    """Microseconds pydantic takes to validate (model_validate) and to dump (model_dump) a document
+    of every model, the overhead every datastore operation pays per document."""
+    overhead = {}
+    for name, model in (
+        ("VoiceMetadata", __voice),
+        ("User", __user),
+        ("Prompt", __prompt),
+    ):
+        instances = [model(n) for n in range(ops)]
+        documents = [
+            instance.model_dump(by_alias=True, exclude_unset=True)
+            for instance in instances
+        ]
+        validate = __time(type(instances[0]).model_validate, [(d,) for d in documents])
+        dump = __time(
+            lambda instance: instance.model_dump(by_alias=True, exclude_unset=True),
+            [(instance,) for instance in instances],
+        )
+        overhead[name] = {
+            "model_validate_us": round(float(np.median(validate)) * 1e6, 2),
+            "model_dump_us": round(float(np.median(dump)) * 1e6, 2),
+        }
+    return overhead
+
+
+def measure(
+    client: pymongo.MongoClient, size: int, ops: int, budget: float, seed_value: int
+) -> Mapping:
+    """Seed a fresh database with `size` documents per collection and time every operation."""
+    rng = random.Random(seed_value)
+    client.drop_database(DATABASE)
+    with tempfile.TemporaryDirectory() as directory:
+        with configured(client, directory):
+            datastore.initialize()
+            started = time.perf_counter()
+            seed(client.get_database(DATABASE), size, rng)
+            seeding = time.perf_counter() - started
+            timings = {
+                f"{name}_unfiltered": __summary(__time(operation, arguments, budget))
+                for name, (operation, arguments) in negative_lookups(ops).items()
+            }
+            datastore.build_user_filters()
+            try:
+                timings["load_prompts"] = __summary(
+                    __time(datastore.load_prompts, [()], budget)
+                )
+                # the seeded voices are counted by a backfill
+                timings["rebuild_rollups"] = __summary(
+                    __time(datastore.rebuild_rollups, [()], budget)
+                )
+                timings.update(
+                    (name, __summary(__time(operation, arguments, budget)))
+                    for name, (operation, arguments) in {
+                        **operations(size, ops, rng),
+                        **negative_lookups(ops),
+                    }.items()
+                )
+                filters = datastore.user_filter_stats()
+            finally:
+                datastore.GLOBAL.pop("user_filters", None)
+                datastore.GLOBAL.pop("prompt_index", None)
+    client.drop_database(DATABASE)
+    return {
+        "size": size,
+        "seed_seconds": round(seeding, 2),
+        "operations": timings,
+        "user_filters": filters,
+    }
+
+
+def __report(run: Mapping, previous: Optional[Mapping]):
+    baseline = {
+        (size["backend"], size["size"], name): timing
+        for size in (previous or {}).get("sizes", [])
+        for name, timing in size["operations"].items()
+    }
+    print(
+        f"{'backend':<10} {'size':>8} {'operation':<34} {'p50 us':>10} {'p95 us':>10} {'p99 us':>10} {'ops/s':>10} {'change':>8}"
+    )
+    for size in run["sizes"]:
+        for name, timing in size["operations"].items():
+            before = baseline.get((size["backend"], size["size"], name))
+            change = f"{timing['p50_us'] / before['p50_us'] - 1:+.1%}" if before else ""
+            print(
+                f"{size['backend']:<10} {size['size']:>8} {name:<34} {timing['p50_us']:>10} "
+                f"{timing['p95_us']:>10} {timing['p99_us']:>10} {timing['ops_per_second']:>10} "
+                f"{change:>8}"
+            )
+    print(
+        f"\n{'backend':<10} {'size':>8} {'user filter':<15} {'keys':>8} {'memory KiB':>11} {'FP rate':>9}"
+    )
+    for size in run["sizes"]:
+        for name, stats in size.get("user_filters", {}).items():
+            print(
+                f"{size['backend']:<10} {size['size']:>8} {name:<15} {stats['keys']:>8} "
+                f"{stats['memory_bytes'] / 1024:>11.1f} {stats['false_positive_rate']:>9.2e}"
+            )
+    print(f"\n{'model':<15} {'model_validate us':>18} {'model_dump us':>14}")
+    for name, overhead in run["validation"].items():
+        print(
+            f"{name:<15} {overhead['model_validate_us']:>18} {overhead['model_dump_us']:>14}"
+        )
+    if previous:
+        print(f"\nchange of p50 vs {previous['revision']}")
+
+
+def run(args: argparse.Namespace) -> Mapping:
+    sizes = []
+    for backend in args.backends:
+        client = __client(backend)
+        if client is None:
+            continue
+        try:
+            for size in sorted(args.sizes):
+                print(
+                    f"Measuring {backend} with {size} documents per collection...",
+                    flush=True,
+                )
+                sizes.append(
+                    {
+                        "backend": backend,
+                        **measure(client, size, args.ops, args.budget, args.seed),
+                    }
+                )
+        finally:
+            client.close()
+    return {
+        "revision": results.revision(),
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "setup": {
+            "ops": args.ops,
+            "budget": args.budget,
+            "seed": args.seed,
+            "voices_per_user": VOICES_PER_USER,
+            "voices_per_prompt": VOICES_PER_PROMPT,
+        },
+        "sizes": sizes,
+        "validation": validation(args.ops),
+    }
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.datastore", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10_000, 100_000],
+        help="documents per collection",
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=["mongomock", "mongod"],
+        default=["mongomock", "mongod"],
+        help="mongod is MONGO_CONN_STR, skipped if not reachable",
+    )
+    parser.add_argument(
+        "--ops", type=int, default=200, help="timed calls of every operation"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=10.0,
+        help="seconds of calls per operation at most, the first call always runs",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-save",
+        action="store_true",
+        help="don't append the results to benchmarks/results",
+    )
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    __report(result, results.previous(NAME, result["setup"]))
+    if not args.no_save:
+        results.save(NAME, result)
+
+
+if __name__ == "__main__":
+    main()
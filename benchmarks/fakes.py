@@ -0,0 +1,122 @@
+"""
+benchmarks.fakes.py
+~~~~~~~~~~~~~~~~~~~
+Local stand-in of the Graph API and the attachments CDN, serving synthetic audio.
+"""
+import io
+import json
+import threading
+import time
+import wave
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+
+from api import audio
+
+NOTE_SECONDS = 0.25
+
+
+def synthetic_wav(name: str, seconds: float) -> bytes:
+    """A 16-bit mono WAV of a random melody seeded by `name`: every name sounds different."""
+    rng = np.random.default_rng(zlib.crc32(name.encode()))
+    note = int(NOTE_SECONDS * audio.SAMPLE_RATE)
+    notes = max(1, int(seconds / NOTE_SECONDS))
+    t = np.arange(note) / audio.SAMPLE_RATE
+    melody = np.concatenate(
+        [np.sin(2 * np.pi * rng.uniform(200, 2000) * t) for _ in range(notes)]
+    )
+    samples = 0.5 * melody + 0.05 * rng.standard_normal(len(melody))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(audio.SAMPLE_RATE)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+class FakeUpstreams:
+    """HTTP server on localhost standing in for Facebook, answering after `latency` seconds.
+
+    - GET  /graph/<psid>           the user profile
+    - POST /graph/me/messages      a reply, recorded in `replies` as (recipient id, text, time)
+    - GET  /cdn/<name>.wav         `audio_seconds` of synthetic audio
+
+    Use as a context manager, the server runs on a background thread.
+    """
+
+    def __init__(self, latency: float = 0.0, audio_seconds: float = 2.0):
+        self.latency = latency
+        self.audio_seconds = audio_seconds
+        self.replies: list[tuple[str, str, float]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def graph_url(self) -> str:
+        return f"{self.url}/graph"
+
+    def cdn_url(self, name: str) -> str:
+        return f"{self.url}/cdn/{name}.wav"
+
+    def __enter__(self) -> "FakeUpstreams":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self) -> type:
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(upstreams.latency)
+                path = urlparse(self.path).path
+                if path.startswith("/cdn/"):
+                    name = path.removeprefix("/cdn/").removesuffix(".wav")
+                    self._send(
+                        synthetic_wav(name, upstreams.audio_seconds), "audio/x-wav"
+                    )
+                elif path.startswith("/graph/"):
+                    psid = path.removeprefix("/graph/")
+                    profile = {"first_name": "Bench", "last_name": psid, "id": psid}
+                    self._send(json.dumps(profile).encode(), "application/json")
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                time.sleep(upstreams.latency)
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with upstreams._lock:
+                    upstreams.replies.append(
+                        (
+                            str(body["recipient"]["id"]),
+                            body["message"]["text"],
+                            time.perf_counter(),
+                        )
+                    )
+                self._send(b'{"message_id": "bench"}', "application/json")
+
+            def _send(self, content: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass  # keep the benchmark output readable
+
+        return Handler
@@ -0,0 +1,176 @@
+"""
+benchmarks.logs.py
+~~~~~~~~~~~~~~~~~~
+Logging overhead per webhook request at every log level, in the text and structured formats: the eager
+f-string & pformat records the ingest path used to build, against the lazy ones of api.logs. Records are
+written to /dev/null, over the events of unittests/data/facebook/event_data.json.
+
+    python -m benchmarks.logs --repeat 2000
+"""
+import argparse
+import datetime
+import logging
+import os
+import time
+from collections.abc import Callable, Mapping, Sequence
+from pprint import pformat as pf
+from typing import Optional
+
+from api import datastore, logs, utils
+from api import main as api_main
+from benchmarks import results
+from benchmarks.pipeline import load_events
+from benchmarks.replay import DEFAULT_SOURCES
+from models import facebook
+
+NAME = "logs"  # results stored to benchmarks/results/logs.jsonl
+LEVELS = ("DEBUG", "INFO", "WARNING")
+FORMATS = ("text", "json")
+# Datastore calls of a request archiving one voice: user lookup, archived check, duplicates, insert
+QUERIES = ("fb/12345", "m_bench", {"_id": {"$in": list(range(200))}}, "m_bench")
+
+
+def eager(event: facebook.Event):
+    """The records of a request as the ingest path built them before: f-strings & pformat."""
+    api_main.LOGGER.info(f"Data event:\n {pf(event.model_dump())}")
+    for entry in event.entry or []:
+        for messaging in entry.messaging:
+            api_main.LOGGER.info(f"userID: {messaging.sender.id}")
+            api_main.LOGGER.info(
+                f"Message object: \n{pf(messaging.message.model_dump())}"
+            )
+            for query in QUERIES:
+                datastore.LOGGER.info(
+                    f"Getting document in {datastore.METADATAS} " f"with query={query}"
+                )
+            datastore.LOGGER.info(
+                f"Inserted document with id {messaging.message.mid} to {datastore.METADATAS}"
+            )
+            utils.LOGGER.info(f"Saved audio & metadata: {messaging.message.mid}")
+            utils.LOGGER.info("Prepping call to Facebook Graph API.")
+
+
+def lazy(event: facebook.Event):
+    """The records of a request as the ingest path builds them: deferred to api.logs payloads."""
+    api_main.LOGGER.info("Data event: %s", logs.payload(event))
+    for entry in event.entry or []:
+        for messaging in entry.messaging:
+            api_main.LOGGER.info(
+                "Job %s of user %s: %s",
+                0,
+                messaging.sender.id,
+                logs.payload(messaging.message),
+            )
+            for query in QUERIES:
+                datastore.LOGGER.info(
+                    "Getting document in %s with query=%s",
+                    datastore.METADATAS,
+                    logs.payload(query),
+                )
+            datastore.LOGGER.info(
+                "Inserted document with id %s to %s",
+                messaging.message.mid,
+                datastore.METADATAS,
+            )
+            utils.LOGGER.info("Saved audio & metadata: %s", messaging.message.mid)
+            utils.LOGGER.info("Prepping call to Facebook Graph API.")
+
+
+def measure(
+    log: Callable,
+    events: Sequence[facebook.Event],
+    level: str,
+    format: str,
+    repeat: int,
+) -> float:
+    """Microseconds of logging per request."""
+    root = logging.getLogger()
+    with open(os.devnull, "w") as sink:
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(
+            logs.StructuredFormatter()
+            if format == "json"
+            else logging.Formatter(logging.BASIC_FORMAT)
+        )
+        previous_level, previous_handlers = root.level, root.handlers
+        root.handlers = [handler]
+        root.setLevel(level)
+        try:
+            started = time.perf_counter()
+            for n in range(repeat):
+                log(events[n % len(events)])
+            elapsed = time.perf_counter() - started
+        finally:
+            root.handlers = previous_handlers
+            root.setLevel(previous_level)
+    return round(elapsed / repeat * 1e6, 2)
+
+
+def run(args: argparse.Namespace) -> Mapping:
+    events = [
+        facebook.Event.model_validate(event)
+        for event in load_events(args.sources or DEFAULT_SOURCES[:1])
+    ]
+    runs = []
+    for format in FORMATS:
+        for level in LEVELS:
+            runs.append(
+                {
+                    "format": format,
+                    "level": level,
+                    "eager_us": measure(eager, events, level, format, args.repeat),
+                    "lazy_us": measure(lazy, events, level, format, args.repeat),
+                }
+            )
+    return {
+        "revision": results.revision(),
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "setup": {"repeat": args.repeat, "events": len(events)},
+        "runs": runs,
+    }
+
+
+def __report(run: Mapping, previous: Optional[Mapping]):
+    baseline = {
+        (before["format"], before["level"]): before
+        for before in (previous or {}).get("runs", [])
+    }
+    print(
+        f"{'format':<7} {'level':<8} {'eager us/req':>13} {'lazy us/req':>12} {'saved':>7} {'lazy before':>12}"
+    )
+    for level in run["runs"]:
+        saved = 1 - level["lazy_us"] / level["eager_us"] if level["eager_us"] else 0
+        before = baseline.get((level["format"], level["level"]), {}).get("lazy_us", "")
+        print(
+            f"{level['format']:<7} {level['level']:<8} {level['eager_us']:>13} "
+            f"{level['lazy_us']:>12} {saved:>7.0%} {before!s:>12}"
+        )
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.logs", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        help="capture journals or test data files (default: unittests/data/facebook events)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=2000, help="requests logged per measure"
+    )
+    parser.add_argument(
+        "--no-save",
+        action="store_true",
+        help="don't append the results to benchmarks/results",
+    )
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    __report(result, results.previous(NAME, result["setup"]))
+    if not args.no_save:
+        results.save(NAME, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+benchmarks.parsing.py
+~~~~~~~~~~~~~~~~~~~~~
+Webhook events parsed per second from the request bytes: the way FastAPI parsed the body (into a dict,
+then validated into the full models), validated in one pass into the full models, and into the ingest
+models of the webhook. Over the events of unittests/data/facebook/event_data.json.
+
+    python -m benchmarks.parsing --repeat 20000
+"""
+import argparse
+import datetime
+import json
+import time
+from collections.abc import Callable, Mapping, Sequence
+from typing import Optional
+
+from benchmarks import results
+from benchmarks.pipeline import load_events
+from benchmarks.replay import DEFAULT_SOURCES
+from models import facebook
+
+NAME = "parsing"  # results stored to benchmarks/results/parsing.jsonl
+
+
+def fastapi(body: bytes):
+    """A `data: facebook.Event` body parameter: `await request.json()`, then validated."""
+    return facebook.Event.model_validate(json.loads(body))
+
+
+def full(body: bytes):
+    return facebook.Event.model_validate_json(body)
+
+
+def webhook(body: bytes):
+    """The ingest path of POST /webhook."""
+    return facebook.WebhookEvent.model_validate_json(body)
+
+
+PARSERS = {"fastapi": fastapi, "full": full, "webhook": webhook}
+
+
+def measure(parse: Callable, bodies: Sequence[bytes], repeat: int) -> float:
+    """Events parsed per second."""
+    started = time.perf_counter()
+    for n in range(repeat):
+        parse(bodies[n % len(bodies)])
+    elapsed = time.perf_counter() - started
+    return round(repeat / elapsed)
+
+
+def run(args: argparse.Namespace) -> Mapping:
+    # compact, as Facebook posts them
+    bodies = [
+        json.dumps(event, separators=(",", ":")).encode()
+        for event in load_events(args.sources or DEFAULT_SOURCES[:1])
+    ]
+    runs = [
+        {"parser": name, "events_per_s": measure(parse, bodies, args.repeat)}
+        for name, parse in PARSERS.items()
+    ]
+    return {
+        "revision": results.revision(),
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "setup": {"repeat": args.repeat, "events": len(bodies)},
+        "runs": runs,
+    }
+
+
+def __report(run: Mapping, previous: Optional[Mapping]):
+    baseline = {
+        before["parser"]: before["events_per_s"]
+        for before in (previous or {}).get("runs", [])
+    }
+    reference = run["runs"][0]["events_per_s"]
+    print(
+        f"{'parser':<8} {'events/s':>10} {'us/event':>9} {'speedup':>8} {'before':>10}"
+    )
+    for parser in run["runs"]:
+        rate = parser["events_per_s"]
+        print(
+            f"{parser['parser']:<8} {rate:>10} {1e6 / rate:>9.1f} "
+            f"{rate / reference:>7.2f}x {baseline.get(parser['parser'], '')!s:>10}"
+        )
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.parsing", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        help="capture journals or test data files (default: unittests/data/facebook events)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20000, help="events parsed per parser"
+    )
+    parser.add_argument(
+        "--no-save",
+        action="store_true",
+        help="don't append the results to benchmarks/results",
+    )
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    __report(result, results.previous(NAME, result["setup"]))
+    if not args.no_save:
+        results.save(NAME, result)
+
+
+if __name__ == "__main__":
+    main()
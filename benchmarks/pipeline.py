@@ -0,0 +1,222 @@
+"""
+benchmarks.pipeline.py
+~~~~~~~~~~~~~~~~~~~~~~
+The API booted in-process against the local upstreams, and the payloads & statistics of the load tools.
+"""
+import asyncio
+import contextlib
+import copy
+import json
+import time
+from collections.abc import AsyncIterator, Iterable, Iterator, Mapping, Sequence
+from pathlib import Path
+from typing import Optional
+from unittest import mock
+
+import httpx
+import numpy as np
+
+from api import capture, datastore, jobqueue, main, utils
+from benchmarks.fakes import FakeUpstreams
+
+REGISTRATION_REPLY = "New user detected"  # replies of handle_fb_user, not of a message
+
+
+@contextlib.contextmanager
+def configured(
+    directory: Path, graph_url: str, use_mongomock: bool = False
+) -> Iterator[None]:
+    """Configure the API to keep its voices & job queue under `directory` and to call the Graph API
+    at `graph_url`. Mongo is MONGO_CONN_STR, or mongomock. Capture is off.
+    The database is never cleared: point MONGO_CONN_STR to a scratch database.
+    """
+    directory = Path(directory)
+    with contextlib.ExitStack() as patches:
+        for module, name, value in (
+            (datastore, "VOICES_DIR", directory / "voices"),
+            (jobqueue, "QUEUE_PATH", directory / "jobs.sqlite"),
+            (utils, "FB_GRAPH_API", graph_url),
+            (main, "STARTUP_MODE", "production"),
+            (capture, "CAPTURE_PATH", None),
+        ):
+            patches.enter_context(mock.patch.object(module, name, value))
+        if use_mongomock:
+            import mongomock
+
+            client = mongomock.MongoClient()
+            patches.enter_context(
+                mock.patch.object(
+                    datastore,
+                    "startup",
+                    lambda: datastore.GLOBAL.update(db_client=client),
+                )
+            )
+        yield
+
+
+@contextlib.asynccontextmanager
+async def pipeline(
+    directory: Path, upstreams: FakeUpstreams, use_mongomock: bool = False
+) -> AsyncIterator[httpx.AsyncClient]:
+    """Boot api.main.APP in-process, configured for `directory` and `upstreams` (see configured),
+    and yield a client of it."""
+    with configured(directory, upstreams.graph_url, use_mongomock):
+        async with main.lifespan(main.APP):
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=main.APP),
+                base_url="http://bench",
+                timeout=60,
+            ) as client:
+                yield client
+
+
+async def drain(timeout: float = 300.0) -> bool:
+    """Wait for the job queue to process every job. Return False on timeout."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        counts = await asyncio.to_thread(jobqueue.queue().counts)
+        if counts[jobqueue.RUNNING] + counts[jobqueue.PENDING] == 0:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def load_events(paths: Iterable[Path]) -> Sequence[Mapping]:
+    """Load the webhook events of capture journals (JSON lines) and of test data files
+    (`{"valid": [...]}` of events, messagings or messages, wrapped into events)."""
+    events = []
+    for path in paths:
+        text = Path(path).read_text()
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            events.extend(json.loads(line) for line in text.splitlines() if line)
+            continue
+        for item in data["valid"] if isinstance(data, Mapping) else data:
+            if "mid" in item:  # a message
+                item = {
+                    "sender": {"id": "bench"},
+                    "recipient": {"id": "page"},
+                    "timestamp": 0,
+                    "message": item,
+                }
+            if "sender" in item:  # a messaging
+                item = {
+                    "object": "page",
+                    "entry": [{"id": "page", "time": 0, "messaging": [item]}],
+                }
+            events.append(item)
+    return events
+
+
+def synthesize(
+    events: Sequence[Mapping],
+    count: int,
+    upstreams: FakeUpstreams,
+    senders: Optional[int] = None,
+    attachments: Optional[int] = None,
+) -> Sequence[Mapping]:
+    """`count` events cycling through `events`, made unique by `.n` suffixed message ids.
+    Args:
+    upstreams -- serving the audio attachments, whose urls are rewritten
+    senders -- spread the messages over this many sender ids, keep the senders if None
+    attachments -- replace the attachments of every message by this many audios, keep them if None
+    """
+    synthesized = []
+    for n in range(count):
+        event = copy.deepcopy(events[n % len(events)])
+        for entry in event.get("entry") or []:
+            for messaging in entry.get("messaging", []):
+                message = messaging["message"]
+                message["mid"] = f"{message['mid']}.{n}"
+                if senders:
+                    messaging["sender"]["id"] = f"bench-{n % senders}"
+                if attachments is not None:
+                    message["attachments"] = [{"type": "audio"}] * attachments or None
+                for i, attachment in enumerate(message.get("attachments") or []):
+                    if attachment.get("type") == "audio":
+                        url = upstreams.cdn_url(f"{message['mid']}-{i}")
+                        message["attachments"][i] = {
+                            "type": "audio",
+                            "payload": {"url": url},
+                        }
+        synthesized.append(event)
+    return synthesized
+
+
+def synthetic_event(
+    n: int, upstreams: FakeUpstreams, sender: str, attachments: int = 1
+) -> Mapping:
+    """The n-th synthetic event: a message of the sender with `attachments` audios, or a text."""
+    mid = f"m_bench.{n}"
+    message = {"mid": mid, "text": "bench"}
+    if attachments:
+        message["attachments"] = [
+            {"type": "audio", "payload": {"url": upstreams.cdn_url(f"{mid}-{i}")}}
+            for i in range(attachments)
+        ]
+    return {
+        "object": "page",
+        "entry": [
+            {
+                "id": "page",
+                "time": 0,
+                "messaging": [
+                    {
+                        "sender": {"id": sender},
+                        "recipient": {"id": "page"},
+                        "timestamp": 0,
+                        "message": message,
+                    }
+                ],
+            }
+        ],
+    }
+
+
+def senders_of(event: Mapping) -> Sequence[str]:
+    """Sender id of every messaging of the event, in order."""
+    return [
+        str(messaging["sender"]["id"])
+        for entry in event.get("entry") or []
+        for messaging in entry.get("messaging", [])
+    ]
+
+
+def processing_latencies(
+    sent: Sequence[tuple[Mapping, float]], replies: Sequence[tuple[str, str, float]]
+) -> Sequence[float]:
+    """Seconds from sending each messaging to the reply to it.
+
+    The messages of a sender are processed in order, so its k-th reply answers its k-th message
+    (approximately: messages of a sender sent at once may be admitted in another order).
+    Args:
+    sent -- the acknowledged events and when they were sent (time.perf_counter)
+    replies -- the replies recorded by FakeUpstreams
+    """
+    sent_at = {}
+    for event, at in sorted(sent, key=lambda item: item[1]):
+        for sender in senders_of(event):
+            sent_at.setdefault(sender, []).append(at)
+    replied_at = {}
+    for recipient, text, at in sorted(replies, key=lambda reply: reply[2]):
+        if not text.startswith(REGISTRATION_REPLY):
+            replied_at.setdefault(recipient, []).append(at)
+    return [
+        reply - send
+        for sender, sends in sent_at.items()
+        for send, reply in zip(sends, replied_at.get(sender, []))
+    ]
+
+
+def percentiles(seconds: Sequence[float]) -> Mapping[str, Optional[float]]:
+    """p50, p95, p99 and max of the durations, in milliseconds."""
+    if not len(seconds):
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    p50, p95, p99, top = np.percentile(np.asarray(seconds) * 1000, (50, 95, 99, 100))
+    return {
+        "p50": round(float(p50), 2),
+        "p95": round(float(p95), 2),
+        "p99": round(float(p99), 2),
+        "max": round(float(top), 2),
+    }
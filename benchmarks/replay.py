@@ -0,0 +1,156 @@
+"""
+benchmarks.replay.py
+~~~~~~~~~~~~~~~~~~~~
+Replay captured webhook events, or the test data, into the ingestion pipeline and report its throughput
+and latencies. The Graph API and CDN are local stand-ins (see benchmarks.fakes).
+
+    python -m benchmarks.replay events.jsonl events.jsonl.1 --count 2000 --rate 200 --mongomock
+"""
+import argparse
+import asyncio
+import json
+import logging
+import tempfile
+import time
+from collections import Counter
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+from benchmarks.fakes import FakeUpstreams
+from benchmarks.pipeline import (
+    drain,
+    load_events,
+    percentiles,
+    pipeline,
+    processing_latencies,
+    senders_of,
+    synthesize,
+)
+
+TEST_DATA = Path(__file__).joinpath("..").resolve().parent / "unittests" / "data"
+DEFAULT_SOURCES = [
+    TEST_DATA / "facebook" / "event_data.json",
+    TEST_DATA / "facebook" / "messaging_data.json",
+]
+
+
+async def replay(
+    client: httpx.AsyncClient,
+    events: Sequence[Mapping],
+    rate: Optional[float] = None,
+    concurrency: int = 64,
+) -> tuple[Sequence[tuple[Mapping, float]], Counter, Sequence[float]]:
+    """POST the events to /webhook, `rate` per second or as fast as possible if None,
+    at most `concurrency` at once.
+
+    Returns:
+    The acknowledged events with when they were sent, the count of every status code,
+    and the seconds every request took.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    acknowledged, statuses, durations = [], Counter(), []
+    start = time.perf_counter()
+
+    async def send(i: int, event: Mapping):
+        if rate:
+            await asyncio.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        async with semaphore:
+            sent_at = time.perf_counter()
+            response = await client.post("/webhook", json=event)
+            durations.append(time.perf_counter() - sent_at)
+        statuses[response.status_code] += 1
+        if response.status_code == 200:
+            acknowledged.append((event, sent_at))
+
+    await asyncio.gather(*(send(i, event) for i, event in enumerate(events)))
+    return acknowledged, statuses, durations
+
+
+async def run(args: argparse.Namespace) -> Mapping:
+    """Replay the events as configured by the command line, and report."""
+    with FakeUpstreams(args.latency, args.audio_seconds) as upstreams:
+        events = synthesize(
+            load_events(args.sources or DEFAULT_SOURCES),
+            args.count,
+            upstreams,
+            senders=args.senders,
+            attachments=args.attachments,
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            async with pipeline(directory, upstreams, args.mongomock) as client:
+                started = time.perf_counter()
+                acknowledged, statuses, durations = await replay(
+                    client, events, args.rate, args.concurrency
+                )
+                sent = time.perf_counter()
+                drained = await drain(args.timeout)
+                finished = time.perf_counter()
+
+    processing = processing_latencies(acknowledged, upstreams.replies)
+    return {
+        "events": len(events),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "acknowledged_per_second": round(len(acknowledged) / (sent - started), 1),
+        "acknowledgement_ms": percentiles(durations),
+        "messages": sum(len(senders_of(event)) for event, _ in acknowledged),
+        "replied": len(processing),
+        "drained": drained,
+        "replied_per_second": round(len(processing) / (finished - started), 1),
+        "processing_ms": percentiles(processing),
+    }
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.replay", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        type=Path,
+        help="capture journals or test data files (default: unittests/data/facebook events & messagings)",
+    )
+    parser.add_argument("--count", type=int, default=1000, help="events to send")
+    parser.add_argument(
+        "--rate", type=float, help="events per second (default: as fast as possible)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=64, help="requests in flight at most"
+    )
+    parser.add_argument(
+        "--senders", type=int, help="spread the events over this many senders"
+    )
+    parser.add_argument(
+        "--attachments",
+        type=int,
+        help="audio attachments per message, replacing the captured ones",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds the upstreams take to answer",
+    )
+    parser.add_argument(
+        "--audio-seconds", type=float, default=2.0, help="duration of the audios served"
+    )
+    parser.add_argument(
+        "--mongomock", action="store_true", help="mongomock instead of MONGO_CONN_STR"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300.0,
+        help="seconds to wait for the processing",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+benchmarks.results.py
+~~~~~~~~~~~~~~~~~~~~~
+The stored runs of the benchmarks: JSON lines under benchmarks/results/, one file per benchmark,
+each run tagged with the git revision it measured.
+"""
+import json
+import subprocess
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Optional
+
+ROOT = Path(__file__).joinpath("..").resolve().parent
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+
+
+def path(name: str) -> Path:
+    """The results file of the benchmark."""
+    return RESULTS_DIR / f"{name}.jsonl"
+
+
+def revision() -> str:
+    """The git revision benchmarked, `+dirty` suffixed if the tree has changes."""
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        return f"{revision}+dirty" if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous(name: str, setup: Mapping) -> Optional[Mapping]:
+    """The last stored run of the benchmark with the same setup."""
+    results = path(name)
+    if not results.exists():
+        return None
+    runs = [json.loads(line) for line in results.read_text().splitlines() if line]
+    same = [run for run in runs if run["setup"] == setup]
+    return same[-1] if same else None
+
+
+def save(name: str, run: Mapping):
+    """Append the run to the results of the benchmark."""
+    results = path(name)
+    results.parent.mkdir(parents=True, exist_ok=True)
+    with open(results, "a") as file:
+        file.write(json.dumps(run) + "\n")
@@ -0,0 +1,31 @@
+"""
+benchmarks.server.py
+~~~~~~~~~~~~~~~~~~~~
+Serve api.main.APP with uvicorn, configured for a benchmark (see benchmarks.pipeline.configured).
+
+    python -m benchmarks.server --port 8000 --directory /tmp/bench --graph-url http://127.0.0.1:9000/graph
+"""
+import argparse
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional
+
+import uvicorn
+
+from api import main as api_main
+from benchmarks.pipeline import configured
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.server")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--directory", type=Path, required=True)
+    parser.add_argument("--graph-url", required=True)
+    parser.add_argument("--mongomock", action="store_true")
+    args = parser.parse_args(argv)
+    with configured(args.directory, args.graph_url, args.mongomock):
+        uvicorn.run(api_main.APP, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
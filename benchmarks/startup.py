@@ -0,0 +1,199 @@
+"""
+benchmarks.startup.py
+~~~~~~~~~~~~~~~~~~~~~
+Cold start of the API: the import time of api.main, and for a fresh `uvicorn api.main:APP` process the time
+until it answers, the latency of its first webhook request, and the time until it is ready (datastore
+connected) and warm (deferred imports done). Medians over several runs, in milliseconds.
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import datetime
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Mapping, Sequence
+from typing import Optional
+
+import httpx
+
+from benchmarks import results
+
+NAME = "startup"  # results stored to benchmarks/results/startup.jsonl
+READY_TIMEOUT = 30.0  # seconds for a server to boot
+# A text message: its job fails fast against the closed Graph API port, and is left queued
+EVENT = {
+    "object": "page",
+    "entry": [
+        {
+            "id": "page",
+            "time": 0,
+            "messaging": [
+                {
+                    "sender": {"id": "bench"},
+                    "recipient": {"id": "page"},
+                    "timestamp": 0,
+                    "message": {"mid": "m_bench.startup", "text": "bench"},
+                }
+            ],
+        }
+    ],
+}
+IMPORT = "import time; started = time.perf_counter(); {}; print(time.perf_counter() - started)"
+
+
+def __free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def import_ms(statement: str, preload: str = "pass") -> float:
+    """Milliseconds to run the import statement in a fresh interpreter, after the preload."""
+    output = subprocess.run(
+        [sys.executable, "-c", f"{preload}; {IMPORT.format(statement)}"],
+        cwd=results.ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return float(output) * 1000
+
+
+def boot(args: argparse.Namespace) -> Mapping[str, Optional[float]]:
+    """Boot a server and time its first responses, in milliseconds since its process started."""
+    port = __free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "STARTUP_MODE": "production",
+            "JOB_QUEUE_PATH": os.path.join(directory, "jobs.sqlite"),
+            "MONGO_DATABASE": "sounds_benchmark",
+            "FB_GRAPH_API": "http://127.0.0.1:9",
+        }
+        env.pop("WEBHOOK_CAPTURE_PATH", None)
+        started = time.perf_counter()
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "api.main:APP",
+                f"--port={port}",
+                "--log-level=warning",
+            ],
+            cwd=results.ROOT,
+            env=env,
+            stderr=None if args.server_logs else subprocess.DEVNULL,
+        )
+        timings = {"answer": None, "first_request": None, "ready": None, "warm": None}
+        try:
+            with httpx.Client(base_url=f"http://127.0.0.1:{port}") as client:
+                deadline = started + READY_TIMEOUT
+                while timings["answer"] is None:
+                    if server.poll() is not None or time.perf_counter() > deadline:
+                        raise RuntimeError("The server didn't boot, see --server-logs.")
+                    try:
+                        client.get("/ready")
+                        timings["answer"] = time.perf_counter() - started
+                    except httpx.TransportError:
+                        time.sleep(0.005)
+
+                sent = time.perf_counter()
+                client.post("/webhook", json=EVENT).raise_for_status()
+                timings["first_request"] = time.perf_counter() - sent
+
+                deadline = time.perf_counter() + args.ready_timeout
+                while time.perf_counter() < deadline and not timings["warm"]:
+                    readiness = client.get("/ready").json()
+                    now = time.perf_counter() - started
+                    if readiness["ready"] and timings["ready"] is None:
+                        timings["ready"] = now
+                    if readiness["warm"]:
+                        timings["warm"] = now
+                    time.sleep(0.005)
+        finally:
+            server.terminate()
+            server.wait()
+    return {
+        name: None if seconds is None else round(seconds * 1000, 1)
+        for name, seconds in timings.items()
+    }
+
+
+def __median(values: Sequence[Optional[float]]) -> Optional[float]:
+    values = [value for value in values if value is not None]
+    return round(statistics.median(values), 1) if values else None
+
+
+def run(args: argparse.Namespace) -> Mapping:
+    imports = {
+        "import_ms": __median([import_ms("import api.main") for _ in range(args.runs)]),
+        # the API's own share, FastAPI & pydantic being imported by any app
+        "app_import_ms": __median(
+            [
+                import_ms(
+                    "import api.main",
+                    preload="import fastapi, fastapi.responses, pydantic",
+                )
+                for _ in range(args.runs)
+            ]
+        ),
+    }
+    boots = [boot(args) for _ in range(args.runs)]
+    return {
+        "revision": results.revision(),
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "setup": {"runs": args.runs},
+        "startup": {
+            **imports,
+            **{
+                f"{name}_ms": __median([timings[name] for timings in boots])
+                for name in boots[0]
+            },
+        },
+    }
+
+
+def __report(run: Mapping, previous: Optional[Mapping]):
+    before = (previous or {}).get("startup", {})
+    print(f"{'milliseconds':<18} {'median':>8} {'before':>8}")
+    for name, value in run["startup"].items():
+        print(f"{name:<18} {value!s:>8} {before.get(name, '')!s:>8}")
+    if run["startup"]["ready_ms"] is None:
+        print("Never ready: is Mongo up at MONGO_CONN_STR?")
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.startup", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--ready-timeout",
+        type=float,
+        default=10.0,
+        help="seconds to wait for a server to be ready & warm once answering",
+    )
+    parser.add_argument(
+        "--server-logs", action="store_true", help="show the warnings of the servers"
+    )
+    parser.add_argument(
+        "--no-save",
+        action="store_true",
+        help="don't append the results to benchmarks/results",
+    )
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    __report(result, results.previous(NAME, result["setup"]))
+    if not args.no_save:
+        results.save(NAME, result)
+
+
+if __name__ == "__main__":
+    main()
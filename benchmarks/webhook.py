@@ -0,0 +1,234 @@
+"""
+benchmarks.webhook.py
+~~~~~~~~~~~~~~~~~~~~~
+End-to-end throughput of POST /webhook at increasing concurrency, against local stand-ins of the Graph API & CDN.
+Every level boots a fresh server process, so its CPU time and peak RSS are the API's alone. Results are appended
+to benchmarks/results/webhook.jsonl with the git revision, and compared with the previous run of the same setup.
+
+    python -m benchmarks.webhook --concurrency 1 8 32 --duration 10 --audio-seconds 2 --mongomock
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+from api import jobqueue
+from benchmarks import results
+from benchmarks.fakes import FakeUpstreams
+from benchmarks.pipeline import percentiles, processing_latencies, synthetic_event
+
+NAME = "webhook"  # results stored to benchmarks/results/webhook.jsonl
+READY_TIMEOUT = 30.0  # seconds for a server to boot
+
+
+def __free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def __wait_ready(client: httpx.AsyncClient, server: subprocess.Popen):
+    deadline = time.perf_counter() + READY_TIMEOUT
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("The server exited while booting, see --server-logs.")
+        try:
+            if (await client.get("/metrics")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise TimeoutError("The server didn't boot in time.")
+
+
+async def __drain(queue: jobqueue.JobQueue, timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        counts = await asyncio.to_thread(queue.counts)
+        if counts[jobqueue.RUNNING] + counts[jobqueue.PENDING] == 0:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def measure(
+    concurrency: int, upstreams: FakeUpstreams, args: argparse.Namespace
+) -> Mapping:
+    """Drive a fresh server with `concurrency` clients posting events for `args.duration` seconds,
+    wait for the processing, and measure."""
+    port = __free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        command = [
+            sys.executable,
+            "-m",
+            "benchmarks.server",
+            f"--port={port}",
+            f"--directory={directory}",
+            f"--graph-url={upstreams.graph_url}",
+        ]
+        if args.mongomock:
+            command.append("--mongomock")
+        server = subprocess.Popen(
+            command,
+            cwd=results.ROOT,
+            stderr=None if args.server_logs else subprocess.DEVNULL,
+        )
+        try:
+            async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{port}", timeout=60
+            ) as client:
+                await __wait_ready(client, server)
+                counter = itertools.count()
+                acknowledged, statuses, durations = [], Counter(), []
+                started = time.perf_counter()
+
+                async def worker():
+                    while time.perf_counter() - started < args.duration:
+                        n = next(counter)
+                        event = synthetic_event(
+                            n,
+                            upstreams,
+                            sender=f"bench-{concurrency}-{n % args.senders}",
+                            attachments=args.attachments,
+                        )
+                        sent_at = time.perf_counter()
+                        response = await client.post("/webhook", json=event)
+                        durations.append(time.perf_counter() - sent_at)
+                        statuses[response.status_code] += 1
+                        if response.status_code == 200:
+                            acknowledged.append((event, sent_at))
+
+                await asyncio.gather(*(worker() for _ in range(concurrency)))
+                sent = time.perf_counter()
+                queue = jobqueue.JobQueue(Path(directory) / "jobs.sqlite")
+                drained = await __drain(queue, args.timeout)
+                finished = time.perf_counter()
+                queue.close()
+        finally:
+            server.send_signal(signal.SIGINT)
+            _, status, usage = await asyncio.to_thread(os.wait4, server.pid, 0)
+            server.returncode = os.waitstatus_to_exitcode(status)
+
+    replies = [reply for reply in upstreams.replies if reply[2] >= started]
+    processing = processing_latencies(acknowledged, replies)
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    return {
+        "concurrency": concurrency,
+        "requests": sum(statuses.values()),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "requests_per_second": round(sum(statuses.values()) / (sent - started), 1),
+        "latency_ms": percentiles(durations),
+        "drained": drained,
+        "messages_per_second": round(len(processing) / (finished - started), 1),
+        "processing_ms": percentiles(processing),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_ms_per_message": (
+            round(cpu_seconds * 1000 / len(processing), 2) if processing else None
+        ),
+        # kilobytes on Linux
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+    }
+
+
+def __report(run: Mapping, previous: Optional[Mapping]):
+    baseline = {
+        level["concurrency"]: level for level in (previous or {}).get("levels", [])
+    }
+    print(
+        f"{'conc':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'msg/s':>7} {'proc p95':>9} {'cpu ms/msg':>10} {'rss MB':>7}"
+    )
+    for level in run["levels"]:
+        print(
+            f"{level['concurrency']:>5} {level['requests_per_second']:>8} "
+            f"{level['latency_ms']['p50']!s:>8} {level['latency_ms']['p95']!s:>8} "
+            f"{level['latency_ms']['p99']!s:>8} {level['messages_per_second']:>7} "
+            f"{level['processing_ms']['p95']!s:>9} {level['cpu_ms_per_message']!s:>10} "
+            f"{level['peak_rss_mb']:>7}"
+        )
+        before = baseline.get(level["concurrency"])
+        if before and before["requests_per_second"]:
+            change = level["requests_per_second"] / before["requests_per_second"] - 1
+            print(
+                f"{'':>5} {change:>+8.1%} vs {previous['revision']}, "
+                f"p95 {before['latency_ms']['p95']} ms before"
+            )
+
+
+async def run(args: argparse.Namespace) -> Mapping:
+    with FakeUpstreams(args.latency, args.audio_seconds) as upstreams:
+        levels = [await measure(c, upstreams, args) for c in args.concurrency]
+    return {
+        "revision": results.revision(),
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "setup": {
+            "duration": args.duration,
+            "attachments": args.attachments,
+            "senders": args.senders,
+            "latency": args.latency,
+            "audio_seconds": args.audio_seconds,
+            "mongo": "mongomock" if args.mongomock else "mongod",
+        },
+        "levels": levels,
+    }
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.webhook", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="seconds of load per level"
+    )
+    parser.add_argument(
+        "--attachments", type=int, default=1, help="audios per message, 0 for texts"
+    )
+    parser.add_argument("--senders", type=int, default=1000)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds the upstreams take to answer",
+    )
+    parser.add_argument("--audio-seconds", type=float, default=2.0)
+    parser.add_argument(
+        "--mongomock", action="store_true", help="mongomock instead of MONGO_CONN_STR"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300.0,
+        help="seconds to wait for the processing",
+    )
+    parser.add_argument(
+        "--server-logs", action="store_true", help="show the warnings of the servers"
+    )
+    parser.add_argument(
+        "--no-save",
+        action="store_true",
+        help="don't append the results to benchmarks/results",
+    )
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    __report(result, results.previous(NAME, result["setup"]))
+    if not args.no_save:
+        results.save(NAME, result)
+
+
+if __name__ == "__main__":
+    main()
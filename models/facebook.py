@@ -9,10 +9,16 @@ from collections.abc import Mapping, Sequence
 from enum import Enum
 from typing import Optional, Union
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 
 
-class AttachmentPayload(BaseModel):
+class Model(BaseModel):
+    """Base model, its validator built on first use rather than at import"""
+
+    model_config = ConfigDict(defer_build=True)
+
+
+class AttachmentPayload(Model):
     """Attachment's payload model"""
 
     url: str = None
@@ -28,14 +34,14 @@ class AttachmentType(Enum):
     VIDEO = "video"
 
 
-class Attachment(BaseModel):
+class Attachment(Model):
     """Message's attachement model"""
 
     type: AttachmentType
     payload: AttachmentPayload
 
 
-class Message(BaseModel):
+class Message(Model):
     """Message model"""
 
     mid: str
@@ -45,13 +51,13 @@ class Message(BaseModel):
     attachments: Optional[Sequence[Attachment]] = None
 
 
-class User(BaseModel):
+class User(Model):
     """User model"""
 
     id: Union[str, int]
 
 
-class Messaging(BaseModel):
+class Messaging(Model):
     """Messaging object"""
 
     sender: User
@@ -60,7 +66,7 @@ class Messaging(BaseModel):
     message: Message
 
 
-class MessageEvent(BaseModel):
+class MessageEvent(Model):
     """MessageEvent models in webhook event."""
 
     id: str
@@ -68,7 +74,7 @@ class MessageEvent(BaseModel):
     messaging: Sequence[Messaging]
 
 
-class Event(BaseModel):
+class Event(Model):
     """Webhook event model"""
 
     object: str = Field(examples=["page"])
@@ -82,19 +88,64 @@ class Event(BaseModel):
         raise ValueError("object must be page")
 
 
+"""
+Ingest models of the webhook: only the fields the processing reads, validated straight from the request
+bytes by `WebhookEvent.model_validate_json`. The others are skipped, as any unknown field.
+Their validators are built at import, ready for the first request.
+"""
+
+
+class WebhookMessage(BaseModel):
+    """Message model of the ingest path"""
+
+    mid: str
+    attachments: Optional[list[Attachment]] = None
+
+
+class WebhookMessaging(BaseModel):
+    """Messaging model of the ingest path"""
+
+    sender: User
+    recipient: User
+    timestamp: int
+    message: WebhookMessage
+
+
+class WebhookMessageEvent(BaseModel):
+    """MessageEvent model of the ingest path"""
+
+    id: str
+    time: int
+    messaging: list[WebhookMessaging]
+
+
+class WebhookEvent(BaseModel):
+    """Webhook event model of the ingest path"""
+
+    object: str
+    entry: Optional[list[WebhookMessageEvent]] = None
+
+    @field_validator("object")
+    @classmethod
+    def object_must_be_page(cls, value):
+        if value == "page":
+            return value
+        raise ValueError("object must be page")
+
+
 """ 
 Models based on Send API
 https://developers.facebook.com/docs/messenger-platform/reference/send-api
 """
 
 
-class ResponseMessage(BaseModel):
+class ResponseMessage(Model):
     """ResponseMessage of Response model"""
 
     text: str
 
 
-class Response(BaseModel):
+class Response(Model):
     """Chatbot's Response model back to the Facebook sending user"""
 
     message: ResponseMessage
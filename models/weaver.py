@@ -9,20 +9,31 @@ from datetime import datetime
 from enum import Enum
 from typing import Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
-class VoiceMetadata(BaseModel):
+class Model(BaseModel):
+    """Base model, its validator built on first use rather than at import"""
+
+    model_config = ConfigDict(defer_build=True)
+
+
+class VoiceMetadata(Model):
     """Metadata for the voice record stored in voices dir."""
 
     id: str = Field(alias="_id")  # unreadable index in datastore
     datetime: datetime  # date and time archived
     audio_extension: str  # audio file type/extension
     username: str  # username of the sound's owner
-    prompt_id: int  # prompt id of the sound
+    prompt_id: Optional[int]  # prompt id of the sound, None if no prompt was open
+    fingerprint_size: Optional[int] = None  # number of landmark hashes indexed
+    duplicate_of: Optional[str] = None  # archived voice this one nearly duplicates
+    trim_start: Optional[float] = None  # seconds of leading silence to skip
+    trim_end: Optional[float] = None  # seconds where the trailing silence begins
+    gain_db: Optional[float] = None  # gain normalising the loudness of the voiced part
 
 
-class User(BaseModel):
+class User(Model):
     """Users of the website. Owners of the voice records.
     Can be from multiple platforms, for now only serves FB messenger."""
 
@@ -36,7 +47,7 @@ class User(BaseModel):
     prompt_set: Sequence[int] = {}  # user's prompt participated
 
 
-class Prompt(BaseModel):
+class Prompt(Model):
     """The prompt is a question answered by user in the form of voice record."""
 
     id: int = Field(
@@ -49,28 +60,55 @@ class Prompt(BaseModel):
     user_set: Sequence[str] = {}  # usernames responding to this prompt
 
 
-class UsernameToId(BaseModel):
+class UsernameToId(Model):
     username: str = Field(alias="_id")  # Unique displayable & user-friendly identity
     id: str  # internal id
 
 
-class PromptManager(BaseModel):
+class PromptManager(Model):
     id: str = Field(alias="_id", default="manager")
     active_prompt: Optional[int] = None
     next_index: int = 0  # next index avalaible for prompt counter
     deleted_prompts: Set[int] = set()  # archived/deleted index
 
 
-class VoiceMetadataUpdate(BaseModel):
+class RollupKind(str, Enum):
+    """What the voices of a rollup are counted by"""
+
+    PROMPT = "prompt"
+    USER = "user"
+    DAY = "day"  # UTC day
+    LOCAL_DAY = "local_day"  # day in the archive's timezone
+    PROMPT_USER = "prompt_user"  # the voices of a user answering a prompt
+
+
+class Rollup(Model):
+    """Voices counted by prompt, user or day, maintained as they are archived and deleted."""
+
+    id: str = Field(alias="_id")  # <kind>/<key>, e.g. prompt/3, day/2024-01-04
+    kind: RollupKind
+    key: str
+    voices: int = 0
+    participants: Optional[int] = None  # users who answered, of a prompt rollup
+    prompt: Optional[int] = None  # of a prompt_user rollup
+    user: Optional[str] = None  # of a prompt_user rollup
+
+
+class VoiceMetadataUpdate(Model):
     """Metadata update model"""
 
     datetime: Optional[datetime] = None  # date and time archived
     audio_extension: Optional[str] = None  # audio file type/extension
     username: Optional[str] = None  # username of the sound's owner
     prompt_id: Optional[int] = None  # prompt id of the sound
+    fingerprint_size: Optional[int] = None  # number of landmark hashes indexed
+    duplicate_of: Optional[str] = None  # archived voice this one nearly duplicates
+    trim_start: Optional[float] = None  # seconds of leading silence to skip
+    trim_end: Optional[float] = None  # seconds where the trailing silence begins
+    gain_db: Optional[float] = None  # gain normalising the loudness of the voiced part
 
 
-class UserUpdate(BaseModel):
+class UserUpdate(Model):
     """User Update model"""
 
     username: Optional[str] = None  # unique & displayable user id on the website
@@ -80,7 +118,7 @@ class UserUpdate(BaseModel):
     prompt_set: Optional[Sequence[int]] = None  # user's prompt participated
 
 
-class PromptUpdate(BaseModel):
+class PromptUpdate(Model):
     """Prompt update model"""
 
     begins: Optional[datetime] = None  # prompt begin date
@@ -90,13 +128,13 @@ class PromptUpdate(BaseModel):
     user_set: Optional[Sequence[str]] = None  # usernames responding to this prompt
 
 
-class UsernameToIdUpdate(BaseModel):
+class UsernameToIdUpdate(Model):
     """UsernameToId Update model"""
 
     id: Optional[str] = None  # internal id
 
 
-class PromptManagerUpdate(BaseModel):
+class PromptManagerUpdate(Model):
     """Prompt manager update model"""
 
     active_prompt: Optional[int] = None
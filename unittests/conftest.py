@@ -3,14 +3,17 @@ tests.conftest.py
 ~~~~~~~~~~~~~~~~~
 Test fixture for the unit test suite. All test fixture defined in conftest MUST have the word `fixture`.
 """
+import io
 import json
+import wave
 from pathlib import Path
 
+import numpy as np
 import pytest
 import yaml
 from fastapi.testclient import TestClient
 
-from api import main, utils
+from api import audio, main, resilience, utils
 
 ROOT = Path(__file__).joinpath("..").joinpath("..").resolve()
 TEST_DATA_PATH = ROOT / "unittests" / "data"
@@ -22,6 +25,30 @@ def api_client_fixture():
     return TestClient(main.APP)
 
 
+@pytest.fixture(autouse=True)
+def resilience_fixture(monkeypatch):
+    """Close the upstream circuits before every test, and retry without backing off."""
+    resilience.reset()
+    monkeypatch.setattr(resilience, "BACKOFF_BASE", 0)
+
+
+@pytest.fixture(scope="session")
+def test_fixture_make_wav():
+    """Factory encoding float samples in [-1, 1] (shape (n,) or (n, channels)) to 16-bit WAV bytes."""
+
+    def make_wav(samples: np.ndarray, rate: int = audio.SAMPLE_RATE) -> bytes:
+        samples = np.asarray(samples, dtype=np.float32).reshape(len(samples), -1)
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(samples.shape[1])
+            wav.setsampwidth(2)
+            wav.setframerate(rate)
+            wav.writeframes((samples * 32767).astype("<i2").tobytes())
+        return buffer.getvalue()
+
+    return make_wav
+
+
 # ================================= Facebook Test data begins.
 
 FACEBOOK_TEST_DATA_PATH = TEST_DATA_PATH / "facebook"
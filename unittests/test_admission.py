@@ -0,0 +1,42 @@
+"""
+unittests.test_admission.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.admission
+"""
+import pytest
+
+from api import admission
+
+
+def test_attachments_leave_reserved_capacity_to_cheap_events():
+    controller = admission.AdmissionController(capacity=3, reserved=1)
+    assert controller.try_acquire(admission.ATTACHMENT)
+    assert controller.try_acquire(admission.ATTACHMENT)
+    assert not controller.try_acquire(admission.ATTACHMENT)
+    assert controller.try_acquire(admission.CHEAP)
+    assert not controller.try_acquire(admission.CHEAP)
+    assert controller.in_flight == 3
+
+    controller.release(admission.ATTACHMENT)
+    assert controller.try_acquire(admission.CHEAP)
+
+
+def test_outcomes_are_counted():
+    controller = admission.AdmissionController(capacity=1, reserved=0)
+    accepted = admission.EVENTS.value(kind=admission.CHEAP, outcome="accepted")
+    rejected = admission.EVENTS.value(kind=admission.CHEAP, outcome="rejected")
+    controller.try_acquire(admission.CHEAP)
+    controller.try_acquire(admission.CHEAP)
+    controller.release(admission.CHEAP)
+
+    assert admission.EVENTS.value(kind=admission.CHEAP, outcome="accepted") == (
+        accepted + 1
+    )
+    assert admission.EVENTS.value(kind=admission.CHEAP, outcome="rejected") == (
+        rejected + 1
+    )
+
+
+def test_reserved_capacity_must_be_below_capacity():
+    with pytest.raises(ValueError):
+        admission.AdmissionController(capacity=2, reserved=2)
@@ -4,9 +4,24 @@ tests.test_api.py
 Test api calls
 """
 
+import asyncio
+import json
+import marshal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pymongo
 import pytest
+import requests
+from fastapi.testclient import TestClient
 
 import api
+from api import audio
+from models import facebook, weaver
 
 
 def test_client(api_client_fixture):
@@ -18,22 +33,136 @@ def _auto_mock_datastore(mocker):
     mocker.patch("api.datastore.startup")
     mocker.patch("api.datastore.clearall")
     mocker.patch("api.datastore.clearvoices")
+    mocker.patch("api.datastore.initialize")
+    mocker.patch("api.datastore.build_user_filters")
+    mocker.patch("api.datastore.load_prompts")
     mocker.patch("api.datastore.shutdown")
 
 
+@pytest.fixture(autouse=True)
+def _datastore_ready(monkeypatch):
+    monkeypatch.setitem(api.main.READINESS, "datastore", True)
+
+
+@pytest.fixture(autouse=True)
+def _jobs(mocker, monkeypatch, tmp_path):
+    """Queue jobs under tmp_path and process them on one shard, drained before unpatching."""
+    monkeypatch.setattr(api.jobqueue, "QUEUE_PATH", tmp_path / "jobs.sqlite")
+    monkeypatch.setattr(
+        api.sharding, "SHARDS", api.sharding.ShardedExecutor(shards=1, max_depth=8)
+    )
+    yield api.jobqueue
+    _drain()
+
+
+def _drain():
+    """Wait for the jobs submitted so far to be processed."""
+    api.sharding.SHARDS.submit("", lambda: None).result()
+
+
 def test_lifespan(api_client_fixture, mocker):
     """Test app's startup and shutdown lifespan events."""
     on_startup = mocker.patch("api.datastore.startup")
     on_shutdown = mocker.patch("api.datastore.shutdown")
+    on_clearall = mocker.patch("api.datastore.clearall")
+    on_initialize = mocker.patch("api.datastore.initialize")
+    on_build_user_filters = mocker.patch("api.datastore.build_user_filters")
 
     with api_client_fixture:
         # After startup
         on_startup.assert_called_once()
+        on_clearall.assert_called_once()  # development mode by default
+        on_initialize.assert_called_once()
+        on_build_user_filters.assert_called_once()
 
     # After shutdown
     on_shutdown.assert_called_once()
 
 
+def test_lifespan_production_keeps_data(api_client_fixture, mocker, monkeypatch):
+    monkeypatch.setattr(api.main, "STARTUP_MODE", "production")
+    on_clearall = mocker.patch("api.datastore.clearall")
+    on_clearvoices = mocker.patch("api.datastore.clearvoices")
+    on_initialize = mocker.patch("api.datastore.initialize")
+
+    with api_client_fixture:
+        _wait_ready(api_client_fixture)
+        on_initialize.assert_called_once()
+    on_clearall.assert_not_called()
+    on_clearvoices.assert_not_called()
+
+
+def _wait_ready(client, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while client.get("/ready").status_code != 200:
+        assert time.monotonic() < deadline, "not ready"
+        time.sleep(0.01)
+
+
+def test_ready_once_connected(api_client_fixture, mocker, monkeypatch):
+    """In production the API serves while Mongo is down, and is ready once it answers."""
+    monkeypatch.setattr(api.main, "STARTUP_MODE", "production")
+    monkeypatch.setattr(api.main, "STARTUP_RETRY_INTERVAL", 0.01)
+    connected = threading.Event()
+
+    def startup():
+        if not connected.is_set():
+            raise RuntimeError("server selection timeout")
+
+    mocker.patch("api.datastore.startup", side_effect=startup)
+
+    with api_client_fixture:
+        resp = api_client_fixture.get("/ready")
+        assert resp.status_code == 503
+        assert resp.json()["ready"] is False
+        assert api_client_fixture.get("/metrics").status_code == 200  # serving
+
+        connected.set()
+        _wait_ready(api_client_fixture)
+        assert api_client_fixture.get("/ready").json()["error"] is None
+
+
+def test_lifespan_refreshes_prompts(api_client_fixture, mocker, monkeypatch):
+    """The prompt index is reloaded in the background, even when a reload fails."""
+    monkeypatch.setattr(api.datastore, "PROMPT_REFRESH_INTERVAL", 0.01)
+    refreshed = threading.Event()
+
+    def load_prompts():
+        if load.call_count == 2:
+            raise RuntimeError("server selection timeout")
+        if load.call_count > 2:
+            refreshed.set()
+
+    load = mocker.patch("api.datastore.load_prompts", side_effect=load_prompts)
+
+    with api_client_fixture:
+        assert refreshed.wait(5)
+
+
+def test_warm_up(api_client_fixture):
+    with api_client_fixture:
+        deadline = time.monotonic() + 5
+        while not api.main.READINESS["warm"]:
+            assert time.monotonic() < deadline, "not warm"
+            time.sleep(0.01)
+    assert facebook.Response.__pydantic_complete__  # built
+
+
+def test_import_defers_heavy_modules():
+    imported = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, api.main; print(' '.join(sorted(sys.modules)))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    for name in ("numpy", "pymongo", "requests", "transaction", "api.utils"):
+        assert name not in imported
+
+
 @pytest.mark.parametrize(
     "params", ["hub.verify_token=invalid", "hub.verify_token=foo&hub.challenge=bar"]
 )
@@ -70,6 +199,17 @@ def test_get_privacy_policy(api_client_fixture):
     assert api_client_fixture.get("/privacy-policy").status_code == 200
 
 
+def test_get_privacy_policy_cached(api_client_fixture):
+    resp = api_client_fixture.get("/privacy-policy")
+    assert resp.text == api.main.PRIVACY_POLICY_PATH.read_text()
+    assert resp.headers["content-encoding"] == "gzip"
+
+    cached = api_client_fixture.get(
+        "/privacy-policy", headers={"if-none-match": resp.headers["etag"]}
+    )
+    assert cached.status_code == 304
+
+
 def test_post_message_200_resp_valid_data(
     api_client_fixture, test_fixture_valid_event, mocker
 ):
@@ -86,3 +226,497 @@ def test_post_message_422(api_client_fixture, test_fixture_invalid_event, mocker
     mocker.patch("api.utils.reply_to")
     resp = api_client_fixture.post("/webhook", json=test_fixture_invalid_event)
     assert resp.status_code == 422
+
+
+def test_post_message_422_not_json(api_client_fixture):
+    resp = api_client_fixture.post("/webhook", content=b"{not json")
+    assert resp.status_code == 422
+    assert resp.json()["status_code"] == 10422
+
+
+def test_post_message_stages_timed(
+    api_client_fixture, test_fixture_valid_event, mocker
+):
+    mocker.patch("api.utils.handle_fb_user", return_value="fb/12345")
+    mocker.patch("api.utils.handle_user_message", return_value="mocked response")
+    mocker.patch("api.utils.reply_to")
+    validated = api.metrics.STAGES.value(stage="validate")
+    enqueued = api.metrics.STAGES.value(stage="enqueue")
+
+    api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert api.metrics.STAGES.value(stage="validate") == validated + 1
+    assert api.metrics.STAGES.value(stage="enqueue") == enqueued + 1
+    resp = api_client_fixture.get("/metrics")
+    assert "# TYPE ingest_stage_seconds histogram" in resp.text
+    assert 'ingest_stage_seconds_bucket{stage="validate",le="+Inf"}' in resp.text
+
+
+def test_get_voice_waveform(api_client_fixture, mocker):
+    peaks = {64: np.array([[-1, 2, 1]], dtype=np.int8)}
+    mocker.patch("api.datastore.get_waveform", return_value=audio.pack_peaks(peaks))
+
+    resp = api_client_fixture.get("/voices/honeybee/waveform?samples_per_peak=64")
+    assert resp.status_code == 200
+    assert resp.json()["min"] == [-1]
+    assert resp.json()["max"] == [2]
+    assert "immutable" in resp.headers["cache-control"]
+
+    # Conditional requests are answered without a body
+    cached = api_client_fixture.get(
+        "/voices/honeybee/waveform?samples_per_peak=64",
+        headers={"If-None-Match": resp.headers["etag"]},
+    )
+    assert cached.status_code == 304
+
+
+def test_get_voice_waveform_unknown_level(api_client_fixture, mocker):
+    peaks = {64: np.array([[-1, 2, 1]], dtype=np.int8)}
+    mocker.patch("api.datastore.get_waveform", return_value=audio.pack_peaks(peaks))
+    resp = api_client_fixture.get("/voices/honeybee/waveform?samples_per_peak=5")
+    assert resp.status_code == 400
+
+
+def test_get_voice_waveform_not_found(api_client_fixture, mocker):
+    mocker.patch("api.datastore.get_waveform", return_value=None)
+    assert api_client_fixture.get("/voices/honeybee/waveform").status_code == 404
+
+
+def test_get_similar_voices(api_client_fixture, mocker):
+    get_similar = mocker.patch(
+        "api.datastore.get_similar_voices", return_value=[[("bumblebee", 0.9)]]
+    )
+    resp = api_client_fixture.get("/voices/honeybee/similar?k=3")
+    assert resp.status_code == 200
+    assert resp.json()["similar"] == [{"id": "bumblebee", "similarity": 0.9}]
+    get_similar.assert_called_once_with(["honeybee"], k=3)
+
+
+def test_get_similar_voices_not_found(api_client_fixture, mocker):
+    mocker.patch("api.datastore.get_similar_voices", return_value=[None])
+    assert api_client_fixture.get("/voices/honeybee/similar").status_code == 404
+
+
+def test_get_voice_spectrogram(
+    api_client_fixture, mocker, tmp_path, test_fixture_make_wav
+):
+    voice = tmp_path / "honeybee.wav"
+    voice.write_bytes(test_fixture_make_wav(np.ones(audio.SAMPLE_RATE) * 0.1))
+    mocker.patch("api.datastore.get_voice", return_value=voice)
+    mocker.patch("api.datastore.VOICES_DIR", tmp_path)
+
+    resp = api_client_fixture.get("/voices/honeybee/spectrogram?height=32&width=16")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "image/png"
+    assert "immutable" in resp.headers["cache-control"]
+    assert (tmp_path / "spectrograms").is_dir()
+
+
+@pytest.mark.parametrize("voice,status_code", [(None, 404), ("bumblebee.wav", 415)])
+def test_get_voice_spectrogram_errors(
+    api_client_fixture, mocker, tmp_path, voice, status_code
+):
+    if voice:
+        voice = tmp_path / voice
+        voice.write_bytes(b"Buzz buzzzzz bizz zzzz ~")
+    mocker.patch("api.datastore.get_voice", return_value=voice)
+    mocker.patch("api.datastore.VOICES_DIR", tmp_path)
+    resp = api_client_fixture.get("/voices/bumblebee/spectrogram")
+    assert resp.status_code == status_code
+
+
+def test_get_voice_spectrogram_deleted_voice_not_served_from_cache(
+    api_client_fixture, mocker, tmp_path, test_fixture_make_wav
+):
+    voice = tmp_path / "honeybee.wav"
+    voice.write_bytes(test_fixture_make_wav(np.ones(audio.SAMPLE_RATE) * 0.1))
+    get_voice = mocker.patch("api.datastore.get_voice", return_value=voice)
+    mocker.patch("api.datastore.VOICES_DIR", tmp_path)
+    url = "/voices/honeybee/spectrogram?height=32&width=16"
+    assert api_client_fixture.get(url).status_code == 200
+
+    get_voice.return_value = None  # deleted
+    assert api_client_fixture.get(url).status_code == 404
+
+
+def test_post_message_503_when_overloaded(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch
+):
+    handle_fb_user = mocker.patch("api.utils.handle_fb_user")
+    saturated = api.admission.AdmissionController(capacity=1, reserved=0)
+    saturated.try_acquire(api.admission.CHEAP)
+    monkeypatch.setattr(api.admission, "ADMISSION", saturated)
+
+    resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert resp.status_code == 503
+    assert resp.headers["retry-after"] == str(api.main.OVERLOAD_RETRY_AFTER)
+    handle_fb_user.assert_not_called()
+    assert saturated.in_flight == 1
+
+
+def test_post_message_releases_admission(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch
+):
+    mocker.patch("api.utils.handle_fb_user", side_effect=RuntimeError("graph down"))
+    reply_to = mocker.patch("api.utils.reply_to")
+    controller = api.admission.AdmissionController(capacity=4, reserved=1)
+    monkeypatch.setattr(api.admission, "ADMISSION", controller)
+
+    resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert resp.status_code == 200
+    _drain()
+    assert reply_to.call_args.args[1] == api.main.ERROR_REPLY  # no error details
+    assert controller.in_flight == 0
+    assert api.jobqueue.queue().counts()["failed"] == 1
+
+
+def test_post_message_duplicate_voice_rejected(
+    api_client_fixture, test_fixture_valid_event, mocker
+):
+    mocker.patch("api.utils.handle_fb_user", return_value="fb/12345")
+    mocker.patch(
+        "api.utils.handle_user_message",
+        side_effect=api.datastore.DuplicateVoiceError("Duplicate of honeybee"),
+    )
+    reply_to = mocker.patch("api.utils.reply_to")
+
+    resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert resp.status_code == 200
+    _drain()
+    assert reply_to.call_args.args[1] == api.main.DUPLICATE_REPLY
+    assert sum(api.jobqueue.queue().counts().values()) == 0  # not to be retried
+
+
+def test_post_message_retried_while_datastore_unreachable(
+    api_client_fixture, test_fixture_valid_event, mocker
+):
+    mocker.patch(
+        "api.utils.handle_fb_user",
+        side_effect=pymongo.errors.ServerSelectionTimeoutError("mongo:27017 refused"),
+    )
+    reply_to = mocker.patch("api.utils.reply_to")
+
+    resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert resp.status_code == 200
+    _drain()
+    reply_to.assert_not_called()
+    assert api.jobqueue.queue().counts()["pending"] == 1
+
+
+def test_post_message_deferred_until_datastore_connected(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch
+):
+    monkeypatch.setitem(api.main.READINESS, "datastore", False)
+    handle_fb_user = mocker.patch("api.utils.handle_fb_user")
+    reply_to = mocker.patch("api.utils.reply_to")
+
+    resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert resp.status_code == 200
+    _drain()
+    handle_fb_user.assert_not_called()
+    reply_to.assert_not_called()
+    assert api.jobqueue.queue().counts()["pending"] == 1
+
+
+def test_post_message_releases_admission_when_enqueue_fails(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch
+):
+    handle_fb_user = mocker.patch("api.utils.handle_fb_user")
+    mocker.patch.object(
+        api.jobqueue.JobQueue,
+        "enqueue",
+        side_effect=sqlite3.OperationalError("database is locked"),
+    )
+    controller = api.admission.AdmissionController(capacity=4, reserved=1)
+    monkeypatch.setattr(api.admission, "ADMISSION", controller)
+
+    for _ in range(2):
+        resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+        assert resp.status_code == 503
+        assert resp.headers["retry-after"] == str(api.main.OVERLOAD_RETRY_AFTER)
+    assert controller.in_flight == 0
+    handle_fb_user.assert_not_called()
+
+
+def test_get_metrics(api_client_fixture):
+    api.admission.EVENTS.inc(0, kind=api.admission.CHEAP, outcome="accepted")
+    resp = api_client_fixture.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    assert "# TYPE webhook_events_total counter" in resp.text
+
+
+def test_post_message_503_when_sender_shard_full(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch
+):
+    handle_fb_user = mocker.patch("api.utils.handle_fb_user")
+    monkeypatch.setattr(api.sharding.SHARDS, "_depths", [8])
+    controller = api.admission.AdmissionController(capacity=4, reserved=1)
+    monkeypatch.setattr(api.admission, "ADMISSION", controller)
+
+    resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert resp.status_code == 503
+    handle_fb_user.assert_not_called()
+    assert controller.in_flight == 0
+
+
+def test_post_message_acknowledged_once_queued(
+    api_client_fixture, test_fixture_valid_event, mocker
+):
+    mocker.patch("api.utils.handle_fb_user", return_value="fb/12345")
+    mocker.patch("api.utils.handle_user_message", return_value="Saved")
+    reply_to = mocker.patch("api.utils.reply_to")
+    processing = threading.Event()
+    api.sharding.SHARDS.submit("", processing.wait, 5)  # hold the only shard
+
+    resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert resp.status_code == 200
+    assert api.jobqueue.queue().counts()["running"] >= 1
+    reply_to.assert_not_called()
+
+    processing.set()
+    _drain()
+    reply_to.assert_called()
+    assert api.jobqueue.queue().counts()["running"] == 0
+
+
+def test_post_message_network_failure_retried(
+    api_client_fixture, test_fixture_valid_event, mocker
+):
+    mocker.patch(
+        "api.utils.handle_fb_user",
+        side_effect=requests.exceptions.HTTPError("graph down"),
+    )
+    reply_to = mocker.patch("api.utils.reply_to")
+
+    resp = api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert resp.status_code == 200
+    _drain()
+    reply_to.assert_not_called()
+    assert api.jobqueue.queue().counts()["pending"] >= 1
+
+
+def test_lifespan_replays_unfinished_jobs(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch
+):
+    messaging = facebook.Event(**test_fixture_valid_event).entry[0].messaging[0]
+    jobs = api.jobqueue.queue()
+    job_ids = jobs.enqueue(
+        [
+            (
+                messaging.sender.id,
+                messaging.message.mid,
+                messaging.model_dump_json(exclude_none=True),
+            )
+        ]
+    )
+    monkeypatch.setattr(jobs, "lease", 0)  # its worker died
+    mocker.patch("api.utils.handle_fb_user", return_value="fb/12345")
+    mocker.patch("api.utils.handle_user_message", return_value="Saved")
+    reply_to = mocker.patch("api.utils.reply_to")
+
+    with api_client_fixture:
+        for _ in range(100):
+            if jobs.counts()["running"] == 0:
+                break
+            time.sleep(0.01)
+        _drain()
+    reply_to.assert_called_once_with(messaging.sender.id, "Saved")
+    assert sum(jobs.counts().values()) == 0
+    assert job_ids
+
+
+def test_post_message_captured(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch, tmp_path
+):
+    mocker.patch("api.utils.handle_fb_user", return_value="fb/12345")
+    mocker.patch("api.utils.handle_user_message", return_value="Saved")
+    mocker.patch("api.utils.reply_to")
+    monkeypatch.setattr(api.capture, "CAPTURE_PATH", str(tmp_path / "events.jsonl"))
+
+    assert (
+        api_client_fixture.post("/webhook", json=test_fixture_valid_event).status_code
+        == 200
+    )
+    (line,) = (tmp_path / "events.jsonl").read_text().splitlines()
+    assert facebook.Event.model_validate_json(line) == facebook.Event(
+        **test_fixture_valid_event
+    )
+
+
+def test_post_message_captured_off_event_loop(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch, tmp_path
+):
+    mocker.patch("api.utils.handle_fb_user", return_value="fb/12345")
+    mocker.patch("api.utils.handle_user_message", return_value="Saved")
+    mocker.patch("api.utils.reply_to")
+    monkeypatch.setattr(api.capture, "CAPTURE_PATH", str(tmp_path / "events.jsonl"))
+    loops = []
+
+    def record(event):
+        try:
+            loops.append(asyncio.get_running_loop())
+        except RuntimeError:
+            loops.append(None)
+
+    mocker.patch("api.capture.record", side_effect=record)
+    api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    assert loops == [None]
+
+
+def test_post_message_traced(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch, tmp_path
+):
+    mocker.patch("api.utils.handle_fb_user", return_value="fb/12345")
+    mocker.patch("api.utils.handle_user_message", return_value="Saved")
+    mocker.patch("api.utils.reply_to")
+    monkeypatch.setattr(api.tracing, "TRACE_EXPORT", str(tmp_path / "spans.jsonl"))
+    monkeypatch.setattr(api.tracing, "GLOBAL", {})
+
+    api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    _drain()
+    spans = [
+        json.loads(line) for line in (tmp_path / "spans.jsonl").read_text().splitlines()
+    ]
+    roots = {span["span_id"]: span for span in spans if span["parent_id"] is None}
+    processes = [span for span in spans if span["name"] == "job.process"]
+    assert {span["name"] for span in roots.values()} == {"webhook.messaging"}
+    assert len(processes) == len(roots)
+    for process in processes:
+        assert roots[process["parent_id"]]["trace_id"] == process["trace_id"]
+
+
+def test_admin_disabled_without_token(api_client_fixture, monkeypatch):
+    monkeypatch.setattr(api.profiling, "ADMIN_TOKEN", None)
+    assert api_client_fixture.post("/admin/profile/cpu").status_code == 404
+
+
+def test_admin_requires_token(api_client_fixture, monkeypatch):
+    monkeypatch.setattr(api.profiling, "ADMIN_TOKEN", "s3cret")
+    assert api_client_fixture.post("/admin/profile/cpu").status_code == 401
+    resp = api_client_fixture.post(
+        "/admin/profile/cpu", headers={"Authorization": "Bearer wrong"}
+    )
+    assert resp.status_code == 401
+
+
+def test_admin_cpu_profile(
+    api_client_fixture, test_fixture_valid_event, mocker, monkeypatch
+):
+    mocker.patch("api.utils.handle_fb_user", return_value="fb/12345")
+    mocker.patch("api.utils.handle_user_message", return_value="Saved")
+    mocker.patch("api.utils.reply_to")
+    monkeypatch.setattr(api.profiling, "ADMIN_TOKEN", "s3cret")
+    monkeypatch.setattr(api.profiling, "CPU", api.profiling.CpuProfiler())
+    admin = {"Authorization": "Bearer s3cret"}
+
+    assert (
+        api_client_fixture.get("/admin/profile/cpu", headers=admin).status_code == 404
+    )
+    resp = api_client_fixture.post("/admin/profile/cpu?requests=1", headers=admin)
+    assert resp.json() == {"remaining": 1, "sample_rate": 1.0}
+    api_client_fixture.post("/webhook", json=test_fixture_valid_event)
+    _drain()
+
+    resp = api_client_fixture.get("/admin/profile/cpu", headers=admin)
+    assert resp.headers["content-disposition"] == 'attachment; filename="cpu.prof"'
+    assert any(name == "messenger_post" for _, _, name in marshal.loads(resp.content))
+    resp = api_client_fixture.get("/admin/profile/cpu?format=text", headers=admin)
+    assert resp.text.startswith("1 requests profiled")
+    assert "pformat" in resp.text
+    assert api_client_fixture.delete("/admin/profile/cpu", headers=admin).json() == {
+        "remaining": 0
+    }
+
+
+def test_admin_memory_profile(api_client_fixture, monkeypatch):
+    monkeypatch.setattr(api.profiling, "ADMIN_TOKEN", "s3cret")
+    admin = {"Authorization": "Bearer s3cret"}
+
+    resp = api_client_fixture.get("/admin/profile/memory", headers=admin)
+    assert resp.status_code == 409
+    api_client_fixture.post("/admin/profile/memory?frames=5", headers=admin)
+    try:
+        resp = api_client_fixture.get("/admin/profile/memory", headers=admin)
+        assert resp.text.startswith("Traced")
+        resp = api_client_fixture.get(
+            "/admin/profile/memory?format=snapshot", headers=admin
+        )
+        assert resp.headers["content-type"] == "application/octet-stream"
+    finally:
+        api_client_fixture.delete("/admin/profile/memory", headers=admin)
+    assert not api.profiling.MEMORY.tracing
+
+
+def test_general_exception_handler(mocker):
+    mocker.patch("api.datastore.get_similar_voices", side_effect=RuntimeError("boom"))
+    client = TestClient(api.main.APP, raise_server_exceptions=False)
+
+    resp = client.get("/voices/honeybee/similar")
+    assert resp.status_code == 500
+    assert resp.json()["message"] == "boom"
+
+
+def test_admin_rebuild_rollups(api_client_fixture, mocker, monkeypatch):
+    monkeypatch.setattr(api.profiling, "ADMIN_TOKEN", "s3cret")
+    rebuild = mocker.patch("api.datastore.rebuild_rollups", return_value=12)
+
+    assert api_client_fixture.post("/admin/rollups/rebuild").status_code == 401
+    resp = api_client_fixture.post(
+        "/admin/rollups/rebuild", headers={"Authorization": "Bearer s3cret"}
+    )
+    assert resp.json() == {"rollups": 12}
+    rebuild.assert_called_once()
+
+
+def _rollup(kind: str, key: str, **counts) -> weaver.Rollup:
+    return weaver.Rollup(_id=f"{kind}/{key}", kind=kind, key=key, **counts)
+
+
+def test_get_prompt_stats(api_client_fixture, mocker):
+    get_rollup = mocker.patch(
+        "api.datastore.get_rollup",
+        return_value=_rollup("prompt", "2", voices=5, participants=3),
+    )
+    resp = api_client_fixture.get("/stats/prompts/2")
+    assert resp.json() == {"prompt": 2, "voices": 5, "participants": 3}
+    get_rollup.assert_called_once_with(weaver.RollupKind.PROMPT, "2")
+
+
+def test_get_prompt_contributors(api_client_fixture, mocker):
+    top = mocker.patch(
+        "api.datastore.get_top_contributors",
+        return_value=[
+            _rollup("prompt_user", "2/fb/1", voices=4, prompt=2, user="fb/1")
+        ],
+    )
+    resp = api_client_fixture.get("/stats/prompts/2/contributors?limit=1")
+    assert resp.json() == {"prompt": 2, "contributors": [{"user": "fb/1", "voices": 4}]}
+    top.assert_called_once_with(2, 1)
+
+
+def test_get_user_stats(api_client_fixture, mocker):
+    get_rollup = mocker.patch(
+        "api.datastore.get_rollup", return_value=_rollup("user", "fb/1", voices=7)
+    )
+    assert api_client_fixture.get("/stats/users/fb/1").json() == {
+        "user": "fb/1",
+        "voices": 7,
+    }
+    get_rollup.assert_called_once_with(weaver.RollupKind.USER, "fb/1")
+
+
+@pytest.mark.parametrize(
+    "query, kind, timezone",
+    [
+        ("", "day", "UTC"),
+        ("?local=true", "local_day", "America/Los_Angeles"),
+    ],
+)
+def test_get_day_stats(api_client_fixture, mocker, query, kind, timezone):
+    get_rollup = mocker.patch(
+        "api.datastore.get_rollup", return_value=_rollup(kind, "2024-01-04", voices=9)
+    )
+    resp = api_client_fixture.get(f"/stats/days/2024-01-04{query}")
+    assert resp.json() == {"day": "2024-01-04", "timezone": timezone, "voices": 9}
+    get_rollup.assert_called_once_with(weaver.RollupKind(kind), "2024-01-04")
+    assert api_client_fixture.get("/stats/days/yesterday").status_code == 422
@@ -0,0 +1,208 @@
+"""
+unittests.test_audio.py
+~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.audio decoding and signal analysis
+"""
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from api import audio
+
+
+def _tone(
+    seconds: float, freq: float = 440, rate: int = audio.SAMPLE_RATE
+) -> np.ndarray:
+    """A sine tone at half amplitude."""
+    t = np.arange(int(seconds * rate)) / rate
+    return (0.5 * np.sin(2 * np.pi * freq * t)).astype(np.float32)
+
+
+def _melody(seed: int, notes: int = 32) -> np.ndarray:
+    """Random sequence of quarter second notes with harmonics."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(audio.SAMPLE_RATE // 4) / audio.SAMPLE_RATE
+    return np.concatenate(
+        [
+            sum(np.sin(2 * np.pi * f * k * t) / k for k in (1, 2, 3))
+            * 0.3
+            * np.hanning(len(t))
+            for f in rng.uniform(150, 2500, notes)
+        ]
+    ).astype(np.float32)
+
+
+def _overlap(a: np.ndarray, b: np.ndarray) -> float:
+    """Share of common hashes of the smallest fingerprint."""
+    return np.isin(a, b).sum() / min(len(a), len(b))
+
+
+def test_decode_wav_mono(test_fixture_make_wav):
+    tone = _tone(0.5)
+    samples = audio.decode(test_fixture_make_wav(tone), "wav")
+    assert samples.dtype == np.float32
+    assert np.allclose(samples, tone, atol=1e-3)
+
+
+def test_decode_wav_stereo_resampled(test_fixture_make_wav):
+    tone = _tone(1, rate=8000)
+    samples = audio.decode(
+        test_fixture_make_wav(np.stack((tone, tone), 1), 8000), "WAV"
+    )
+    # Downmixed to mono and resampled to the analysis rate
+    assert samples.ndim == 1
+    assert len(samples) == audio.SAMPLE_RATE
+    assert np.abs(samples).max() == pytest.approx(0.5, abs=1e-2)
+
+
+def test_decode_invalid_wav():
+    with pytest.raises(ValueError):
+        audio.decode(b"Buzz buzzzzz bizz zzzz ~", "wav")
+
+
+def test_decode_without_ffmpeg(mocker):
+    mocker.patch("shutil.which", return_value=None)
+    with pytest.raises(ValueError):
+        audio.decode(b"not an mp4", "mp4")
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg is not installed")
+def test_decode_mp4_index_at_end(test_fixture_make_wav, tmp_path):
+    tone = _tone(1)
+    (tmp_path / "tone.wav").write_bytes(test_fixture_make_wav(tone))
+    # AAC in MP4, the moov atom written after the media data by default
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", tmp_path / "tone.wav", "-c:a", "aac"]
+        + [tmp_path / "tone.mp4"],
+        check=True,
+    )
+    content = (tmp_path / "tone.mp4").read_bytes()
+    assert content.index(b"moov") > content.index(b"mdat")
+
+    samples = audio.decode(content, "mp4")
+    assert len(samples) == pytest.approx(len(tone), rel=0.1)  # priming & padding
+    assert np.abs(samples).max() == pytest.approx(0.5, abs=0.05)
+
+
+def test_waveform_peaks_levels():
+    samples = np.concatenate((np.full(1000, 0.5), np.full(1000, -1.0))).astype(
+        np.float32
+    )
+    peaks = audio.waveform_peaks(samples, levels=(250, 1000, 4000))
+
+    assert sorted(peaks) == [250, 1000, 4000]
+    assert peaks[250].shape == (8, 3)
+    assert peaks[250].dtype == np.int8
+    # Each level is min, max, rms of its bins
+    assert peaks[1000].tolist() == [[64, 64, 64], [-127, -127, 127]]
+    # The partial last bin isn't diluted by padding
+    assert peaks[4000].tolist() == [[-127, 64, 100]]
+
+
+def test_waveform_peaks_empty():
+    peaks = audio.waveform_peaks(np.zeros(0, dtype=np.float32))
+    assert all(values.tolist() == [[0, 0, 0]] for values in peaks.values())
+
+
+def test_waveform_peaks_invalid_levels():
+    with pytest.raises(ValueError):
+        audio.waveform_peaks(_tone(1), levels=(100, 250))
+
+
+def test_pack_peaks_round_trip():
+    peaks = audio.waveform_peaks(_tone(2))
+    unpacked = audio.unpack_peaks(audio.pack_peaks(peaks))
+    assert unpacked.keys() == peaks.keys()
+    assert all(np.array_equal(unpacked[level], peaks[level]) for level in peaks)
+
+
+def test_frames_pads_tail():
+    framed = audio.frames(np.arange(10, dtype=np.float32), size=4, hop=3)
+    assert framed.tolist() == [[0, 1, 2, 3], [3, 4, 5, 6], [6, 7, 8, 9]]
+    assert audio.frames(np.ones(2, dtype=np.float32), 4, 2).tolist() == [[1, 1, 0, 0]]
+
+
+def test_stft_peak_frequency():
+    spectrum = audio.stft(_tone(1, freq=1000), n_fft=1024, hop=256)
+    assert spectrum.shape[1] == 513
+    assert spectrum.mean(axis=0).argmax() == round(1000 / audio.SAMPLE_RATE * 1024)
+
+
+def test_fingerprint_matches_reencoded_copy():
+    original = audio.fingerprint(_melody(1))
+    # Lower sample rate, gain and 8-bit quantization: every byte differs
+    reencoded = audio.resample(
+        audio.resample(_melody(1) * 0.6, 16000, 8000), 8000, 16000
+    )
+    reencoded = audio.fingerprint((np.round(reencoded * 127) / 127).astype(np.float32))
+
+    assert original.dtype == np.int64
+    assert np.all(np.diff(original) > 0)  # sorted & unique
+    assert _overlap(reencoded, original) > 0.4
+    assert _overlap(audio.fingerprint(_melody(2)), original) < 0.2
+
+
+def test_fingerprint_silence():
+    assert (
+        len(audio.fingerprint(np.zeros(audio.SAMPLE_RATE * 3, dtype=np.float32))) == 0
+    )
+
+
+def test_mel_filterbank_shape():
+    filters = audio.mel_filterbank(n_fft=512, n_mels=40)
+    assert filters.shape == (40, 257)
+    assert filters.max() <= 1
+    assert np.all(filters.sum(axis=1) > 0)  # no empty band
+
+
+def test_embedding_similar_timbres_are_closer():
+    t = np.arange(audio.SAMPLE_RATE * 2) / audio.SAMPLE_RATE
+
+    def voice(f0, harmonics, gain=0.2):
+        tones = (
+            a * np.sin(2 * np.pi * f0 * (k + 1) * t) for k, a in enumerate(harmonics)
+        )
+        return (gain * sum(tones)).astype(np.float32)
+
+    reference = audio.embedding(voice(200, [1, 0.5, 0.2]))
+    assert reference.shape == (audio.EMBEDDING_SIZE,)
+    assert np.linalg.norm(reference) == pytest.approx(1)
+    # Same timbre, quieter and slightly higher is closer than a different timbre
+    same = reference @ audio.embedding(voice(210, [1, 0.5, 0.2], gain=0.05))
+    different = reference @ audio.embedding(voice(200, [0.1, 0.3, 1, 0.8]))
+    assert same > 0.9
+    assert same - different > 0.1
+
+
+def test_embedding_silence():
+    assert not audio.embedding(np.zeros(audio.SAMPLE_RATE, dtype=np.float32)).any()
+
+
+def test_levels_trims_silence_and_normalises():
+    second = audio.SAMPLE_RATE
+    hiss = np.random.default_rng(0).normal(0, 1e-4, second).astype(np.float32)
+    samples = np.concatenate((np.zeros(second // 2), 0.01 * _tone(1) / 0.5, hiss))
+
+    trim_start, trim_end, gain_db = audio.levels(samples.astype(np.float32))
+    assert trim_start == pytest.approx(0.5 - audio.TRIM_PADDING, abs=0.011)
+    assert trim_end == pytest.approx(1.5 + audio.TRIM_PADDING, abs=0.026)
+
+    voiced = audio.apply_levels(samples, trim_start, trim_end, gain_db)
+    assert len(voiced) == int(trim_end * second) - int(trim_start * second)
+    loudness = 20 * np.log10(np.sqrt(np.mean(np.square(voiced))))
+    assert loudness == pytest.approx(audio.TARGET_LOUDNESS_DB, abs=1)
+
+
+def test_levels_gain_limited_by_peak():
+    clicks = np.zeros(audio.SAMPLE_RATE, dtype=np.float32)
+    clicks[::4000] = 0.5  # quiet on average but with loud peaks
+    _, _, gain_db = audio.levels(clicks)
+    assert gain_db == pytest.approx(
+        audio.PEAK_CEILING_DB - 20 * np.log10(0.5), abs=0.01
+    )
+
+
+def test_levels_silence():
+    assert audio.levels(np.zeros(audio.SAMPLE_RATE, dtype=np.float32)) == (0, 0, 0)
@@ -0,0 +1,83 @@
+"""
+unittests.test_bloom.py
+~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.bloom
+"""
+import pytest
+
+from api import bloom
+
+
+@pytest.fixture
+def _filter() -> bloom.CountingBloomFilter:
+    return bloom.CountingBloomFilter(capacity=1000, error_rate=0.01)
+
+
+def test_sized_for_error_rate(_filter):
+    assert _filter.size == 9586  # -n ln p / ln² 2
+    assert _filter.hashes == 7
+    assert _filter.memory_bytes == _filter.size
+
+
+def test_add(_filter):
+    assert "fb/1" not in _filter
+    _filter.add("fb/1")
+    assert "fb/1" in _filter
+    assert _filter.might_contain("fb/1")
+    assert _filter.count == 1
+
+
+def test_remove(_filter):
+    _filter.add("fb/1")
+    _filter.add("fb/2")
+    _filter.remove("fb/1")
+
+    assert "fb/1" not in _filter
+    assert "fb/2" in _filter
+    assert _filter.count == 1
+
+
+def test_added_twice_removed_once(_filter):
+    _filter.add("fb/1")
+    _filter.add("fb/1")
+    _filter.remove("fb/1")
+    assert "fb/1" in _filter
+
+
+def test_remove_never_added(_filter):
+    _filter.add("fb/1")
+    _filter.remove("fb/2")
+    assert "fb/1" in _filter
+    assert _filter.count == 1
+
+
+def test_no_false_negatives_and_bounded_false_positives(_filter):
+    for i in range(1000):
+        _filter.add(f"fb/{i}")
+
+    assert all(f"fb/{i}" in _filter for i in range(1000))
+    false_positives = sum(f"ig/{i}" in _filter for i in range(10000))
+    assert false_positives / 10000 < 0.02
+    assert 0.005 < _filter.false_positive_rate() < 0.015
+
+
+def test_empty_false_positive_rate(_filter):
+    assert _filter.false_positive_rate() == 0.0
+
+
+def test_saturated_counters_kept(monkeypatch):
+    monkeypatch.setattr(bloom, "MAX_COUNT", 2)
+    keys = bloom.CountingBloomFilter(capacity=1, error_rate=0.5)
+    for _ in range(3):
+        keys.add("fb/1")
+    for _ in range(3):
+        keys.remove("fb/1")
+    assert "fb/1" in keys  # its count is unknown once saturated
+
+
+def test_stats(_filter):
+    _filter.add("fb/1")
+    stats = _filter.stats()
+    assert stats["keys"] == 1
+    assert stats["memory_bytes"] == _filter.size
+    assert 0 < stats["false_positive_rate"] < 1e-10
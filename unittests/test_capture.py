@@ -0,0 +1,78 @@
+"""
+unittests.test_capture.py
+~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.capture
+"""
+import json
+
+import pytest
+
+from api import capture
+from models import facebook
+
+
+@pytest.fixture
+def _event(test_fixture_valid_event) -> facebook.Event:
+    return facebook.Event(**test_fixture_valid_event)
+
+
+def test_append_compact_json_lines(tmp_path, _event):
+    journal = capture.CaptureJournal(tmp_path / "events.jsonl", 2**20, backups=2)
+    journal.append(_event)
+    journal.append(_event)
+
+    lines = (tmp_path / "events.jsonl").read_text().splitlines()
+    assert len(lines) == 2
+    assert facebook.Event.model_validate_json(lines[0]) == _event
+    assert ": " not in lines[0]  # compact
+    assert json.loads(lines[0]) == json.loads(lines[1])
+
+
+def test_append_raw_body(tmp_path, test_fixture_valid_event):
+    journal = capture.CaptureJournal(tmp_path / "events.jsonl", 2**20, backups=2)
+    journal.append(json.dumps(test_fixture_valid_event, indent=2).encode())
+
+    lines = (tmp_path / "events.jsonl").read_text().splitlines()
+    assert len(lines) == 1
+    assert lines[0] == json.dumps(test_fixture_valid_event, separators=(",", ":"))
+
+
+def test_append_raw_body_line_separators(tmp_path, test_fixture_valid_event):
+    """Line separators allowed unescaped in JSON strings don't split the event."""
+    event = {**test_fixture_valid_event, "note": "a\u2028b\u0085c"}
+    journal = capture.CaptureJournal(tmp_path / "events.jsonl", 2**20, backups=2)
+    journal.append(json.dumps(event, ensure_ascii=False).encode())
+
+    lines = (tmp_path / "events.jsonl").read_text().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0]) == event
+
+
+def test_rotation_keeps_backups(tmp_path, _event):
+    journal = capture.CaptureJournal(tmp_path / "events.jsonl", 1, backups=2)
+    for _ in range(4):
+        journal.append(_event)
+
+    assert sorted(path.name for path in tmp_path.glob("events.jsonl*")) == [
+        "events.jsonl",
+        "events.jsonl.1",
+        "events.jsonl.2",
+    ]
+    assert journal.files() == [
+        tmp_path / "events.jsonl.2",
+        tmp_path / "events.jsonl.1",
+        tmp_path / "events.jsonl",
+    ]
+
+
+def test_record_off_by_default(monkeypatch, _event):
+    monkeypatch.setattr(capture, "CAPTURE_PATH", None)
+    assert capture.journal() is None
+    capture.record(_event)
+
+
+def test_record_failure_only_logged(monkeypatch, tmp_path, _event):
+    monkeypatch.setattr(capture, "GLOBAL", {})
+    monkeypatch.setattr(capture, "CAPTURE_PATH", str(tmp_path / "events.jsonl"))
+    (tmp_path / "events.jsonl").mkdir()  # not writable as a file
+    capture.record(_event)
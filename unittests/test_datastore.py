@@ -4,18 +4,20 @@ unittests.test_datastore.py
 Test datastore operations using mongmock client.
 """
 
+import fcntl
 import tempfile
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import IO
+from typing import IO, Optional
 from zoneinfo import ZoneInfo
 
 import mongomock
+import numpy as np
 import pymongo
 import pytest
 from pydantic import ValidationError
 
-from api import datastore
+from api import audio, datastore, usercache
 from models import weaver
 
 
@@ -41,6 +43,8 @@ def _auto_cleanup_database():
         datastore.PROMPTS,
         datastore.USERNAME_TO_ID,
         datastore.PROMPT_MANAGER,
+        datastore.FINGERPRINTS,
+        datastore.ROLLUPS,
     }:
         db.drop_collection(name)
 
@@ -83,7 +87,7 @@ def test_insert_voice_succeeds(mocker, _mock_voices_directory):
     assert (
         datastore.insert_voice(
             audio_content=b"Buzz buzzzzz bizz zzzz ~",
-            **dict(metadata),
+            **metadata.model_dump(exclude_unset=True),
         )
         == "honeybee"
     )
@@ -106,7 +110,10 @@ def test_insert_voice_file_save_fails(_mock_voices_directory):
     )
     # New file fails to save
     with pytest.raises(TypeError):
-        datastore.insert_voice(audio_content="this isn't byte type", **dict(metadata))
+        datastore.insert_voice(
+            audio_content="this isn't byte type",
+            **metadata.model_dump(exclude_unset=True),
+        )
 
     # File not found since the write is unsucessful
     with pytest.raises(FileNotFoundError):
@@ -136,6 +143,177 @@ def test_insert_voice_metadata_fails(_mock_voices_directory):
     assert _db().get_collection(datastore.METADATAS).find_one("honeybee") is None
 
 
+def _insert_voice(id: str, fingerprint=None, **kwargs) -> str:
+    """Insert a voice record with placeholder content."""
+    return datastore.insert_voice(
+        id=id,
+        audio_extension="wav",
+        audio_content=b"Buzz buzzzzz bizz zzzz ~",
+        datetime=__from_ts("2024-01-03 19:30:00"),
+        username="fb/12345",
+        prompt_id=2,
+        fingerprint=fingerprint,
+        **kwargs,
+    )
+
+
+def test_insert_voice_indexes_fingerprint(_mock_voices_directory):
+    _insert_voice("honeybee", fingerprint=range(10))
+    postings = _db().get_collection(datastore.FINGERPRINTS)
+    assert postings.count_documents({}) == 10
+    assert postings.find_one(3)["voices"] == ["honeybee"]
+    assert datastore.get_metadata("honeybee").fingerprint_size == 10
+
+
+def test_insert_voice_flags_duplicate(_mock_voices_directory):
+    _insert_voice("honeybee", fingerprint=range(10))
+    _insert_voice("bumblebee", fingerprint=range(20, 30))
+    # 6 of the 10 hashes in common with honeybee
+    _insert_voice("honeybee-again", fingerprint=[*range(6), *range(100, 104)])
+
+    assert datastore.get_metadata("honeybee-again").duplicate_of == "honeybee"
+    assert datastore.get_metadata("bumblebee").duplicate_of is None
+    assert datastore.find_duplicates(range(20, 30)) == [("bumblebee", 1.0)]
+    assert _db().get_collection(datastore.FINGERPRINTS).find_one(0)["voices"] == [
+        "honeybee",
+        "honeybee-again",
+    ]
+
+
+def test_insert_voice_rejects_duplicate(_mock_voices_directory):
+    _insert_voice("honeybee", fingerprint=range(10))
+    with pytest.raises(datastore.DuplicateVoiceError):
+        _insert_voice("honeybee-again", fingerprint=range(10), reject_duplicates=True)
+
+    # Nothing of the duplicate is stored
+    assert datastore.get_metadata("honeybee-again") is None
+    assert not Path(_voice_path("honeybee-again.wav")).exists()
+
+
+def test_find_duplicates_short_fingerprint(_mock_voices_directory):
+    _insert_voice("honeybee", fingerprint=range(10))
+    assert datastore.find_duplicates(range(3)) == []
+
+
+def test_delete_voice(_mock_voices_directory):
+    _insert_voice("honeybee", fingerprint=range(10))
+    _insert_voice("honeybee-again", fingerprint=range(5, 15))
+    datastore.insert_waveform("honeybee", b"peaks")
+
+    assert datastore.delete_voice("honeybee")
+    assert datastore.get_metadata("honeybee") is None
+    assert datastore.get_waveform("honeybee") is None
+    assert not Path(_voice_path("honeybee.wav")).exists()
+
+    # Postings only held by the deleted voice are dropped
+    postings = _db().get_collection(datastore.FINGERPRINTS)
+    assert postings.find_one(0) is None
+    assert postings.find_one(5)["voices"] == ["honeybee-again"]
+
+    assert not datastore.delete_voice("honeybee")
+
+
+def test_delete_voice_drops_spectrograms(_mock_voices_directory):
+    _insert_voice("honeybee")
+    datastore.get_spectrogram("honeybee", 32, 64, lambda: b"png")
+    datastore.get_spectrogram("honeybee.2", 32, 64, lambda: b"other")  # another voice
+
+    assert datastore.delete_voice("honeybee")
+    assert datastore.get_spectrogram("honeybee", 32, 64, lambda: b"new") == b"new"
+    assert datastore.get_spectrogram("honeybee.2", 32, 64, lambda: b"new") == b"other"
+
+
+def test_get_voices_by_prompt_and_user(_mock_voices_directory):
+    for id, ts, username, prompt_id in (
+        ("honeybee", "2024-01-03 19:30:00", "fb/12345", 2),
+        ("bumblebee", "2024-01-04 10:00:00", "fb/12345", 3),
+        ("wasp", "2024-01-02 08:00:00", "fb/67890", 2),
+    ):
+        datastore.insert_voice(
+            id=id,
+            audio_extension="wav",
+            audio_content=b"Bzzz",
+            datetime=__from_ts(ts),
+            username=username,
+            prompt_id=prompt_id,
+        )
+
+    assert [voice.id for voice in datastore.get_voices_by_prompt(2)] == [
+        "wasp",
+        "honeybee",
+    ]
+    assert [voice.id for voice in datastore.get_voices_by_user("fb/12345")] == [
+        "honeybee",
+        "bumblebee",
+    ]
+    assert datastore.get_voices_by_prompt(4) == []
+    assert datastore.get_voices_by_user("fb/00000") == []
+
+
+def test_update_metadata(_mock_voices_directory):
+    _insert_voice("honeybee")
+    assert datastore.update_metadata(
+        "honeybee", weaver.VoiceMetadataUpdate(gain_db=3.5, trim_end=2.0)
+    )
+    metadata = datastore.get_metadata("honeybee")
+    assert (metadata.gain_db, metadata.trim_end, metadata.prompt_id) == (3.5, 2.0, 2)
+    assert not datastore.update_metadata("wasp", weaver.VoiceMetadataUpdate(gain_db=1))
+
+
+def test_get_similar_voices(_mock_voices_directory):
+    for id, vector in (
+        ("honeybee", [1, 0]),
+        ("bumblebee", [0.8, 0.6]),
+        ("wasp", [0, 1]),
+    ):
+        embedding = np.zeros(audio.EMBEDDING_SIZE, dtype=np.float32)
+        embedding[:2] = vector
+        datastore.insert_embedding(id, embedding)
+
+    honeybee, unknown = datastore.get_similar_voices(["honeybee", "unknown"], k=1)
+    assert honeybee == [("bumblebee", pytest.approx(0.8))]
+    assert unknown is None
+
+    # Deleted voices leave the index
+    _insert_voice("bumblebee")
+    datastore.delete_voice("bumblebee")
+    assert datastore.get_similar_voices(["honeybee"], k=1) == [[("wasp", 0.0)]]
+
+
+def test_get_voice(_mock_voices_directory):
+    assert datastore.get_voice("honeybee") is None
+    _insert_voice("honeybee")
+    assert datastore.get_voice("honeybee") == datastore.VOICES_DIR / "honeybee.wav"
+
+
+def test_get_spectrogram_cached(_mock_voices_directory):
+    assert datastore.get_spectrogram("honeybee", 32, 64, lambda: b"png") == b"png"
+    assert datastore.get_spectrogram("honeybee", 32, 64, lambda: b"other") == b"png"
+    assert datastore.get_spectrogram("honeybee", 16, 64, lambda: b"other") == b"other"
+
+    datastore.clearvoices()
+    assert not (datastore.VOICES_DIR / datastore.SPECTROGRAMS_DIR).exists()
+
+
+def test_waveform_round_trip(_mock_voices_directory):
+    assert datastore.get_waveform("honeybee") is None
+    assert datastore.insert_waveform("honeybee", b"peaks") == "honeybee"
+    assert datastore.get_waveform("honeybee") == b"peaks"
+
+
+def test_voice_files_skips_derived_files(_mock_voices_directory):
+    for name in ("honeybee.wav", "honeybee.peaks", "bumblebee.mp4"):
+        (datastore.VOICES_DIR / name).write_bytes(b"")
+    assert [id for id, _ in datastore.voice_files()] == ["bumblebee", "honeybee"]
+
+
+def test_voice_files_skips_startup_lock(_mock_voices_directory):
+    datastore.initialize()
+    assert (datastore.VOICES_DIR / datastore.STARTUP_LOCK).is_file()
+    (datastore.VOICES_DIR / "honeybee.wav").write_bytes(b"")
+    assert [id for id, _ in datastore.voice_files()] == ["honeybee"]
+
+
 def test_insert_user_successfully():
     user = weaver.User(
         _id="fb/12345",
@@ -176,11 +354,49 @@ def test_insert_user_fails_users():
     )
 
 
+def test_datastore_calls_timed():
+    inserted = datastore.OPERATIONS.value(
+        operation="insert", collection=datastore.USERS
+    )
+    got = datastore.OPERATIONS.value(operation="get", collection=datastore.USERS)
+
+    datastore.insert_user(id="fb/12345", first_name="Bee")
+    datastore.get_user_by_id("fb/12345")
+    assert (
+        datastore.OPERATIONS.value(operation="insert", collection=datastore.USERS)
+        == inserted + 1
+    )
+    assert (
+        datastore.OPERATIONS.value(operation="get", collection=datastore.USERS)
+        == got + 1
+    )
+
+
+def test_datastore_call_errors_counted():
+    errors = datastore.ERRORS.value(operation="insert", collection=datastore.USERS)
+    datastore.insert_user(id="fb/12345", first_name="Bee")
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        datastore.insert_user(id="fb/12345", first_name="Bee")
+
+    assert (
+        datastore.ERRORS.value(operation="insert", collection=datastore.USERS)
+        == errors + 1
+    )
+
+
+def test_get_user_by_username():
+    datastore.insert_user(id="fb/12345", first_name="Bee", username="queen_bee")
+
+    assert datastore.get_user_by_username("queen_bee").id == "fb/12345"
+    assert datastore.get_user_by_id("fb/12345").username == "queen_bee"
+    assert datastore.get_user_by_username("drone_bee") is None
+
+
 @pytest.mark.xfail(reason="Needs data transaction manager for this to pass.")
-def test_insert_user_fails_mapping():
+def test_insert_user_fails_mapping(monkeypatch):
     # change collection name to create some sort of error
     placeholder = datastore.USERNAME_TO_ID
-    datastore.USERNAME_TO_ID = 98765
+    monkeypatch.setattr(datastore, "USERNAME_TO_ID", 98765)
 
     with pytest.raises(TypeError):
         datastore.insert_user(
@@ -196,9 +412,6 @@ def test_insert_user_fails_mapping():
     # Username to id mapping contains the entry since failure
     assert _db().get_collection(placeholder).find_one("queen_bee_is_da_best") is None
 
-    # revert the collection name back
-    datastore.USERNAME_TO_ID = placeholder
-
 
 def test_insert_prompt_succeeds_first_prompt():
     kwargs = dict(
@@ -233,6 +446,39 @@ def test_insert_prompt_succeeds_second_prompt():
     assert kwargs.items() <= doc.items()  # kwargs is subset aside from the id field
 
 
+def test_initialize(_mock_voices_directory):
+    assert datastore.initialize()
+    assert (datastore.VOICES_DIR / datastore.EMBEDDINGS_DIR).is_dir()
+    assert (
+        "voices_1" in _db().get_collection(datastore.FINGERPRINTS).index_information()
+    )
+    manager = _db().get_collection(datastore.PROMPT_MANAGER).find_one("manager")
+    assert weaver.PromptManager.model_validate(manager).next_index == 0
+
+    # Idempotent: existing prompts are kept
+    datastore.insert_prompt(
+        text="what is your favorite flower?",
+        begins=__from_ts("2024-01-04 00:00:00"),
+        ends=__from_ts("2024-01-11 23:59:59"),
+    )
+    assert datastore.initialize()
+    manager = _db().get_collection(datastore.PROMPT_MANAGER).find_one("manager")
+    assert manager["next_index"] == 1
+
+
+def test_initialize_skipped_while_another_worker_initializes(_mock_voices_directory):
+    datastore.VOICES_DIR.mkdir(exist_ok=True)
+    with open(datastore.VOICES_DIR / datastore.STARTUP_LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        assert not datastore.initialize()
+    assert _db().get_collection(datastore.PROMPT_MANAGER).find_one("manager") is None
+
+
+def test_clearvoices_without_voices_directory(_mock_voices_directory):
+    datastore.VOICES_DIR.rmdir()
+    datastore.clearvoices()
+
+
 def test_new_db(mocker):
     datastore.shutdown()
     assert "db_client" not in datastore.GLOBAL
@@ -241,3 +487,465 @@ def test_new_db(mocker):
     datastore.__database()
 
     assert "db_client" in datastore.GLOBAL
+
+
+def test_startup_reuses_client(mocker):
+    client = datastore.GLOBAL["db_client"]
+    new_client = mocker.patch("pymongo.MongoClient")
+    datastore.startup()
+
+    new_client.assert_not_called()
+    assert datastore.GLOBAL["db_client"] is client
+
+
+@pytest.fixture
+def _user_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(usercache, "USER_CACHE_PATH", str(tmp_path / "users"))
+    monkeypatch.setattr(usercache, "GLOBAL", {})
+    yield usercache.cache()
+    usercache.GLOBAL["cache"].close()
+
+
+def _user_gets() -> int:
+    return datastore.OPERATIONS.value(operation="get", collection=datastore.USERS)
+
+
+def test_get_user_by_id_cached(_user_cache):
+    gets = _user_gets()
+    assert datastore.get_user_by_id("fb/12345") is None
+    assert datastore.get_user_by_id("fb/12345") is None  # cached as not registered
+    assert _user_gets() == gets + 1
+
+    datastore.insert_user(id="fb/12345", first_name="Bee", username="queen_bee")
+    user = datastore.get_user_by_id("fb/12345")
+    assert user.first_name == "Bee"
+    assert datastore.get_user_by_id("fb/12345") == user
+    assert _user_gets() == gets + 2
+
+
+def test_update_user(_user_cache):
+    datastore.insert_user(id="fb/12345", first_name="Bee", username="queen_bee")
+    user = datastore.get_user_by_id("fb/12345")
+
+    assert datastore.update_user(
+        user.model_copy(update={"first_name": "Honey", "username": "honey_bee"})
+    )
+    assert datastore.get_user_by_id("fb/12345").first_name == "Honey"  # not cached
+    assert datastore.get_user_by_username("honey_bee").id == "fb/12345"
+    assert datastore.get_user_by_username("queen_bee") is None
+    assert not datastore.update_user(
+        weaver.User(_id="fb/00000", username="drone", first_name="Drone")
+    )
+
+
+def test_delete_user(_user_cache):
+    datastore.insert_user(id="fb/12345", first_name="Bee", username="queen_bee")
+    datastore.get_user_by_id("fb/12345")
+
+    assert datastore.delete_user("fb/12345")
+    assert datastore.get_user_by_id("fb/12345") is None
+    assert datastore.get_user_by_username("queen_bee") is None
+    assert not datastore.delete_user("fb/12345")
+
+
+def test_clearall_clears_user_cache(_user_cache):
+    datastore.insert_user(id="fb/12345", first_name="Bee")
+    datastore.get_user_by_id("fb/12345")
+    datastore.clearall()
+    assert datastore.get_user_by_id("fb/12345") is None
+
+
+@pytest.fixture
+def _user_filters():
+    datastore.build_user_filters()
+    yield datastore.GLOBAL["user_filters"]
+    datastore.GLOBAL.pop("user_filters", None)
+
+
+def _filter_lookups(result: str) -> int:
+    return datastore.FILTER_LOOKUPS.value(filter=datastore.USERS, result=result)
+
+
+def test_user_filters_built_from_registered(_user_filters):
+    datastore.insert_user(id="fb/12345", first_name="Bee", username="queen_bee")
+    datastore.GLOBAL.pop("user_filters")
+    datastore.build_user_filters()
+
+    assert "fb/12345" in datastore.GLOBAL["user_filters"][datastore.USERS]
+    assert "queen_bee" in datastore.GLOBAL["user_filters"][datastore.USERNAME_TO_ID]
+    stats = datastore.user_filter_stats()
+    assert stats[datastore.USERS]["keys"] == 1
+    assert datastore.FILTER_BYTES.value(filter=datastore.USERS) == (
+        stats[datastore.USERS]["memory_bytes"]
+    )
+
+
+def test_user_registered_without_round_trip(_user_filters):
+    gets, negatives = _user_gets(), _filter_lookups("negative")
+    assert not datastore.user_registered("fb/12345")
+    assert _user_gets() == gets
+    assert _filter_lookups("negative") == negatives + 1
+
+    datastore.insert_user(id="fb/12345", first_name="Bee")
+    assert datastore.user_registered("fb/12345")
+    assert _user_gets() == gets + 1
+
+
+def test_user_registered_false_positive(_user_filters):
+    _user_filters[datastore.USERS].add("fb/12345")  # e.g. hashing like another id
+    false_positives = _filter_lookups("false_positive")
+    assert not datastore.user_registered("fb/12345")
+    assert _filter_lookups("false_positive") == false_positives + 1
+
+
+def test_user_registered_without_filters():
+    assert not datastore.user_registered("fb/12345")
+    datastore.insert_user(id="fb/12345", first_name="Bee")
+    assert datastore.user_registered("fb/12345")
+
+
+def test_deleted_user_looked_up(_user_filters):
+    datastore.insert_user(id="fb/12345", first_name="Bee", username="queen_bee")
+    datastore.delete_user("fb/12345")
+
+    # kept in the filters: answered by a lookup
+    assert "fb/12345" in _user_filters[datastore.USERS]
+    assert not datastore.user_registered("fb/12345")
+    assert datastore.username_available("queen_bee")
+
+
+def test_user_registered_by_another_worker_deleted_not_removed(_user_filters):
+    datastore.insert_user(id="fb/1", first_name="Bee", username="queen_bee")
+    _db().get_collection(datastore.USERS).insert_one(
+        {"_id": "fb/2", "username": "drone_bee", "first_name": "Drone"}
+    )
+    _db().get_collection(datastore.USERNAME_TO_ID).insert_one(
+        {"_id": "drone_bee", "id": "fb/2"}
+    )
+    counts = [keys.count for keys in _user_filters.values()]
+    datastore.delete_user("fb/2")  # never counted by this worker
+
+    assert [keys.count for keys in _user_filters.values()] == counts
+    assert datastore.user_registered("fb/1")
+    assert not datastore.username_available("queen_bee")
+
+
+def test_username_available(_user_filters):
+    datastore.insert_user(id="fb/12345", first_name="Bee", username="queen_bee")
+
+    assert datastore.username_available("honey_bee")
+    assert not datastore.username_available("queen_bee")
+    assert datastore.username_available("queen_bee", id="fb/12345")  # its own
+
+
+def test_update_user_filters(_user_filters):
+    datastore.insert_user(id="fb/12345", first_name="Bee", username="queen_bee")
+    user = datastore.get_user_by_id("fb/12345")
+    datastore.update_user(user.model_copy(update={"username": "honey_bee"}))
+
+    assert datastore.username_available("queen_bee")
+    assert not datastore.username_available("honey_bee")
+    assert datastore.get_user_by_username("queen_bee") is None
+
+
+def test_update_user_username_taken():
+    datastore.insert_user(id="fb/1", first_name="Bee", username="queen_bee")
+    datastore.insert_user(id="fb/2", first_name="Drone", username="drone_bee")
+    drone = datastore.get_user_by_id("fb/2")
+
+    with pytest.raises(ValueError):
+        datastore.update_user(drone.model_copy(update={"username": "queen_bee"}))
+    assert datastore.get_user_by_username("drone_bee").id == "fb/2"
+    assert datastore.get_user_by_username("queen_bee").id == "fb/1"
+
+
+def test_user_registered_by_another_worker_added_to_filter(_user_filters):
+    _db().get_collection(datastore.USERS).insert_one(
+        {"_id": "fb/12345", "username": "fb/12345", "first_name": "Bee"}
+    )
+    assert not datastore.user_registered("fb/12345")  # unseen by this worker
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        datastore.insert_user(id="fb/12345", first_name="Bee")
+    assert datastore.user_registered("fb/12345")
+
+
+def test_update_user_username_seen_taken_not_claimed(_user_filters):
+    datastore.insert_user(id="fb/1", first_name="Bee", username="queen_bee")
+    datastore.insert_user(id="fb/2", first_name="Drone", username="drone_bee")
+    drone = datastore.get_user_by_id("fb/2")
+    inserted = datastore.OPERATIONS.value(
+        operation="insert", collection=datastore.USERNAME_TO_ID
+    )
+
+    with pytest.raises(ValueError):
+        datastore.update_user(drone.model_copy(update={"username": "queen_bee"}))
+    assert (
+        datastore.OPERATIONS.value(
+            operation="insert", collection=datastore.USERNAME_TO_ID
+        )
+        == inserted
+    )
+
+
+def test_get_user_by_username_filtered(_user_filters):
+    negatives = datastore.FILTER_LOOKUPS.value(
+        filter=datastore.USERNAME_TO_ID, result="negative"
+    )
+    assert datastore.get_user_by_username("drone_bee") is None
+    assert (
+        datastore.FILTER_LOOKUPS.value(
+            filter=datastore.USERNAME_TO_ID, result="negative"
+        )
+        == negatives + 1
+    )
+
+
+def test_update_user_username_claimed_by_another_worker(_user_filters):
+    datastore.insert_user(id="fb/2", first_name="Drone", username="drone_bee")
+    _db().get_collection(datastore.USERNAME_TO_ID).insert_one(
+        {"_id": "queen_bee", "id": "fb/1"}
+    )
+    assert datastore.username_available("queen_bee")  # unseen by this worker
+    drone = datastore.get_user_by_id("fb/2")
+
+    with pytest.raises(ValueError):
+        datastore.update_user(drone.model_copy(update={"username": "queen_bee"}))
+    assert datastore.get_user_by_id("fb/2").username == "drone_bee"
+    assert datastore.get_user_by_username("drone_bee").id == "fb/2"
+    assert not datastore.username_available("queen_bee")
+
+
+def test_update_user_claims_username_before_releasing(mocker):
+    datastore.insert_user(id="fb/1", first_name="Bee", username="queen_bee")
+    user = datastore.get_user_by_id("fb/1")
+    mocker.patch.object(
+        datastore, "__update_collection", side_effect=RuntimeError("mongo down")
+    )
+
+    with pytest.raises(RuntimeError):
+        datastore.update_user(user.model_copy(update={"username": "honey_bee"}))
+    # the previous username still maps to the user
+    assert datastore.get_user_by_username("queen_bee").id == "fb/1"
+    mocker.stopall()
+    # the claimed one is taken over when updating again
+    assert datastore.update_user(user.model_copy(update={"username": "honey_bee"}))
+    assert datastore.get_user_by_username("honey_bee").id == "fb/1"
+    assert datastore.get_user_by_username("queen_bee") is None
+
+
+def test_clearall_rebuilds_user_filters(_user_filters):
+    datastore.insert_user(id="fb/12345", first_name="Bee")
+    datastore.clearall()
+    assert "fb/12345" not in datastore.GLOBAL["user_filters"][datastore.USERS]
+
+
+@pytest.fixture
+def _prompt_index():
+    yield
+    datastore.GLOBAL.pop("prompt_index", None)
+
+
+def _manager() -> dict:
+    return _db().get_collection(datastore.PROMPT_MANAGER).find_one("manager")
+
+
+def test_active_prompt(_prompt_index):
+    datastore.insert_prompt(
+        "Flowers?", __from_ts("2024-01-04 00:00:00"), __from_ts("2024-01-11 00:00:00")
+    )
+    datastore.insert_prompt(
+        "Parks?", __from_ts("2024-01-11 00:00:00"), __from_ts("2024-01-18 00:00:00")
+    )
+
+    assert datastore.active_prompt(__from_ts("2024-01-05 12:00:00")) == 0
+    assert datastore.active_prompt(__from_ts("2024-01-11 00:00:00")) == 1
+    assert datastore.active_prompt(__from_ts("2024-01-20 00:00:00")) is None
+
+
+def test_active_prompt_without_round_trip(_prompt_index):
+    datastore.insert_prompt(
+        "Flowers?", __from_ts("2024-01-04 00:00:00"), __from_ts("2024-01-11 00:00:00")
+    )
+    datastore.load_prompts()
+    scans = datastore.OPERATIONS.value(operation="scan", collection=datastore.PROMPTS)
+
+    for day in range(1, 20):
+        datastore.active_prompt(datetime(2024, 1, day))
+    assert (
+        datastore.OPERATIONS.value(operation="scan", collection=datastore.PROMPTS)
+        == scans
+    )
+
+
+def test_active_prompt_reloaded(_prompt_index, monkeypatch):
+    datastore.load_prompts()
+    # inserted by another worker
+    _db().get_collection(datastore.PROMPTS).insert_one(
+        {
+            "_id": 0,
+            "text": "Flowers?",
+            "begins": datetime(2024, 1, 4),
+            "ends": datetime(2024, 1, 11),
+        }
+    )
+    monkeypatch.setattr(datastore, "PROMPT_REFRESH_INTERVAL", 0)
+    assert datastore.active_prompt(datetime(2024, 1, 5)) is None  # never in the ingest
+    datastore.load_prompts()  # in the background
+    assert datastore.active_prompt(datetime(2024, 1, 5)) == 0
+
+
+def test_deleted_prompts_not_loaded(_prompt_index):
+    datastore.insert_prompt(
+        "Flowers?", __from_ts("2024-01-04 00:00:00"), __from_ts("2024-01-11 00:00:00")
+    )
+    _db().get_collection(datastore.PROMPT_MANAGER).update_one(
+        {"_id": "manager"}, {"$set": {"deleted_prompts": [0]}}
+    )
+    datastore.load_prompts()
+    assert datastore.active_prompt(datetime(2024, 1, 5)) is None
+
+
+def test_update_prompt(_prompt_index):
+    datastore.insert_prompt(
+        "Flowers?", __from_ts("2024-01-04 00:00:00"), __from_ts("2024-01-11 00:00:00")
+    )
+    datastore.load_prompts()
+    prompt = weaver.Prompt.model_validate(
+        _db().get_collection(datastore.PROMPTS).find_one(0)
+    )
+
+    assert datastore.update_prompt(
+        prompt.model_copy(update={"ends": datetime(2024, 1, 20), "text": "Trees?"})
+    )
+    assert datastore.active_prompt(datetime(2024, 1, 15)) == 0
+    assert _db().get_collection(datastore.PROMPTS).find_one(0)["text"] == "Trees?"
+    assert not datastore.update_prompt(prompt.model_copy(update={"id": 9}))
+
+
+def test_manager_active_prompt_maintained(_prompt_index):
+    now = datetime.utcnow()
+    datastore.load_prompts()
+    assert _manager().get("active_prompt") is None
+
+    datastore.insert_prompt("Now?", now - timedelta(days=1), now + timedelta(days=1))
+    assert _manager()["active_prompt"] == 0
+
+    datastore.insert_prompt("Later?", now + timedelta(days=1), now + timedelta(days=8))
+    assert _manager()["active_prompt"] == 0
+
+
+def _archive(id: str, ts: str, username: str, prompt_id: Optional[int]):
+    datastore.insert_voice(
+        id=id,
+        audio_extension="wav",
+        audio_content=b"Bzzz",
+        datetime=__from_ts(ts),
+        username=username,
+        prompt_id=prompt_id,
+    )
+
+
+def _voices(kind: weaver.RollupKind, key: str) -> int:
+    return datastore.get_rollup(kind, key).voices
+
+
+@pytest.fixture
+def _archived(_mock_voices_directory):
+    for voice in (
+        ("honeybee", "2024-01-03 19:30:00", "fb/1", 2),
+        ("bumblebee", "2024-01-04 10:00:00", "fb/1", 2),
+        ("wasp", "2024-01-04 07:00:00", "fb/2", 2),  # 23:00 the 3rd in Los Angeles
+        ("hornet", "2024-01-04 08:00:00", "fb/2", None),
+    ):
+        _archive(*voice)
+
+
+def test_rollups_counted_on_insert(_archived):
+    prompt = datastore.get_rollup(weaver.RollupKind.PROMPT, "2")
+    assert (prompt.voices, prompt.participants) == (3, 2)
+    assert _voices(weaver.RollupKind.USER, "fb/1") == 2
+    assert _voices(weaver.RollupKind.USER, "fb/2") == 2
+    assert _voices(weaver.RollupKind.DAY, "2024-01-03") == 1
+    assert _voices(weaver.RollupKind.DAY, "2024-01-04") == 3
+    assert _voices(weaver.RollupKind.LOCAL_DAY, "2024-01-03") == 2
+    assert _voices(weaver.RollupKind.LOCAL_DAY, "2024-01-04") == 2
+
+
+def test_rollup_not_counted():
+    prompt = datastore.get_rollup(weaver.RollupKind.PROMPT, "9")
+    assert (prompt.voices, prompt.participants) == (0, 0)
+    assert datastore.get_rollup(weaver.RollupKind.USER, "fb/0").participants is None
+
+
+def test_rollups_counted_on_delete(_archived):
+    assert datastore.delete_voice("wasp")
+    prompt = datastore.get_rollup(weaver.RollupKind.PROMPT, "2")
+    assert (prompt.voices, prompt.participants) == (2, 1)
+    assert _voices(weaver.RollupKind.USER, "fb/2") == 1
+    assert [rollup.user for rollup in datastore.get_top_contributors(2, 10)] == ["fb/1"]
+
+    assert datastore.delete_voice("bumblebee")
+    prompt = datastore.get_rollup(weaver.RollupKind.PROMPT, "2")
+    assert (prompt.voices, prompt.participants) == (1, 1)  # fb/1 still answered
+
+
+def test_rollups_moved_on_update(_archived):
+    datastore.update_metadata("wasp", weaver.VoiceMetadataUpdate(prompt_id=3))
+    assert _voices(weaver.RollupKind.PROMPT, "2") == 2
+    assert datastore.get_rollup(weaver.RollupKind.PROMPT, "3").participants == 1
+
+    datastore.update_metadata("wasp", weaver.VoiceMetadataUpdate(gain_db=1.0))
+    assert _voices(weaver.RollupKind.PROMPT, "3") == 1  # not counted again
+
+
+def test_top_contributors(_archived):
+    _archive("drone", "2024-01-05 10:00:00", "fb/3", 2)
+    top = datastore.get_top_contributors(2, 2)
+    assert [(rollup.user, rollup.voices) for rollup in top] == [
+        ("fb/1", 2),
+        ("fb/2", 1),
+    ]
+
+
+def test_rebuild_rollups(_archived):
+    counted = sorted(_db().get_collection(datastore.ROLLUPS).find(), key=str)
+    _db().get_collection(datastore.ROLLUPS).delete_many({})
+    _db().get_collection(datastore.ROLLUPS).insert_one(
+        {"_id": "user/fb/gone", "kind": "user", "key": "fb/gone", "voices": 3}
+    )
+
+    assert datastore.rebuild_rollups() == len(counted)
+    assert sorted(_db().get_collection(datastore.ROLLUPS).find(), key=str) == counted
+    assert _voices(weaver.RollupKind.USER, "fb/gone") == 0
+
+
+def test_rebuild_rollups_empty(_archived):
+    for id in ("honeybee", "bumblebee", "wasp", "hornet"):
+        datastore.delete_voice(id)
+    assert datastore.rebuild_rollups() == 0
+    assert _voices(weaver.RollupKind.USER, "fb/1") == 0
+    indexes = _db().get_collection(datastore.ROLLUPS).index_information()
+    assert [("kind", 1), ("prompt", 1), ("voices", -1)] in [
+        index["key"] for index in indexes.values()
+    ]
+
+
+def test_rollups_not_decremented_if_never_counted(_archived):
+    _db().get_collection(datastore.ROLLUPS).delete_many({})  # e.g. archived before
+    assert datastore.delete_voice("wasp")
+    assert _db().get_collection(datastore.ROLLUPS).count_documents({}) == 0
+
+    datastore.rebuild_rollups()
+    _db().get_collection(datastore.ROLLUPS).delete_one({"_id": "prompt_user/2/fb/1"})
+    assert datastore.delete_voice("honeybee")  # fb/1's answer to 2 not counted
+    prompt = datastore.get_rollup(weaver.RollupKind.PROMPT, "2")
+    assert (prompt.voices, prompt.participants) == (1, 1)
+    assert datastore.delete_voice("bumblebee")
+    prompt = datastore.get_rollup(weaver.RollupKind.PROMPT, "2")
+    assert (prompt.voices, prompt.participants) == (0, 1)  # clamped at zero
+
+
+def test_rollup_failure_keeps_voice(_mock_voices_directory, mocker):
+    mocker.patch("pymongo.UpdateOne", side_effect=RuntimeError("boom"))
+    _archive("honeybee", "2024-01-03 19:30:00", "fb/1", 2)
+    assert datastore.get_metadata("honeybee") is not None
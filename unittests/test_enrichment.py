@@ -0,0 +1,98 @@
+"""
+unittests.test_enrichment.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.enrichment stages
+"""
+import tempfile
+from pathlib import Path
+
+import mongomock
+import numpy as np
+import pytest
+
+from api import audio, datastore, enrichment
+from models import weaver
+
+
+@pytest.fixture(autouse=True)
+def _mock_voices_directory():
+    """Patch the voices directory to a temp dir instead of disk."""
+    old = datastore.VOICES_DIR
+    tmpdir = tempfile.TemporaryDirectory()
+    datastore.VOICES_DIR = Path(tmpdir.name)
+    yield
+    tmpdir.cleanup()
+    datastore.VOICES_DIR = old
+
+
+@pytest.fixture(autouse=True)
+def _auto_mongomock_client_patch():
+    """Mock the Mongo client. Remove at teardown."""
+    datastore.GLOBAL.update(db_client=mongomock.MongoClient())
+    yield
+    datastore.GLOBAL.pop("db_client", None)
+
+
+def _insert_metadata(id: str):
+    datastore.GLOBAL["db_client"].sounds.get_collection(datastore.METADATAS).insert_one(
+        weaver.VoiceMetadata(
+            _id=id,
+            datetime="2024-01-03T19:30:00",
+            audio_extension="wav",
+            username="fb/12345",
+            prompt_id=2,
+        ).model_dump(by_alias=True)
+    )
+
+
+def test_decode_voice_undecodable():
+    assert enrichment.decode_voice(b"blub bluuub blub", "wav") is None
+
+
+def test_enrich_voice_stores_waveform():
+    _insert_metadata("honeybee")
+    samples = np.linspace(-1, 1, audio.SAMPLE_RATE, dtype=np.float32)
+    enrichment.enrich_voice("honeybee", samples)
+
+    peaks = audio.unpack_peaks(datastore.get_waveform("honeybee"))
+    assert sorted(peaks) == sorted(audio.WAVEFORM_LEVELS)
+    assert datastore.get_similar_voices(["honeybee"]) == [[]]
+
+
+def test_enrich_voice_stores_levels():
+    _insert_metadata("honeybee")
+    samples = np.zeros(audio.SAMPLE_RATE * 2, dtype=np.float32)
+    samples[audio.SAMPLE_RATE : audio.SAMPLE_RATE + 1600] = 0.1
+    enrichment.enrich_voice("honeybee", samples, stages=["levels"])
+
+    metadata = datastore.get_metadata("honeybee")
+    assert metadata.trim_start == pytest.approx(1 - audio.TRIM_PADDING, abs=0.03)
+    assert metadata.gain_db == audio.levels(samples)[2]
+    # Only the levels stage ran
+    assert datastore.get_waveform("honeybee") is None
+
+
+def test_enrich_voice_levels_without_metadata(caplog):
+    enrichment.enrich_voice("honeybee", np.ones(100, dtype=np.float32), ["levels"])
+    assert "No metadata for voice honeybee" in caplog.text
+
+
+def test_enrich_voice_stage_failure_is_skipped(mocker):
+    mocker.patch("api.datastore.insert_waveform", side_effect=OSError("disk full"))
+    enrichment.enrich_voice("honeybee", np.zeros(10, dtype=np.float32))
+
+
+def test_enrich_all(test_fixture_make_wav):
+    (datastore.VOICES_DIR / "honeybee.wav").write_bytes(
+        test_fixture_make_wav(np.zeros(audio.SAMPLE_RATE))
+    )
+    (datastore.VOICES_DIR / "bumblebee.wav").write_bytes(b"Buzz buzzzzz bizz zzzz ~")
+
+    assert enrichment.enrich_all() == 1
+    assert datastore.get_waveform("honeybee") is not None
+    assert datastore.get_waveform("bumblebee") is None
+
+
+def test_enrich_all_unknown_stage():
+    with pytest.raises(ValueError):
+        enrichment.enrich_all(["waveform", "sparkles"])
@@ -0,0 +1,126 @@
+"""
+unittests.test_jobqueue.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.jobqueue
+"""
+import sqlite3
+
+import pytest
+
+from api import jobqueue
+
+
+@pytest.fixture
+def _queue(tmp_path) -> jobqueue.JobQueue:
+    queue = jobqueue.JobQueue(tmp_path / "jobs.sqlite", lease=60, max_attempts=2)
+    yield queue
+    queue.close()
+
+
+def test_enqueued_jobs_are_claimed(_queue):
+    ids = _queue.enqueue([("12345", "m1", "{}"), ("12345", "m2", "{}")])
+    assert ids == sorted(ids)
+    assert _queue.counts() == {"pending": 0, "running": 2, "failed": 0}
+    # Held by the enqueuing worker until its lease expires
+    assert _queue.claim_due() == []
+
+
+def test_orphaned_jobs_survive_restart(_queue, tmp_path):
+    (id,) = _queue.enqueue([("12345", "m1", "payload")])
+    _queue.close()
+
+    restarted = jobqueue.JobQueue(tmp_path / "jobs.sqlite", lease=0)
+    assert restarted.claim_due() == [(id, "payload")]
+    restarted.complete(id)
+    assert sum(restarted.counts().values()) == 0
+    restarted.close()
+
+
+def _owned_by(queue: jobqueue.JobQueue, owner: str):
+    with queue._lock:
+        queue._connection.execute("UPDATE jobs SET worker = ?", (owner,))
+
+
+def test_jobs_of_dead_worker_reclaimed_before_lease(_queue):
+    (id,) = _queue.enqueue([("12345", "m1", "payload")])
+    pid = 2**22 + 1  # above pid_max: never running
+    _owned_by(_queue, f"{jobqueue.socket.gethostname()}:{pid}:123")
+
+    assert _queue.claim_due() == [(id, "payload")]
+    assert _queue.claim_due() == []  # claimed by this worker now
+
+
+def test_jobs_of_live_worker_kept(_queue):
+    _queue.enqueue([("12345", "m1", "payload")])
+    assert _queue.claim_due() == []  # this worker's
+    _owned_by(_queue, jobqueue.worker(1))  # running, e.g. init
+    assert _queue.claim_due() == []
+    # a pid reused by another process
+    _owned_by(_queue, f"{jobqueue.socket.gethostname()}:1:0")
+    assert len(_queue.claim_due()) == 1
+
+
+def test_jobs_of_other_host_left_to_lease(_queue):
+    _queue.enqueue([("12345", "m1", "payload")])
+    _owned_by(_queue, "another-host:1:0")
+    assert _queue.claim_due() == []
+
+
+def test_worker():
+    assert jobqueue.worker() == jobqueue.worker(jobqueue.os.getpid())
+    assert jobqueue.worker(2**22 + 1) is None
+
+
+def test_queue_of_previous_version_migrated(tmp_path):
+    connection = sqlite3.connect(tmp_path / "jobs.sqlite")
+    connection.execute(
+        "CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, sender_id TEXT NOT NULL,"
+        " mid TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL,"
+        " attempts INTEGER NOT NULL DEFAULT 1, created_at REAL NOT NULL,"
+        " available_at REAL NOT NULL, claimed_at REAL, error TEXT)"
+    )
+    connection.close()
+
+    queue = jobqueue.JobQueue(tmp_path / "jobs.sqlite")
+    assert queue.enqueue([("12345", "m1", "payload")])
+    queue.close()
+
+
+def test_failed_jobs_retried_after_backoff(_queue, monkeypatch):
+    (id,) = _queue.enqueue([("12345", "m1", "payload")])
+    assert _queue.fail(id, "graph down")
+    assert _queue.claim_due() == []  # backing off
+
+    monkeypatch.setattr(jobqueue, "RETRY_BACKOFF", 0)
+    assert _queue.fail(id, "graph down")  # hasn't been claimed again: same attempt
+    assert _queue.claim_due() == [(id, "payload")]
+    # Out of attempts
+    assert not _queue.fail(id, "graph down")
+    assert _queue.counts() == {"pending": 0, "running": 0, "failed": 1}
+
+
+def test_fail_without_retry(_queue):
+    (id,) = _queue.enqueue([("12345", "m1", "payload")])
+    assert not _queue.fail(id, "not an audio", retry=False)
+    assert not _queue.fail(404, "unknown job")
+    assert _queue.counts()["failed"] == 1
+
+
+def test_deferred_job_due_without_using_an_attempt(_queue, monkeypatch):
+    monkeypatch.setattr(jobqueue, "RETRY_BACKOFF", 0)
+    (id,) = _queue.enqueue([("12345", "m1", "payload")])
+    _queue.defer(id)
+    assert _queue.counts()["pending"] == 1
+    assert _queue.claim_due() == [(id, "payload")]
+    assert _queue.fail(id, "graph down")  # still its first attempt
+    assert _queue.claim_due() == [(id, "payload")]
+    assert not _queue.fail(id, "graph down")
+
+
+def test_queue_cached_per_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobqueue, "GLOBAL", {})
+    monkeypatch.setattr(jobqueue, "QUEUE_PATH", tmp_path / "jobs.sqlite")
+    assert jobqueue.queue() is jobqueue.queue()
+    jobqueue.queue().enqueue([("12345", "m1", "payload")])
+    jobqueue.update_metrics()
+    assert jobqueue.JOBS.value(status="running") == 1
@@ -0,0 +1,85 @@
+"""
+unittests.test_logs.py
+~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.logs
+"""
+import io
+import json
+import logging
+
+import pytest
+
+from api import logs, tracing
+from models import facebook
+
+
+@pytest.fixture
+def _logger() -> logging.Logger:
+    logger = logging.getLogger("unittests.test_logs")
+    logger.setLevel(logging.INFO)
+    yield logger
+    logger.setLevel(logging.NOTSET)
+
+
+def test_payload_rendered_only_when_emitted(_logger, mocker):
+    render = mocker.spy(logs.Payload, "_render")
+    _logger.debug("Data event: %s", logs.payload({"mid": "m_1"}))
+    render.assert_not_called()
+
+    payload = logs.payload({"mid": "m_1"})
+    assert f"{payload} {payload}" == '{"mid": "m_1"} {"mid": "m_1"}'
+    render.assert_called_once()
+
+
+def test_payload_of_model(test_fixture_valid_message):
+    message = facebook.Message(**test_fixture_valid_message)
+    assert json.loads(str(logs.payload(message))) == json.loads(
+        message.model_dump_json(exclude_none=True)
+    )
+
+
+def test_payload_truncated(monkeypatch):
+    monkeypatch.setattr(logs, "LOG_PAYLOAD_MAX_CHARS", 10)
+    assert str(logs.payload("buzz" * 10)) == "buzzbuzzbu... (40 chars)"
+    assert str(logs.payload(b"buzz")) == "buzz"
+
+
+def test_payload_sampled_out(monkeypatch):
+    monkeypatch.setattr(logs, "LOG_PAYLOAD_SAMPLE_RATE", 0.0)
+    assert str(logs.payload({"mid": "m_1"})) == "<payload not sampled>"
+
+
+def test_structured_format(_logger, monkeypatch, tmp_path):
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logs.StructuredFormatter())
+    _logger.addHandler(handler)
+    monkeypatch.setattr(tracing, "TRACE_EXPORT", str(tmp_path / "spans.jsonl"))
+    monkeypatch.setattr(tracing, "GLOBAL", {})
+    root = tracing.trace("webhook.messaging")
+    try:
+        _logger.info("Data event: %s", logs.payload({"mid": "m_1"}))
+        tracing.context(root).run(_logger.warning, "Voice %s archived.", "m_1")
+    finally:
+        _logger.removeHandler(handler)
+
+    first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert first["message"] == 'Data event: {"mid": "m_1"}'
+    assert first["level"] == "INFO"
+    assert first["logger"] == "unittests.test_logs"
+    assert "trace_id" not in first
+    assert second["trace_id"] == root.trace_id
+
+
+def test_configure_json_idempotent():
+    stream = io.StringIO()
+    root = logging.getLogger()
+    level = root.level
+    try:
+        handler = logs.configure(format="json", level="WARNING", stream=stream)
+        assert logs.configure(format="json", stream=stream) is handler
+        assert root.level == logging.WARNING
+        assert logs.configure(format="text") is None
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
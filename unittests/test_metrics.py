@@ -0,0 +1,80 @@
+"""
+unittests.test_metrics.py
+~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.metrics
+"""
+import pytest
+
+from api import metrics
+
+
+@pytest.fixture
+def _registry(monkeypatch) -> dict:
+    registry = {}
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    return registry
+
+
+def test_counter_and_gauge(_registry):
+    requests = metrics.counter("requests_total", "Requests.", ("method",))
+    requests.inc(method="GET")
+    requests.inc(2, method="GET")
+    queue = metrics.gauge("queue_depth", "Queue depth.")
+    queue.set(5)
+    queue.dec()
+
+    assert requests.value(method="GET") == 3
+    assert requests.value(method="POST") == 0
+    assert queue.value() == 4
+
+
+def test_register_returns_existing_metric(_registry):
+    assert metrics.counter("requests_total", "Requests.") is metrics.counter(
+        "requests_total", "Requests."
+    )
+    assert list(_registry) == ["requests_total"]
+
+
+def test_render(_registry):
+    metrics.counter("requests_total", "Requests.", ("path",)).inc(path='/"a"')
+    metrics.gauge("latency_seconds", "Latency.").set(0.25)
+
+    assert metrics.render() == (
+        "# HELP requests_total Requests.\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{path="/\\"a\\""} 1\n'
+        "# HELP latency_seconds Latency.\n"
+        "# TYPE latency_seconds gauge\n"
+        "latency_seconds 0.25\n"
+    )
+
+
+def test_histogram(_registry):
+    latency = metrics.histogram("latency_seconds", "Latency.", ("stage",), (0.1, 1))
+    latency.observe(0.05, stage="download")
+    latency.observe(0.1, stage="download")
+    latency.observe(5, stage="download")
+
+    assert latency.value(stage="download") == 3
+    assert latency.sum(stage="download") == pytest.approx(5.15)
+    assert latency.value(stage="reply") == 0
+    assert metrics.render() == (
+        "# HELP latency_seconds Latency.\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{stage="download",le="0.1"} 2\n'
+        'latency_seconds_bucket{stage="download",le="1.0"} 2\n'
+        'latency_seconds_bucket{stage="download",le="+Inf"} 3\n'
+        'latency_seconds_sum{stage="download"} 5.15\n'
+        'latency_seconds_count{stage="download"} 3\n'
+    )
+
+
+def test_histogram_time_observes_on_raise(_registry):
+    latency = metrics.histogram("latency_seconds", "Latency.")
+    with latency.time():
+        pass
+    with pytest.raises(ValueError):
+        with latency.time():
+            raise ValueError("boom")
+
+    assert latency.value() == 2
@@ -6,6 +6,7 @@ todo: Use examples here for testing instead
 https://developers.facebook.com/docs/messenger-platform/reference/webhook-events/messages
 """
 
+import json
 from pprint import pformat as pf
 
 import pytest
@@ -49,6 +50,25 @@ class TestFacebook:
         with pytest.raises(ValidationError):
             facebook.Event.model_validate(test_fixture_invalid_event)
 
+    def test_valid_webhook_event(self, test_fixture_valid_event):
+        body = json.dumps(test_fixture_valid_event)
+        event = facebook.WebhookEvent.model_validate_json(body)
+        full = facebook.Event.model_validate_json(body)
+        messaging = event.entry[0].messaging[0]
+        assert messaging.sender == full.entry[0].messaging[0].sender
+        assert messaging.message.mid == full.entry[0].messaging[0].message.mid
+        assert (
+            messaging.message.attachments
+            == full.entry[0].messaging[0].message.attachments
+        )
+        assert "text" not in messaging.message.model_dump()  # skipped
+
+    def test_invalid_webhook_event(self, test_fixture_invalid_event):
+        with pytest.raises(ValidationError):
+            facebook.WebhookEvent.model_validate_json(
+                json.dumps(test_fixture_invalid_event)
+            )
+
 
 class TestWeaver:
     """Test weaver models"""
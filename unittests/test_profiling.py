@@ -0,0 +1,135 @@
+"""
+unittests.test_profiling.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.profiling
+"""
+import contextvars
+import marshal
+import pickle
+import threading
+import tracemalloc
+from pprint import pformat
+
+import pytest
+
+from api import profiling
+
+
+def _work():
+    return pformat({"bee": list(range(200))})
+
+
+def test_cpu_profiles_next_requests():
+    cpu = profiling.CpuProfiler()
+    with cpu.request() as profiled:
+        assert not profiled  # not started
+
+    cpu.start(2)
+    for _ in range(3):
+        with cpu.request():
+            _work()
+
+    assert cpu.profiled == 2
+    assert cpu.remaining == 0
+    report = cpu.report()
+    assert report.startswith("2 requests profiled")
+    assert "pformat" in report.splitlines()[1]
+    assert any(function == "_work" for _, _, function in marshal.loads(cpu.dump()))
+
+
+def test_cpu_profiles_jobs_of_profiled_requests():
+    cpu = profiling.CpuProfiler()
+    cpu.start(1)
+    with cpu.request():
+        thread = threading.Thread(
+            target=contextvars.copy_context().run, args=(_job, cpu)
+        )
+        thread.start()
+        thread.join()
+    with cpu.job():  # not from a profiled request
+        pass
+
+    assert any(function == "_work" for _, _, function in marshal.loads(cpu.dump()))
+
+
+def _job(cpu: profiling.CpuProfiler):
+    with cpu.job():
+        _work()
+
+
+def test_cpu_profiles_concurrent_jobs():
+    cpu = profiling.CpuProfiler()
+    cpu.start(1)
+    with cpu.request():
+        started, done = threading.Barrier(2), []
+
+        def job():
+            with cpu.job():
+                started.wait(timeout=5)  # both profiled at once
+                _work()
+            done.append(True)
+
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(job,))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert done == [True, True]
+    assert cpu.dump() is not None
+
+
+def test_cpu_profiler_already_active_runs_unprofiled(monkeypatch):
+    class ActiveProfile(profiling.cProfile.Profile):
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(profiling.cProfile, "Profile", ActiveProfile)
+    cpu = profiling.CpuProfiler()
+    cpu.start(1)
+    ran = []
+    with cpu.request():
+        with cpu.job():
+            ran.append(True)
+
+    assert ran == [True]
+    assert cpu.dump() is None
+
+
+def test_cpu_sample_rate(monkeypatch):
+    cpu = profiling.CpuProfiler()
+    cpu.start(1, sample_rate=0.5)
+    monkeypatch.setattr(profiling.random, "random", lambda: 0.7)
+    with cpu.request() as profiled:
+        assert not profiled
+    monkeypatch.setattr(profiling.random, "random", lambda: 0.2)
+    with cpu.request() as profiled:
+        assert profiled
+    assert cpu.report() is not None
+
+
+def test_cpu_nothing_profiled():
+    cpu = profiling.CpuProfiler()
+    assert cpu.dump() is None
+    assert cpu.report() is None
+
+
+def test_memory_report_and_snapshot():
+    memory = profiling.MemoryProfiler()
+    with pytest.raises(ValueError):
+        memory.report()
+
+    memory.start(frames=5)
+    try:
+        retained = [bytearray(1024) for _ in range(100)]
+        report = memory.report(limit=5)
+        assert report.startswith("Traced")
+        assert "test_profiling.py" in report
+        assert isinstance(pickle.loads(memory.snapshot()), tracemalloc.Snapshot)
+    finally:
+        memory.stop()
+    assert not memory.tracing
+    assert retained
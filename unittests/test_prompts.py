@@ -0,0 +1,89 @@
+"""
+unittests.test_prompts.py
+~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.prompts
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from api import prompts
+
+
+def __at(day: int, hour: int = 0) -> datetime:
+    return datetime(2024, 1, day, hour)
+
+
+@pytest.fixture
+def _index() -> prompts.PromptIndex:
+    return prompts.PromptIndex(
+        {
+            0: (__at(1), __at(8)),
+            1: (__at(8), __at(15)),
+            2: (__at(10), __at(12)),  # within the window of 1
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "at, expected",
+    [
+        (__at(1), 0),  # begins included
+        (__at(7, 23), 0),
+        (__at(8), 1),  # ends excluded
+        (__at(10), 2),  # the latest begun of the overlapping ones
+        (__at(12), 1),  # open again once the later one ended
+        (__at(15), None),  # expired
+        (__at(20), None),
+        (datetime(2023, 12, 31), None),  # none open yet
+    ],
+)
+def test_active(_index, at, expected):
+    assert _index.active(at) == expected
+
+
+def test_same_begins_highest_id():
+    index = prompts.PromptIndex({3: (__at(1), __at(5)), 4: (__at(1), __at(3))})
+    assert index.active(__at(2)) == 4
+    assert index.active(__at(4)) == 3
+
+
+def test_aware_datetimes_compared_in_utc(_index):
+    pacific = timezone(timedelta(hours=-8))
+    assert _index.active(datetime(2024, 1, 7, 20, tzinfo=pacific)) == 1  # 8th 04:00 UTC
+
+
+def test_empty_window_ignored():
+    index = prompts.PromptIndex({0: (__at(5), __at(5)), 1: (__at(6), __at(4))})
+    assert index.active(__at(5)) is None
+    assert len(index) == 2
+
+
+def test_empty_index():
+    assert prompts.PromptIndex().active(__at(1)) is None
+
+
+def test_with_window(_index):
+    moved = _index.with_window(2, __at(20), __at(22))
+    assert moved.active(__at(10)) == 1
+    assert moved.active(__at(21)) == 2
+    assert _index.active(__at(10)) == 2  # unchanged
+
+
+def test_matches_linear_scan():
+    rng = random.Random(0)
+    windows = {}
+    for id in range(200):
+        begins = __at(1) + timedelta(hours=rng.randrange(24 * 60))
+        windows[id] = (begins, begins + timedelta(hours=rng.randrange(1, 24 * 14)))
+    index = prompts.PromptIndex(windows)
+
+    for _ in range(500):
+        at = __at(1) + timedelta(minutes=rng.randrange(60 * 24 * 80))
+        open_ = [
+            (begins, id)
+            for id, (begins, ends) in windows.items()
+            if begins <= at < ends
+        ]
+        assert index.active(at) == (max(open_)[1] if open_ else None)
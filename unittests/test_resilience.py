@@ -0,0 +1,121 @@
+"""
+unittests.test_resilience.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.resilience
+"""
+import pytest
+import requests
+import urllib3
+
+from api import resilience
+
+
+def test_call_passes_timeouts(mocker):
+    method = mocker.Mock(return_value=mocker.Mock(status_code=200))
+    assert (
+        resilience.call(resilience.CDN, method, "url", stream=True).status_code == 200
+    )
+    method.assert_called_once_with(
+        "url", timeout=resilience.TIMEOUTS[resilience.CDN], stream=True
+    )
+
+
+def test_call_retries_connection_errors(mocker):
+    method = mocker.Mock(
+        side_effect=[requests.exceptions.ConnectTimeout(), mocker.Mock(status_code=200)]
+    )
+    assert resilience.call(resilience.GRAPH, method, "url").status_code == 200
+    assert method.call_count == 2
+
+
+def test_call_retries_server_errors(mocker):
+    method = mocker.Mock(return_value=mocker.Mock(status_code=503))
+    assert resilience.call(resilience.GRAPH, method, "url").status_code == 503
+    assert method.call_count == resilience.ATTEMPTS
+
+
+def test_call_client_errors_not_retried(mocker):
+    method = mocker.Mock(return_value=mocker.Mock(status_code=404))
+    resilience.call(resilience.GRAPH, method, "url")
+    assert method.call_count == 1
+    assert resilience.BREAKERS[resilience.GRAPH].state == resilience.CLOSED
+
+
+def test_call_not_idempotent_read_timeout_not_retried(mocker):
+    method = mocker.Mock(side_effect=requests.exceptions.ReadTimeout())
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        resilience.call(resilience.GRAPH, method, "url", idempotent=False)
+    assert method.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        requests.exceptions.ConnectTimeout(),
+        requests.exceptions.ConnectionError(
+            urllib3.exceptions.MaxRetryError(
+                None,
+                "url",
+                urllib3.exceptions.NewConnectionError(None, "Connection refused"),
+            )
+        ),
+    ],
+)
+def test_call_not_idempotent_never_sent_retried(mocker, error):
+    method = mocker.Mock(side_effect=[error, mocker.Mock(status_code=200)])
+    response = resilience.call(resilience.GRAPH, method, "url", idempotent=False)
+    assert response.status_code == 200
+    assert method.call_count == 2
+
+
+def test_call_not_idempotent_connection_aborted_not_retried(mocker):
+    error = requests.exceptions.ConnectionError(
+        urllib3.exceptions.ProtocolError(
+            "Connection aborted.", ConnectionResetError(104, "Connection reset by peer")
+        )
+    )
+    method = mocker.Mock(side_effect=error)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        resilience.call(resilience.GRAPH, method, "url", idempotent=False)
+    assert method.call_count == 1
+
+
+def test_circuit_opens_and_fails_fast(mocker):
+    method = mocker.Mock(side_effect=requests.exceptions.ConnectionError())
+    rejected = resilience.CALLS.value(upstream=resilience.GRAPH, outcome="rejected")
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            resilience.call(resilience.GRAPH, method, "url")
+    # The 5th failure opened the circuit, the 6th call never reached upstream
+    assert method.call_count == resilience.FAILURE_THRESHOLD
+    assert resilience.CIRCUIT_STATE.value(upstream=resilience.GRAPH) == resilience.OPEN
+    assert (
+        resilience.CALLS.value(upstream=resilience.GRAPH, outcome="rejected")
+        == rejected + 1
+    )
+
+    with pytest.raises(resilience.CircuitOpenError):
+        resilience.call(resilience.GRAPH, method, "url")
+    # Other upstreams are unaffected
+    assert resilience.BREAKERS[resilience.CDN].allow()
+
+
+def test_circuit_half_open_trial(monkeypatch):
+    breaker = resilience.CircuitBreaker("test", failure_threshold=1, reset_timeout=10)
+    now = [100.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+
+    breaker.record(success=False)
+    now[0] = 105.0
+    assert not breaker.allow()
+    now[0] = 111.0
+    assert breaker.allow()  # the trial call
+    assert breaker.state == resilience.HALF_OPEN
+    assert not breaker.allow()  # only one trial
+    breaker.record(success=False)
+    assert breaker.state == resilience.OPEN
+
+    now[0] = 122.0
+    assert breaker.allow()
+    breaker.record(success=True)
+    assert breaker.state == resilience.CLOSED
@@ -0,0 +1,75 @@
+"""
+unittests.test_sharding.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.sharding
+"""
+import threading
+
+import pytest
+
+from api import sharding
+
+
+@pytest.fixture
+def _executor() -> sharding.ShardedExecutor:
+    return sharding.ShardedExecutor(shards=4, max_depth=8)
+
+
+def _keys_on_distinct_shards(executor: sharding.ShardedExecutor) -> tuple[str, str]:
+    keys = {}
+    for i in range(100):
+        keys.setdefault(executor.shard(f"user{i}"), f"user{i}")
+    first, second = list(keys.values())[:2]
+    return first, second
+
+
+def test_shard_is_stable(_executor):
+    assert _executor.shard("12345") == _executor.shard("12345")
+    assert 0 <= _executor.shard("12345") < len(_executor)
+
+
+def test_same_key_runs_in_order(_executor):
+    processed = []
+    futures = [_executor.submit("12345", processed.append, i) for i in range(50)]
+    for future in futures:
+        future.result()
+    assert processed == list(range(50))
+
+
+def test_keys_on_other_shards_proceed(_executor):
+    hot, other = _keys_on_distinct_shards(_executor)
+    blocked = threading.Event()
+    _executor.submit(hot, blocked.wait, 5)
+    shard = _executor.shard(hot)
+    assert _executor.depth(shard) == 1
+    assert sharding.QUEUE_DEPTH.value(shard=shard) >= 1
+
+    # Not held up by the hot key
+    assert _executor.submit(other, lambda: "done").result(timeout=1) == "done"
+    blocked.set()
+
+
+def test_depth_drops_when_done(_executor):
+    shard = _executor.shard("12345")
+    _executor.submit("12345", lambda: None)
+    # The shard runs the item, then its done callback, before the next item
+    depth = _executor.submit("12345", _executor.depth, shard).result()
+    assert depth == 1
+
+
+def test_failure_logged(_executor, caplog):
+    def fail():
+        raise RuntimeError("reply failed")
+
+    future = _executor.submit("12345", fail)
+    _executor.submit("12345", lambda: None).result()  # ran after the done callback
+
+    assert isinstance(future.exception(), RuntimeError)
+    (record,) = [r for r in caplog.records if r.name == sharding.LOGGER.name]
+    assert record.levelname == "ERROR"
+    assert record.exc_info[1] is future.exception()
+
+
+def test_invalid_configuration():
+    with pytest.raises(ValueError):
+        sharding.ShardedExecutor(shards=0, max_depth=1)
@@ -0,0 +1,118 @@
+"""
+unittests.test_similarity.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.similarity nearest-neighbour index
+"""
+import numpy as np
+import pytest
+
+from api import similarity
+
+DIM = 8
+
+
+@pytest.fixture
+def _index(tmp_path) -> similarity.EmbeddingIndex:
+    return similarity.EmbeddingIndex(tmp_path, dim=DIM)
+
+
+def _unit(*values: float) -> np.ndarray:
+    vector = np.zeros(DIM, dtype=np.float32)
+    vector[: len(values)] = values
+    return vector / np.linalg.norm(vector)
+
+
+def _random_unit(count: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_search_ranks_by_cosine(_index):
+    _index.add("honeybee", _unit(1, 0))
+    _index.add("bumblebee", _unit(1, 1))
+    _index.add("wasp", _unit(0, 1))
+
+    (neighbours,) = _index.search(_unit(1, 0.1), k=2)
+    assert [id for id, _ in neighbours] == ["honeybee", "bumblebee"]
+    assert neighbours[0][1] == pytest.approx(1 / np.sqrt(1.01))
+
+
+def test_similar_excludes_itself(_index):
+    _index.add("honeybee", _unit(1, 0))
+    _index.add("bumblebee", _unit(1, 1))
+    assert [id for id, _ in _index.similar("honeybee")] == ["bumblebee"]
+    assert _index.similar("wasp") is None
+
+
+def test_batched_search(_index):
+    for id, vector in zip("abc", (_unit(1), _unit(0, 1), _unit(0, 0, 1))):
+        _index.add(id, vector)
+    results = _index.search(np.stack((_unit(0, 0, 1), _unit(0, 1))), k=1)
+    assert [[id for id, _ in neighbours] for neighbours in results] == [["c"], ["b"]]
+
+
+def test_remove_reuses_row(_index):
+    _index.add("honeybee", _unit(1))
+    _index.add("bumblebee", _unit(0, 1))
+    assert _index.remove("honeybee")
+    assert not _index.remove("honeybee")
+    assert "honeybee" not in _index
+    assert [id for id, _ in _index.search(_unit(1), k=5)[0]] == ["bumblebee"]
+
+    _index.add("wasp", _unit(1))
+    assert len(_index) == 2
+    assert (_index.directory / "embeddings.f32").stat().st_size == (
+        similarity.INITIAL_CAPACITY * DIM * 4
+    )
+
+
+def test_replace_embedding(_index):
+    _index.add("honeybee", _unit(1))
+    _index.add("honeybee", _unit(0, 1))
+    assert len(_index) == 1
+    assert np.allclose(_index.get("honeybee"), _unit(0, 1))
+
+
+def test_grows_matrix(_index, monkeypatch):
+    monkeypatch.setattr(similarity, "INITIAL_CAPACITY", 4)
+    vectors = _random_unit(10)
+    for i, vector in enumerate(vectors):
+        _index.add(f"voice{i}", vector)
+    assert (_index.directory / "embeddings.f32").stat().st_size == 16 * DIM * 4
+    assert all(np.allclose(_index.get(f"voice{i}"), v) for i, v in enumerate(vectors))
+
+
+def test_changes_shared_between_instances(tmp_path):
+    """Another worker process maps the same files and replays the journal incrementally."""
+    writer = similarity.EmbeddingIndex(tmp_path, dim=DIM)
+    reader = similarity.EmbeddingIndex(tmp_path, dim=DIM)
+    writer.add("honeybee", _unit(1))
+    writer.add("bumblebee", _unit(0, 1))
+    assert [id for id, _ in reader.search(_unit(1), k=1)[0]] == ["honeybee"]
+
+    writer.remove("honeybee")
+    assert [id for id, _ in reader.search(_unit(1), k=1)[0]] == ["bumblebee"]
+
+    # A fresh instance loads everything from disk
+    assert len(similarity.EmbeddingIndex(tmp_path, dim=DIM)) == 1
+
+
+def test_partitioned_search_recall(_index, monkeypatch):
+    monkeypatch.setattr(similarity, "PARTITION_THRESHOLD", 400)
+    vectors = _random_unit(900)
+    for i, vector in enumerate(vectors[:400]):
+        _index.add(f"voice{i}", vector)
+
+    queries = _random_unit(50, seed=1)
+    exact = np.argsort(-(queries @ vectors[:400].T), axis=1)[:, :5]
+    results = _index.search(queries, k=5)
+    assert _index._centroids is not None
+
+    found = [{id for id, _ in neighbours} for neighbours in results]
+    expected = [{f"voice{i}" for i in row} for row in exact]
+    recall = np.mean([len(f & e) / 5 for f, e in zip(found, expected)])
+    assert recall > 0.6
+
+    # Voices inserted after partitioning join their nearest partition
+    _index.add("newcomer", queries[0])
+    assert _index.search(queries[0], k=1)[0][0][0] == "newcomer"
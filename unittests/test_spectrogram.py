@@ -0,0 +1,107 @@
+"""
+unittests.test_spectrogram.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.spectrogram rendering and cache
+"""
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+import pytest
+
+from api import audio, spectrogram
+
+
+def _decode_png(content: bytes) -> np.ndarray:
+    """Decode the grayscale PNG written by encode_png."""
+    assert content[:8] == b"\x89PNG\r\n\x1a\n"
+    width, height = struct.unpack(">II", content[16:24])
+    (length,) = struct.unpack(">I", content[33:37])
+    assert content[37:41] == b"IDAT"
+    scanlines = np.frombuffer(zlib.decompress(content[41 : 41 + length]), np.uint8)
+    return scanlines.reshape(height, width + 1)[:, 1:]
+
+
+def test_encode_png_round_trip():
+    pixels = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    assert np.array_equal(_decode_png(spectrogram.encode_png(pixels)), pixels)
+
+
+def test_render_dimensions_and_orientation():
+    t = np.arange(audio.SAMPLE_RATE * 2) / audio.SAMPLE_RATE
+    low_tone = (0.5 * np.sin(2 * np.pi * 200 * t)).astype(np.float32)
+    pixels = _decode_png(spectrogram.render(low_tone, height=64, width=50))
+
+    assert pixels.shape == (64, 50)
+    # The tone is drawn in the bottom rows
+    assert pixels.mean(axis=1).argmax() >= 60
+
+
+def test_render_short_audio_keeps_frames():
+    pixels = _decode_png(spectrogram.render(np.ones(2048, dtype=np.float32), 32, 512))
+    assert pixels.shape == (32, 5)
+
+
+@pytest.fixture
+def _cache(tmp_path) -> spectrogram.SpectrogramCache:
+    return spectrogram.SpectrogramCache(tmp_path, max_bytes=100)
+
+
+def test_cache_renders_once(_cache):
+    renders = []
+    render = lambda: renders.append(1) or b"png"
+    assert _cache.get("honeybee.png", render) == b"png"
+    assert _cache.get("honeybee.png", render) == b"png"
+    assert len(renders) == 1
+
+
+def test_cache_concurrent_misses_render_once(_cache):
+    renders = []
+
+    def render() -> bytes:
+        renders.append(1)
+        time.sleep(0.05)
+        return b"png"
+
+    threads = [
+        threading.Thread(target=_cache.get, args=("honeybee.png", render))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(renders) == 1
+    assert _cache._key_locks == {}
+
+
+def test_cache_render_failure_not_cached(_cache):
+    def render() -> bytes:
+        raise ValueError("undecodable")
+
+    with pytest.raises(ValueError):
+        _cache.get("honeybee.png", render)
+    assert _cache.get("honeybee.png", lambda: b"png") == b"png"
+
+
+def test_cache_evicts_least_recently_used(_cache):
+    for i, key in enumerate(("a.png", "b.png")):
+        _cache.get(key, lambda: b"x" * 40)
+        os.utime(_cache.directory / key, (i, i))
+    # a is used again, so b is now the least recently used
+    _cache.get("a.png", lambda: b"")
+    _cache.get("c.png", lambda: b"x" * 40)
+
+    assert sorted(path.name for path in _cache.directory.iterdir()) == [
+        "a.png",
+        "c.png",
+    ]
+    assert _cache._size == 80
+
+
+def test_cache_size_loaded_from_disk(tmp_path):
+    (tmp_path / "a.png").write_bytes(b"x" * 30)
+    assert spectrogram.SpectrogramCache(tmp_path, 100)._size == 30
@@ -0,0 +1,152 @@
+"""
+unittests.test_static.py
+~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.static
+"""
+import gzip
+import os
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from api import static
+
+HTML = b"<html><body>" + b"<p>policy</p>" * 100 + b"</body></html>"
+
+
+@pytest.fixture
+def _assets(tmp_path) -> static.StaticAssets:
+    (tmp_path / "page.html").write_bytes(HTML)
+    assets = static.StaticAssets(reload_interval=0)
+    assets.add("page", tmp_path / "page.html", "text/html")
+    return assets
+
+
+@pytest.fixture
+def _client(_assets) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/page")
+    def page(request: Request):
+        return _assets.response("page", request)
+
+    return TestClient(app)
+
+
+def test_asset_variants(_assets):
+    asset = _assets.get("page")
+    assert asset.variants["identity"] == HTML
+    assert gzip.decompress(asset.variants["gzip"]) == HTML
+    assert len(asset.variants["gzip"]) < len(HTML)
+
+
+def test_small_asset_not_compressed(tmp_path):
+    (tmp_path / "tiny.txt").write_bytes(b"tiny")
+    assert list(static.Asset(tmp_path / "tiny.txt", "text/plain").variants) == [
+        "identity"
+    ]
+
+
+def test_served_from_memory(_assets, tmp_path, monkeypatch):
+    _assets.reload_interval = 60
+    _assets.load()
+    monkeypatch.setattr(
+        static.Asset, "__init__", lambda *_: pytest.fail("read the file again")
+    )
+    assert _assets.get("page").variants["identity"] == HTML
+
+
+def test_reloaded_on_change(_assets, tmp_path):
+    etag = _assets.get("page").etag
+    (tmp_path / "page.html").write_bytes(HTML + b"<!-- v2 -->")
+    assert _assets.get("page").variants["identity"].endswith(b"<!-- v2 -->")
+    assert _assets.get("page").etag != etag
+
+
+def test_reload_interval(_assets, tmp_path):
+    _assets.reload_interval = 60
+    _assets.get("page")
+    (tmp_path / "page.html").write_bytes(b"changed")
+    os.utime(tmp_path / "page.html", ns=(0, 0))
+    assert _assets.get("page").variants["identity"] == HTML  # not checked yet
+
+
+def test_unknown_asset(_assets):
+    with pytest.raises(KeyError):
+        _assets.get("missing")
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("", "identity"),
+        ("gzip", "gzip"),
+        ("gzip, deflate, br", "br"),
+        ("br;q=0.5, gzip", "gzip"),
+        ("gzip;q=0", "identity"),
+        ("*", "br"),
+        ("identity", "identity"),
+        ("deflate", "identity"),
+        ("br;q=0.5", "br"),
+        ("identity;q=0, gzip", "gzip"),
+        ("gzip;q=0.5, identity", "identity"),
+        ("gzip, identity;q=0.9", "gzip"),
+        ("br, identity", "br"),  # tied: the smallest
+        ("identity;q=0", None),
+        ("*;q=0", None),
+        ("*;q=0, identity", "identity"),
+    ],
+)
+def test_negotiate(accept_encoding, expected):
+    variants = {"identity": b"x" * 100, "gzip": b"x" * 40, "br": b"x" * 30}
+    assert static.negotiate(accept_encoding, variants) == expected
+
+
+def test_response_headers(_client):
+    resp = _client.get("/page", headers={"accept-encoding": "gzip"})
+
+    assert resp.status_code == 200
+    assert resp.content == HTML  # decoded by the client
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.headers["vary"] == "Accept-Encoding"
+    assert resp.headers["cache-control"] == static.STATIC_CACHE_CONTROL
+    assert resp.headers["etag"].endswith('-gzip"')
+    assert resp.headers["content-type"].startswith("text/html")
+
+
+def test_not_acceptable(_client):
+    resp = _client.get("/page", headers={"accept-encoding": "identity;q=0"})
+    assert resp.status_code == 406
+
+
+def test_identity_etag_differs(_client):
+    identity = _client.get("/page", headers={"accept-encoding": "identity"})
+    gzipped = _client.get("/page", headers={"accept-encoding": "gzip"})
+
+    assert "content-encoding" not in identity.headers
+    assert identity.headers["etag"] != gzipped.headers["etag"]
+
+
+@pytest.mark.parametrize("weak", ["", "W/"])
+def test_not_modified(_client, weak):
+    etag = _client.get("/page").headers["etag"]
+    resp = _client.get("/page", headers={"if-none-match": f'"other", {weak}{etag}'})
+
+    assert resp.status_code == 304
+    assert resp.content == b""
+    assert resp.headers["etag"] == etag
+
+
+def test_modified(_client, tmp_path):
+    etag = _client.get("/page").headers["etag"]
+    (tmp_path / "page.html").write_bytes(HTML + b"<!-- v2 -->")
+
+    resp = _client.get("/page", headers={"if-none-match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["etag"] != etag
+
+
+def test_brotli_variant(_assets):
+    brotli = pytest.importorskip("brotli")
+    assert brotli.decompress(_assets.get("page").variants["br"]) == HTML
@@ -0,0 +1,102 @@
+"""
+unittests.test_tracing.py
+~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.tracing
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from api import tracing
+
+
+def _child_span(root: tracing.Span) -> tracing.Span:
+    """Open a span under the root, return what it yielded."""
+
+    def open_span():
+        with tracing.span("child") as span:
+            return span
+
+    return tracing.context(root).run(open_span)
+
+
+@pytest.fixture
+def _exported(monkeypatch, tmp_path) -> callable:
+    """Export the spans to a temp file, return a function reading them."""
+    path = tmp_path / "spans.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_EXPORT", str(path))
+    monkeypatch.setattr(tracing, "GLOBAL", {})
+    return lambda: (
+        [json.loads(line) for line in path.read_text().splitlines()]
+        if path.exists()
+        else []
+    )
+
+
+def test_off_by_default():
+    root = tracing.trace("webhook.messaging")
+    assert not root.sampled
+    assert _child_span(root) is None
+    root.end()
+    assert tracing.exporter() is None
+
+
+def test_spans_exported(_exported):
+    root = tracing.trace("webhook.messaging", mid="m_1")
+
+    def work():
+        with tracing.span("download", url="cdn") as span:
+            span.set(status=200)
+            with tracing.span("disk.write"):
+                pass
+
+    tracing.context(root).run(work)
+    root.end()
+
+    write, download, exported_root = _exported()
+    assert exported_root["name"] == "webhook.messaging"
+    assert exported_root["parent_id"] is None
+    assert exported_root["attributes"] == {"mid": "m_1"}
+    assert download["parent_id"] == exported_root["span_id"]
+    assert download["attributes"] == {"url": "cdn", "status": 200}
+    assert write["parent_id"] == download["span_id"]
+    assert {write["trace_id"], download["trace_id"]} == {root.trace_id}
+    assert tracing.current() is None
+
+
+def test_span_records_error(_exported):
+    root = tracing.trace("webhook.messaging")
+
+    @tracing.traced("reply")
+    def reply():
+        raise ValueError("graph down")
+
+    with pytest.raises(ValueError):
+        tracing.context(root).run(reply)
+
+    (span,) = _exported()
+    assert span["name"] == "reply"
+    assert span["error"] == "ValueError: graph down"
+
+
+def test_context_propagates_to_threads(_exported):
+    root = tracing.trace("webhook.messaging")
+
+    def work():
+        with tracing.span("job.process"):
+            return tracing.current().trace_id
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(tracing.context(root).run, work).result() == (
+            root.trace_id
+        )
+
+
+def test_sample_rate(_exported, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 0.0)
+    root = tracing.trace("webhook.messaging")
+    assert not root.sampled
+    assert _child_span(root) is None
+    root.end()
+    assert _exported() == []
@@ -0,0 +1,155 @@
+"""
+unittests.test_usercache.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Unittest for api.usercache
+"""
+import subprocess
+import sys
+
+import pytest
+
+from api import usercache
+
+
+@pytest.fixture
+def _cache(tmp_path) -> usercache.SharedCache:
+    cache = usercache.SharedCache(tmp_path / "users", slots=64)
+    yield cache
+    cache.close()
+
+
+def test_miss_then_hit(_cache):
+    assert _cache.get("fb/1") is usercache.MISS
+    assert _cache.put("fb/1", b'{"_id": "fb/1"}', _cache.generation)
+    assert _cache.get("fb/1") == b'{"_id": "fb/1"}'
+
+
+def test_absent_cached(_cache):
+    assert _cache.put("fb/1", None, _cache.generation)
+    assert _cache.get("fb/1") is None
+
+
+def test_invalidate(_cache):
+    _cache.put("fb/1", None, _cache.generation)
+    _cache.put("fb/2", b"bee", _cache.generation)
+    _cache.invalidate("fb/1")
+
+    assert _cache.get("fb/1") is usercache.MISS
+    assert _cache.get("fb/2") == b"bee"
+
+
+def test_fill_racing_an_invalidation_dropped(_cache):
+    generation = _cache.generation  # read, then the value is fetched...
+    _cache.invalidate("fb/1")  # ...while another worker updates the user
+
+    assert not _cache.put("fb/1", b"stale", generation)
+    assert _cache.get("fb/1") is usercache.MISS
+
+
+def test_too_large_not_cached(_cache):
+    assert not _cache.put("fb/1", b"x" * (usercache.MAX_VALUE + 1), _cache.generation)
+    assert not _cache.put("x" * (usercache.MAX_KEY + 1), b"", _cache.generation)
+    assert _cache.get("fb/1") is usercache.MISS
+
+
+def test_overwrite(_cache):
+    _cache.put("fb/1", b"honey", _cache.generation)
+    _cache.put("fb/1", b"bee", _cache.generation)
+    assert _cache.get("fb/1") == b"bee"
+
+
+def test_full_table_evicts(tmp_path):
+    cache = usercache.SharedCache(tmp_path / "users", slots=4)
+    for i in range(20):
+        cache.put(f"fb/{i}", str(i).encode(), cache.generation)
+
+    cached = [i for i in range(20) if cache.get(f"fb/{i}") is not usercache.MISS]
+    assert 0 < len(cached) <= 4
+    assert 19 in cached  # the last put is always kept
+    for i in cached:
+        assert cache.get(f"fb/{i}") == str(i).encode()
+
+
+def test_invalidated_slot_keeps_later_probes(tmp_path):
+    cache = usercache.SharedCache(tmp_path / "users", slots=2)
+    for i in range(2):
+        cache.put(f"fb/{i}", b"bee", cache.generation)
+    for i in range(2):
+        cache.invalidate(f"fb/{i}")
+        assert all(
+            cache.get(f"fb/{j}") == b"bee" for j in range(i + 1, 2)
+        )  # still found
+
+
+def test_clear(_cache):
+    _cache.put("fb/1", b"bee", _cache.generation)
+    generation = _cache.generation
+    _cache.clear()
+
+    assert _cache.get("fb/1") is usercache.MISS
+    assert _cache.generation > generation
+
+
+def _kill_writing(cache: usercache.SharedCache, key: str):
+    """Leave the slot of the key odd, as a writer killed mid-write does."""
+    offset = next(cache._offsets(key.encode()))
+    sequence = usercache.SLOT.unpack_from(cache._map, offset)[0]
+    usercache.struct.pack_into("<I", cache._map, offset, sequence + 1)
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_slot_left_by_dead_writer_overwritten(_cache, cached):
+    if cached:
+        _cache.put("fb/1", b"bee", _cache.generation)
+    _kill_writing(_cache, "fb/1")
+    assert _cache.get("fb/1") is usercache.MISS
+
+    assert _cache.put("fb/1", b"honey", _cache.generation)
+    assert _cache.get("fb/1") == b"honey"
+
+
+def test_slot_left_by_dead_writer_invalidated(_cache):
+    _cache.put("fb/1", b"bee", _cache.generation)
+    _kill_writing(_cache, "fb/1")
+    _cache.invalidate("fb/1")
+    _cache.clear()
+
+    assert _cache.get("fb/1") is usercache.MISS
+    assert _cache.put("fb/1", b"honey", _cache.generation)
+    assert _cache.get("fb/1") == b"honey"
+
+
+def test_shared_across_processes(_cache, tmp_path):
+    _cache.put("fb/1", b"bee", _cache.generation)
+    script = (
+        "import sys; from api import usercache; "
+        f"cache = usercache.SharedCache({str(tmp_path / 'users')!r}, slots=64); "
+        "print(cache.get('fb/1').decode()); "
+        "cache.invalidate('fb/1')"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    ).stdout
+
+    assert output.strip() == "bee"
+    assert _cache.get("fb/1") is usercache.MISS  # invalidated by the other process
+
+
+def test_layout_change_resets(_cache, tmp_path):
+    _cache.put("fb/1", b"bee", _cache.generation)
+    resized = usercache.SharedCache(tmp_path / "users", slots=32)
+    assert resized.get("fb/1") is usercache.MISS
+
+
+def test_reopened(_cache, tmp_path):
+    _cache.put("fb/1", b"bee", _cache.generation)
+    assert usercache.SharedCache(tmp_path / "users", slots=64).get("fb/1") == b"bee"
+
+
+def test_cache_off_by_default(monkeypatch, tmp_path):
+    monkeypatch.setattr(usercache, "USER_CACHE_PATH", None)
+    assert usercache.cache() is None
+
+    monkeypatch.setattr(usercache, "USER_CACHE_PATH", str(tmp_path / "users"))
+    monkeypatch.setattr(usercache, "GLOBAL", {})
+    assert usercache.cache() is usercache.cache()
@@ -4,11 +4,13 @@ unittests.test_utils.py
 Unittest for api.utils models
 """
 import re
+import threading
 from collections.abc import Mapping
 from datetime import datetime
 from typing import Optional
 from zoneinfo import ZoneInfo
 
+import pymongo
 import pytest
 import requests
 import responses
@@ -17,6 +19,16 @@ from api import datastore, utils
 from models import facebook
 
 
+@pytest.fixture(autouse=True)
+def _auto_mock_not_archived(mocker):
+    mocker.patch("api.datastore.get_metadata", return_value=None)
+
+
+@pytest.fixture(autouse=True)
+def _auto_mock_active_prompt(mocker):
+    return mocker.patch("api.datastore.active_prompt", return_value=1)
+
+
 def __from_ts(ts: str, tz: Optional[str] = "UTC") -> datetime:
     """Convert timestamp with the format `2024-01-03 19:30:00` to datetime object with UTC timezone."""
     return datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=ZoneInfo(tz))
@@ -172,6 +184,8 @@ def test_handle_user_message_succeeds(mocker):
         username="fb/tanwinn",
         audio_extension="wav",
         prompt_id=1,
+        fingerprint=None,  # content isn't decodable audio
+        reject_duplicates=False,
     )
 
 
@@ -225,6 +239,26 @@ def test_handle_fb_user_new_registered_successfully(mocker):
     )
 
 
+@responses.activate
+def test_handle_fb_user_registered_by_another_worker(mocker):
+    # the user filter of this worker doesn't know the user yet
+    mocker.patch("api.datastore.user_registered", return_value=False)
+    responses.add(
+        responses.GET,
+        re.compile(f"{utils.FB_GRAPH_API}*"),
+        json={"first_name": "Takenobu", "id": 123456789},
+        status=200,
+    )
+    mocker.patch(
+        "api.datastore.insert_user",
+        side_effect=pymongo.errors.DuplicateKeyError("E11000"),
+    )
+    reply_to_user_action = mocker.patch("api.utils.reply_to")
+
+    assert utils.handle_fb_user(123456789) == "fb/123456789"
+    reply_to_user_action.assert_not_called()
+
+
 @responses.activate
 def test_handle_fb_user_new_registered_no_name_successfully(mocker):
     # Mock external deps
@@ -291,3 +325,146 @@ def test_reply_to_conn_err():
     )
     with pytest.raises(requests.exceptions.HTTPError):
         utils.reply_to(123456, "This is a reply.")
+
+
+def __audio_attachment(url: str) -> facebook.Attachment:
+    return facebook.Attachment(
+        type="audio", payload=facebook.AttachmentPayload(url=url)
+    )
+
+
+def test_handle_user_message_many_attachments(mocker):
+    archive = mocker.patch("api.utils.__extract_and_store_audio_from_url")
+    message = facebook.Message(
+        mid="kajhdisx",
+        attachments=[
+            __audio_attachment("tanwinn.io/a"),
+            __audio_attachment("tanwinn.io/b"),
+        ],
+    )
+    answer = utils.handle_user_message("fb/tanwinn", message)
+
+    assert answer == "Saved 2 of 2 audio files with IDs kajhdisx-0, kajhdisx-1."
+    assert sorted(call.kwargs["voice_id"] for call in archive.call_args_list) == [
+        "kajhdisx-0",
+        "kajhdisx-1",
+    ]
+
+
+def test_handle_user_message_assigned_prompt_open_when_sent(
+    mocker, _auto_mock_active_prompt
+):
+    _auto_mock_active_prompt.return_value = 7
+    archive = mocker.patch("api.utils.__extract_and_store_audio_from_url")
+    message = facebook.Message(
+        mid="kajhdisx",
+        attachments=[
+            __audio_attachment("tanwinn.io/a"),
+            __audio_attachment("tanwinn.io/b"),
+        ],
+    )
+    utils.handle_user_message("fb/tanwinn", message, timestamp=1704339000000)
+
+    _auto_mock_active_prompt.assert_called_once_with(__from_ts("2024-01-04 03:30:00"))
+    assert [call.kwargs["prompt_id"] for call in archive.call_args_list] == [7, 7]
+
+
+def test_handle_user_message_many_attachments_downloaded_concurrently(mocker):
+    barrier = threading.Barrier(3, timeout=5)
+    # Every download waits for the others: it only passes if they all run at once
+    mocker.patch(
+        "api.utils.__extract_and_store_audio_from_url",
+        side_effect=lambda **_: barrier.wait(),
+    )
+    message = facebook.Message(
+        mid="kajhdisx",
+        attachments=[__audio_attachment(f"tanwinn.io/{i}") for i in range(3)],
+    )
+    assert utils.handle_user_message("fb/tanwinn", message).startswith("Saved 3 of 3")
+
+
+def test_handle_user_message_many_attachments_partial(mocker):
+    def archive(user_id, attachment, voice_id, prompt_id):
+        if voice_id.endswith("-1"):
+            raise AttributeError("Attachment not an audio.")
+
+    mocker.patch("api.utils.__extract_and_store_audio_from_url", side_effect=archive)
+    message = facebook.Message(
+        mid="kajhdisx",
+        attachments=[
+            __audio_attachment("tanwinn.io/a"),
+            __audio_attachment("tanwinn.io/b"),
+        ],
+    )
+    assert utils.handle_user_message("fb/tanwinn", message) == (
+        "Saved 1 of 2 audio files with IDs kajhdisx-0."
+        " Not saved: kajhdisx-1 (not an audio)."
+    )
+
+
+@pytest.mark.parametrize(
+    "error, reason",
+    [
+        (
+            datastore.DuplicateVoiceError("Duplicate of fb/other's voice mid.xyz"),
+            "duplicate",
+        ),
+        (RuntimeError("disk full at /voices"), "error"),
+    ],
+)
+def test_handle_user_message_many_attachments_reason_without_details(
+    mocker, error, reason
+):
+    def archive(user_id, attachment, voice_id, prompt_id):
+        if voice_id.endswith("-1"):
+            raise error
+
+    mocker.patch("api.utils.__extract_and_store_audio_from_url", side_effect=archive)
+    message = facebook.Message(
+        mid="kajhdisx",
+        attachments=[
+            __audio_attachment("tanwinn.io/a"),
+            __audio_attachment("tanwinn.io/b"),
+        ],
+    )
+    assert utils.handle_user_message("fb/tanwinn", message).endswith(
+        f" Not saved: kajhdisx-1 ({reason})."
+    )
+
+
+def test_handle_user_message_many_attachments_datastore_down_raised(mocker):
+    def archive(user_id, attachment, voice_id, prompt_id):
+        if voice_id.endswith("-1"):
+            raise pymongo.errors.AutoReconnect("mongo down")
+
+    mocker.patch("api.utils.__extract_and_store_audio_from_url", side_effect=archive)
+    message = facebook.Message(
+        mid="kajhdisx",
+        attachments=[
+            __audio_attachment("tanwinn.io/a"),
+            __audio_attachment("tanwinn.io/b"),
+        ],
+    )
+    with pytest.raises(pymongo.errors.ConnectionFailure):
+        utils.handle_user_message("fb/tanwinn", message)
+
+
+def test_handle_user_message_many_attachments_retry_skips_archived(mocker):
+    mocker.patch(
+        "api.datastore.get_metadata",
+        side_effect=lambda id: "archived" if id.endswith("-0") else None,
+    )
+    archive = mocker.patch(
+        "api.utils.__extract_and_store_audio_from_url",
+        side_effect=requests.exceptions.HTTPError("cdn down"),
+    )
+    message = facebook.Message(
+        mid="kajhdisx",
+        attachments=[
+            __audio_attachment("tanwinn.io/a"),
+            __audio_attachment("tanwinn.io/b"),
+        ],
+    )
+    with pytest.raises(requests.exceptions.HTTPError):
+        utils.handle_user_message("fb/tanwinn", message)
+    archive.assert_called_once()